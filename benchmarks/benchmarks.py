@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/benchmarks/benchmarks.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+###############################################################################
+## Benchmark suite for pysto, written for asv (airspeed velocity).
+##
+## Each class benchmarks one function. Methods starting with time_ record wall
+## time, and methods starting with peakmem_ record the peak memory (RSS) of the
+## process while the function runs. The inputs are synthetic 2D, 3D and RGB
+## arrays of several sizes, created in setup() with a fixed random seed.
+##
+## Run the benchmarks for the current commit, or compare two commits and flag
+## regressions (see also "make bench" and "make bench-compare"):
+##
+##     asv run
+##     asv continuous --factor 1.1 master HEAD
+##
+## Benchmarks on memory-mapped inputs are only run when the environment
+## variable PYSTO_BENCH_MEMMAP_GB is set to the size in GB of the volume to
+## test (e.g. PYSTO_BENCH_MEMMAP_GB=4). The memmap files are created once in
+## directory PYSTO_BENCH_DIR (default: <tmp>/pysto_bench) and reused.
+###############################################################################
+
+import os
+import tempfile
+import numpy as np
+import pysto.imgproc as pymg
+import pysto.imgprocITK as pitk
+
+# input sizes (name -> shape). 2D images are grayscale, 'rgb' images have an
+# extra channel dimension, and 3D volumes are grayscale
+SHAPES = {
+    '2D_1MP': (1000, 1000),
+    '2D_16MP': (4000, 4000),
+    'rgb_1MP': (1000, 1000, 3),
+    'rgb_16MP': (4000, 4000, 3),
+    '3D_1MP': (100, 100, 100),
+    '3D_16MP': (256, 256, 256),
+}
+
+# name of the memory-mapped input
+MEMMAP = 'memmap'
+
+def _memmap_shape():
+    """Shape of the memory-mapped uint8 3D volume, from PYSTO_BENCH_MEMMAP_GB,
+    or None if memmap benchmarks are disabled."""
+    gb = os.environ.get('PYSTO_BENCH_MEMMAP_GB')
+    if gb is None:
+        return None
+    side = int(round((float(gb) * 2**30) ** (1.0 / 3)))
+    return (side, side, side)
+
+def _memmap(shape, dtype=np.uint8):
+    """Read-only memmap of the given shape, filled with random values. The
+    file is only written the first time."""
+    bench_dir = os.environ.get('PYSTO_BENCH_DIR', 
+                               os.path.join(tempfile.gettempdir(), 'pysto_bench'))
+    if not os.path.isdir(bench_dir):
+        os.makedirs(bench_dir)
+    filename = os.path.join(bench_dir, 'x_' + '_'.join(str(s) for s in shape) 
+                            + '_' + np.dtype(dtype).name + '.dat')
+    if not os.path.isfile(filename):
+        x = np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+        rng = np.random.RandomState(0)
+        # fill by slices, so that we don't need the whole volume in memory
+        for i in range(shape[0]):
+            x[i] = rng.randint(0, 256, size=shape[1:])
+        x.flush()
+        del x
+    return np.memmap(filename, dtype=dtype, mode='r', shape=shape)
+
+def _array(name, dtype=np.uint8):
+    """Synthetic input array. Raises NotImplementedError (asv skips the 
+    benchmark) for memmap inputs if they have not been enabled."""
+    if name == MEMMAP:
+        shape = _memmap_shape()
+        if shape is None:
+            raise NotImplementedError('Set PYSTO_BENCH_MEMMAP_GB to run memmap benchmarks')
+        return _memmap(shape, dtype)
+    rng = np.random.RandomState(0)
+    return rng.randint(0, 256, size=SHAPES[name]).astype(dtype)
+
+def _grayscale_names():
+    return [k for k in sorted(SHAPES) if not k.startswith('rgb')]
+
+###############################################################################
+## block_split / block_stack
+###############################################################################
+
+class BlockSplit(object):
+    
+    params = ([MEMMAP] + _grayscale_names(), [0, 8])
+    param_names = ['input', 'pad_width']
+    timeout = 600
+    
+    def setup(self, name, pad_width):
+        self.x = _array(name)
+        self.nblocks = 4
+        
+    def time_block_split(self, name, pad_width):
+        pymg.block_split(self.x, nblocks=self.nblocks, pad_width=pad_width)
+        
+    def peakmem_block_split(self, name, pad_width):
+        pymg.block_split(self.x, nblocks=self.nblocks, pad_width=pad_width)
+        
+class BlockSplitLazy(object):
+    
+    params = ([MEMMAP] + _grayscale_names(), [0, 8])
+    param_names = ['input', 'pad_width']
+    timeout = 600
+    
+    def setup(self, name, pad_width):
+        self.x = _array(name)
+        self.nblocks = 4
+        
+    def time_block_split_lazy(self, name, pad_width):
+        # read all the blocks, one at a time
+        _, blocks, _ = pymg.block_split(self.x, nblocks=self.nblocks, pad_width=pad_width, lazy=True)
+        for b in blocks:
+            pass
+        
+    def peakmem_block_split_lazy(self, name, pad_width):
+        _, blocks, _ = pymg.block_split(self.x, nblocks=self.nblocks, pad_width=pad_width, lazy=True)
+        for b in blocks:
+            pass
+        
+class BlockStack(object):
+    
+    params = (_grayscale_names(), [0, 8])
+    param_names = ['input', 'pad_width']
+    timeout = 600
+    
+    def setup(self, name, pad_width):
+        x = _array(name).astype(np.float32)
+        self.block_slices, self.blocks, _ = pymg.block_split(x, nblocks=4, pad_width=pad_width)
+        
+    def time_block_stack(self, name, pad_width):
+        pymg.block_stack(self.blocks, self.block_slices, pad_width=pad_width)
+        
+    def peakmem_block_stack(self, name, pad_width):
+        pymg.block_stack(self.blocks, self.block_slices, pad_width=pad_width)
+        
+###############################################################################
+## matchHist
+###############################################################################
+
+class MatchHist(object):
+    
+    params = (['2D_1MP', '2D_16MP', 'rgb_1MP', 'rgb_16MP'], [False, True], ['numpy', 'numba'])
+    param_names = ['input', 'mask', 'backend']
+    timeout = 600
+    
+    def setup(self, name, use_mask, backend):
+        if backend != 'numpy':
+            try:
+                import numba
+            except ImportError:
+                raise NotImplementedError('numba is not installed')
+        self.imref = _array(name)
+        # image to correct: a darker, lower contrast version of the reference
+        self.im = (self.imref // 2 + 20).astype(np.uint8)
+        if use_mask:
+            rng = np.random.RandomState(1)
+            self.mask = rng.rand(*self.im.shape[0:2]) > 0.5
+        else:
+            self.mask = np.ones(0, dtype=bool)
+        # compile the kernels outside of the timed function
+        pymg.matchHist(self.imref[0:4, 0:4], self.im[0:4, 0:4], backend=backend)
+            
+    def time_matchHist(self, name, use_mask, backend):
+        pymg.matchHist(self.imref, self.im, maskref=self.mask, mask=self.mask, backend=backend)
+        
+    def peakmem_matchHist(self, name, use_mask, backend):
+        pymg.matchHist(self.imref, self.im, maskref=self.mask, mask=self.mask, backend=backend)
+
+###############################################################################
+## imfuse
+###############################################################################
+
+class Imfuse(object):
+    
+    params = ['2D_1MP', '2D_16MP', 'rgb_1MP', 'rgb_16MP']
+    param_names = ['input']
+    
+    def setup(self, name):
+        self.a = _array(name)
+        # second image slightly smaller, so that zero-padding is necessary
+        self.b = self.a[10:, 20:].copy()
+        
+    def time_imfuse(self, name):
+        pymg.imfuse(self.a, self.b)
+        
+    def peakmem_imfuse(self, name):
+        pymg.imfuse(self.a, self.b)
+
+###############################################################################
+## imshow
+###############################################################################
+
+class Imshow(object):
+    
+    params = ['2D_1MP', '2D_16MP']
+    param_names = ['input']
+    
+    def setup(self, name):
+        import matplotlib
+        matplotlib.use('Agg')
+        import SimpleITK as sitk
+        self.im = sitk.GetImageFromArray(_array(name))
+        self.im.SetSpacing((0.5, 0.5))
+        
+    def teardown(self, name):
+        import matplotlib.pyplot as plt
+        plt.close('all')
+        
+    def time_imshow(self, name):
+        pitk.imshow(self.im)
+
+###############################################################################
+## TypicalBorderIntensity
+###############################################################################
+
+class TypicalBorderIntensity(object):
+    
+    params = (_grayscale_names() + ['rgb_1MP', 'rgb_16MP'], ['array', 'Image'])
+    param_names = ['input', 'type']
+    
+    def setup(self, name, im_type):
+        im = _array(name)
+        if im_type == 'Image':
+            import SimpleITK as sitk
+            self.im = sitk.GetImageFromArray(im, isVector=name.startswith('rgb'))
+        else:
+            if name.startswith('rgb'):
+                # np.arrays are treated as grayscale images
+                raise NotImplementedError
+            self.im = im
+            
+    def time_TypicalBorderIntensity(self, name, im_type):
+        pitk.TypicalBorderIntensity(self.im)
+        
+    def peakmem_TypicalBorderIntensity(self, name, im_type):
+        pitk.TypicalBorderIntensity(self.im)
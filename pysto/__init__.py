@@ -28,3 +28,66 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see
 <http://www.gnu.org/licenses/>.
 """
+
+###############################################################################
+## Lazy access to the public API
+##
+## Importing pysto does not import any of its submodules. Public functions are
+## looked up the first time they are accessed (e.g. pysto.block_split), which
+## imports only the submodule that defines them. Heavy dependencies (OpenCV,
+## SimpleITK, matplotlib) are in turn only imported when a function that needs
+## them is called. Note: attribute lookup on the package requires python >= 3.7
+## (PEP 562). With older versions, import the submodules explicitly, e.g.
+##
+##     import pysto.imgproc as pym
+###############################################################################
+
+import importlib
+
+# submodules that can be accessed as attributes of the package
+_submodules = ['imgproc', 'imgprocITK', 'blockproc', 'instrument', 'cache', 'cli']
+
+# public name -> submodule that defines it
+_lazy_api = {
+    'block_split': 'imgproc',
+    'block_auto_nblocks': 'imgproc',
+    'block_slices_to_array': 'imgproc',
+    'block_slices_from_array': 'imgproc',
+    'LazyBlocks': 'imgproc',
+    'block_stack': 'imgproc',
+    'block_stack_roi': 'imgproc',
+    'BlockIndex': 'imgproc',
+    'imfuse': 'imgproc',
+    'matchHist': 'imgproc',
+    'matchHistLocal': 'imgproc',
+    'HistogramAccumulator': 'imgproc',
+    'imshow': 'imgprocITK',
+    'block_prefetch': 'blockproc',
+    'block_split_dask': 'blockproc',
+    'block_stack_dask': 'blockproc',
+    'block_apply_dask': 'blockproc',
+    'block_apply': 'blockproc',
+    'BlockExecutor': 'blockproc',
+    'InProcessExecutor': 'blockproc',
+    'ProcessQueueExecutor': 'blockproc',
+    'BufferPool': 'blockproc',
+    'CompressedBlockStore': 'blockproc',
+    'TypicalBorderIntensity': 'imgprocITK',
+    'imfuseITK': 'imgprocITK',
+}
+
+__all__ = _submodules + sorted(_lazy_api)
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module('.' + name, __name__)
+    if name in _lazy_api:
+        module = importlib.import_module('.' + _lazy_api[name], __name__)
+        value = getattr(module, name)
+        # cache the value, so that __getattr__ is not called again for it
+        globals()[name] = value
+        return value
+    raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
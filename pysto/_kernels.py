@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/pysto/_kernels.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+###############################################################################
+## Numba-compiled kernels used by the accelerated backend of pysto functions.
+##
+## This module is private, and it's only imported when a function is called
+## with backend='numba' or backend='auto'. It raises ImportError if numba is
+## not installed, in which case pysto falls back to the pure-NumPy path.
+##
+## Summary of functions in this module:
+##
+##   match_hist:
+##      Kernel of matchHist. For each channel, it computes the histograms of 
+##      the reference and the image in one pass each, without flattening or 
+##      gathering masked pixels into temporary arrays, and maps the image 
+##      intensities in a single fused pass over the output.
+##
+## The kernels reproduce the arithmetic of np.histogram(..., density=True) 
+## and np.interp(), so that both backends produce the same results.
+###############################################################################
+
+import numpy as np
+import numba
+
+###############################################################################
+## Compiled kernels
+###############################################################################
+
+@numba.njit(cache=True, nogil=True)
+def _minmax(x, c, mask):
+    """Min and max of channel c of x[pixel, channel], and number of pixels, 
+    only counting pixels with mask==True (mask of length 0 means no mask).
+    As with np.min() and np.max(), min and max are NaN if there's any NaN."""
+    use_mask = mask.shape[0] > 0
+    mn = np.inf
+    mx = -np.inf
+    n = 0
+    for i in range(x.shape[0]):
+        if use_mask and not mask[i]:
+            continue
+        v = np.float64(x[i, c])
+        if np.isnan(v):
+            return v, v, n + 1
+        if v < mn:
+            mn = v
+        if v > mx:
+            mx = v
+        n += 1
+    return mn, mx, n
+
+@numba.njit(cache=True, nogil=True)
+def _histogram(x, c, mask, edges):
+    """Counts of channel c of x[pixel, channel] in equal-width bins, with the
+    same bin assignment as np.histogram()."""
+    use_mask = mask.shape[0] > 0
+    nbins = edges.shape[0] - 1
+    first = edges[0]
+    norm = nbins / (edges[nbins] - first)
+    counts = np.zeros(nbins, dtype=np.int64)
+    for i in range(x.shape[0]):
+        if use_mask and not mask[i]:
+            continue
+        v = np.float64(x[i, c])
+        j = np.intp((v - first) * norm)
+        if j == nbins:
+            j -= 1
+        # correct for rounding errors at the bin edges
+        if v < edges[j]:
+            j -= 1
+        elif v >= edges[j + 1] and j != nbins - 1:
+            j += 1
+        counts[j] += 1
+    return counts
+
+@numba.njit(cache=True, nogil=True, inline='always')
+def _interp(v, xp, fp):
+    """Scalar np.interp(v, xp, fp)."""
+    n = xp.shape[0]
+    if v < xp[0]:
+        return fp[0]
+    if v >= xp[n - 1]:
+        return fp[n - 1]
+    if np.isnan(v):
+        return v
+    # binary search for j such that xp[j] <= v < xp[j+1]
+    lo = 0
+    hi = n - 1
+    while hi - lo > 1:
+        mid = (lo + hi) >> 1
+        if xp[mid] <= v:
+            lo = mid
+        else:
+            hi = mid
+    j = lo
+    slope = (fp[j + 1] - fp[j]) / (xp[j + 1] - xp[j])
+    r = slope * (v - xp[j]) + fp[j]
+    if np.isnan(r):
+        r = slope * (v - xp[j + 1]) + fp[j + 1]
+        if np.isnan(r) and fp[j] == fp[j + 1]:
+            r = fp[j]
+    return r
+
+@numba.njit(cache=True, nogil=True)
+def _apply(x, out, c, mask, cbins, cdf, cdfref, cbinsref):
+    """Map channel c of x to the reference histogram, writing the result to 
+    out. The two interpolations are fused, so no temporary arrays are 
+    created."""
+    use_mask = mask.shape[0] > 0
+    for i in range(x.shape[0]):
+        if use_mask and not mask[i]:
+            continue
+        v = np.float64(x[i, c])
+        out[i, c] = _interp(_interp(v, cbins, cdf), cdfref, cbinsref)
+
+@numba.njit(cache=True, nogil=True)
+def _apply_lut(x, out, c, mask, offset, lut):
+    """Like _apply(), for integer images, using a look-up table with the 
+    mapped value of each integer intensity, lut[v - offset]."""
+    use_mask = mask.shape[0] > 0
+    for i in range(x.shape[0]):
+        if use_mask and not mask[i]:
+            continue
+        out[i, c] = lut[np.intp(x[i, c]) - offset]
+        
+@numba.njit(cache=True, nogil=True)
+def _make_lut(mn, mx, cbins, cdf, cdfref, cbinsref):
+    lut = np.empty(mx - mn + 1, dtype=np.float64)
+    for k in range(mx - mn + 1):
+        lut[k] = _interp(_interp(np.float64(mn + k), cbins, cdf), cdfref, cbinsref)
+    return lut
+
+###############################################################################
+## Python wrappers
+###############################################################################
+
+# integer images whose intensity range is at most this size are mapped with a
+# look-up table
+_MAX_LUT_SIZE = 1 << 16
+
+def _hist_cdf(x, c, mask, nbins):
+    """Bin edges and cumulative sum of the density histogram of channel c, as
+    computed with np.histogram(..., density=True).cumsum()."""
+    mn, mx, n = _minmax(x, c, mask)
+    if n == 0:
+        mn, mx = 0.0, 1.0
+    elif not (np.isfinite(mn) and np.isfinite(mx)):
+        # same error as np.histogram()
+        raise ValueError('autodetected range of [{}, {}] is not finite'.format(mn, mx))
+    elif mn == mx:
+        mn, mx = mn - 0.5, mx + 0.5
+    dtype = np.result_type(mn, mx, x.dtype)
+    if not np.issubdtype(dtype, np.floating):
+        dtype = np.float64
+    edges = np.linspace(mn, mx, nbins + 1, endpoint=True, dtype=dtype)
+    counts = _histogram(x, c, mask, edges.astype(np.float64))
+    db = np.array(np.diff(edges), float)
+    return edges, (counts / db / counts.sum()).cumsum()
+
+def match_hist(ref, out, maskref, mask, nbins):
+    """Match the histogram of each channel of out to the corresponding 
+    channel of ref, in place.
+    
+    Args:
+        ref, out: Arrays [pixel, channel]. out must be writable, and contain
+        a copy of the image to be corrected.
+        
+        maskref, mask: 1D bool arrays [pixel], or arrays of length 0 for no 
+        mask.
+        
+        nbins: Number of histogram bins.
+    """
+    for c in range(ref.shape[1]):
+        edgesref, cdfref = _hist_cdf(ref, c, maskref, nbins)
+        edges, cdf = _hist_cdf(out, c, mask, nbins)
+        
+        # bin centers
+        cbinsref = (edgesref[:-1] + edgesref[1:]) / 2.0
+        cbins = (edges[:-1] + edges[1:]) / 2.0
+        
+        # for integer images with a small range of values, compute the mapping
+        # once per value instead of once per pixel
+        if np.issubdtype(out.dtype, np.integer):
+            mn, mx, n = _minmax(out, c, mask)
+            if (n > 0) and (mx - mn < _MAX_LUT_SIZE):
+                lut = _make_lut(int(mn), int(mx), cbins, cdf, cdfref, cbinsref)
+                _apply_lut(out, out, c, mask, int(mn), lut.astype(out.dtype))
+                continue
+        _apply(out, out, c, mask, cbins, cdf, cdfref, cbinsref)
@@ -0,0 +1,853 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/pysto/blockproc.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+###############################################################################
+## Summary of functions in this module:
+##
+##   block_prefetch:
+##      Iterate blocks while the next ones are read in a background thread.
+##
+##   BufferPool:
+##      Pool of reusable buffers for the block copies of block_split().
+##
+##   CompressedBlockStore:
+##      Sequence of blocks kept compressed in memory, accepted by block_stack().
+##
+##   block_split_dask, block_stack_dask, block_apply_dask:
+##      Dask equivalents of block_split() and block_stack(), to process blocks
+##      on a Dask cluster with the same padding and reassembly.
+##
+##   BlockExecutor, InProcessExecutor, ProcessQueueExecutor:
+##      Executor interface to run block tasks, with an in-process backend and
+##      a local multi-process backend that stands in for a cluster.
+##
+##   block_apply:
+##      Apply a function to each padded block of an array with an executor,
+##      with retries for failed blocks and per-block timing.
+##
+## Helpers to process the blocks produced by imgproc.block_split().
+###############################################################################
+
+import threading
+import collections
+import multiprocessing
+import pickle
+import traceback
+import numpy as np
+from pysto.imgproc import _pad_width_tuple, _block_idx, BlockIndex, block_split, \
+    block_slices_to_array
+from pysto.instrument import instrumented, current, _clock
+from pysto.cache import cached
+
+try:
+    import queue
+except ImportError: # python 2.7
+    import Queue as queue
+
+###############################################################################
+## block_prefetch
+###############################################################################
+
+def block_prefetch(blocks, depth=2):
+    """Iterate blocks while the next ones are read in a background thread.
+    
+    When blocks are read from disk (e.g. the LazyBlocks output of 
+    block_split(..., lazy=True)), a plain loop alternates between reading a 
+    block and processing it. This generator reads (and pads) up to 'depth' 
+    blocks ahead in a background thread, so that I/O overlaps with the 
+    processing of the current block
+    
+        block_slices, blocks, _ = block_split(dataset, nblocks, pad_width=8)
+        for sl, block in zip(block_slices, block_prefetch(blocks, depth=4)):
+            ...
+    
+    At most 'depth' blocks are waiting in the queue at any time (plus the one
+    being read and the one being processed), so memory use is bounded. 
+    Exceptions raised while reading a block are re-raised in the caller when 
+    that block is reached. If the caller stops iterating early, the 
+    background thread is stopped too.
+    
+    Args:
+        blocks: Iterable of blocks, e.g. LazyBlocks or a list.
+        
+        depth: (def 2) Maximum number of blocks read in advance.
+        
+    Returns:
+        Generator of blocks, in the same order as blocks.
+    """
+    
+    if depth < 1:
+        raise ValueError('depth must be >= 1')
+    
+    # bounded queue, to stop reading when the consumer falls behind
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    
+    # markers for the end of the blocks and for errors
+    _end = object()
+    _error = object()
+    
+    def put(item):
+        # put item in the queue, waiting while it's full, unless the consumer
+        # has stopped. Returns False if stopped
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def reader():
+        try:
+            for block in blocks:
+                if not put((None, block)):
+                    return
+        except BaseException as e:
+            put((_error, e))
+            return
+        put((_end, None))
+            
+    thread = threading.Thread(target=reader, name='pysto-block-prefetch')
+    thread.daemon = True
+    thread.start()
+    
+    try:
+        while True:
+            flag, item = q.get()
+            if flag is _end:
+                return
+            elif flag is _error:
+                raise item
+            yield item
+    finally:
+        # stop the reader, and empty the queue so that it's not blocked in 
+        # put()
+        stop.set()
+        while True:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                break
+        thread.join()
+
+###############################################################################
+## BufferPool
+###############################################################################
+
+class BufferPool(object):
+    """Pool of reusable array buffers for block copies.
+    
+    Splitting and stacking thousands of blocks with the same shape allocates
+    and frees one array per block, and the first write to each new array 
+    triggers page faults. A BufferPool keeps released buffers and hands them
+    out again for blocks with the same shape and dtype, so memory use stays 
+    flat
+    
+        pool = BufferPool()
+        buf = pool.acquire((256, 256), np.uint8)
+        ...
+        pool.release(buf)
+    
+    It's used by block_split(..., pool=pool) and block_stack(..., pool=pool).
+    Acquired buffers are not initialised. The pool can be shared between 
+    threads.
+    
+    Args:
+        max_bytes: (def None) Maximum number of bytes kept in the pool. 
+        Buffers released when the pool is full are left to the garbage 
+        collector. By default, there's no limit.
+        
+    Attributes:
+        nallocated: Number of buffers allocated by acquire().
+        
+        nreused: Number of buffers taken from the pool by acquire().
+        
+        nbytes: Bytes currently kept in the pool.
+    """
+    
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.nallocated = 0
+        self.nreused = 0
+        self.nbytes = 0
+        self._free = {}
+        self._lock = threading.Lock()
+        
+    @staticmethod
+    def _key(shape, dtype):
+        return tuple(int(s) for s in shape), np.dtype(dtype).str
+        
+    def acquire(self, shape, dtype):
+        """Buffer with the given shape and dtype, reused from the pool if 
+        possible, or newly allocated."""
+        key = self._key(shape, dtype)
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                buf = free.pop()
+                self.nbytes -= buf.nbytes
+                self.nreused += 1
+                return buf
+            self.nallocated += 1
+        return np.empty(key[0], dtype=dtype)
+    
+    def release(self, buf):
+        """Return a buffer to the pool. Only whole C-contiguous arrays that
+        own their memory are kept (not views of other arrays)."""
+        if not isinstance(buf, np.ndarray) or (buf.base is not None) \
+                or not buf.flags.c_contiguous or not buf.flags.writeable:
+            return
+        with self._lock:
+            if (self.max_bytes is not None) and (self.nbytes + buf.nbytes > self.max_bytes):
+                return
+            self._free.setdefault(self._key(buf.shape, buf.dtype), []).append(buf)
+            self.nbytes += buf.nbytes
+            
+    def clear(self):
+        """Release all the buffers kept in the pool."""
+        with self._lock:
+            self._free = {}
+            self.nbytes = 0
+
+###############################################################################
+## CompressedBlockStore
+###############################################################################
+
+def _get_codec(codec, level):
+    """(name, compress, decompress) functions of a codec. 'auto' chooses the
+    fastest codec installed: blosc, lz4 or zlib."""
+    if codec == 'auto':
+        for name in ('blosc', 'lz4'):
+            try:
+                return _get_codec(name, level)
+            except ImportError:
+                pass
+        return _get_codec('zlib', level)
+    if codec == 'zlib':
+        import zlib
+        level = 1 if level is None else level
+        return 'zlib', lambda b: zlib.compress(b, level), zlib.decompress
+    elif codec == 'lz4':
+        import lz4.frame
+        level = 0 if level is None else level
+        return 'lz4', lambda b: lz4.frame.compress(b, compression_level=level), \
+            lz4.frame.decompress
+    elif codec == 'blosc':
+        import blosc
+        level = 5 if level is None else level
+        return 'blosc', lambda b: blosc.compress(b, clevel=level), blosc.decompress
+    else:
+        raise ValueError("codec must be 'auto', 'blosc', 'lz4' or 'zlib'")
+
+class CompressedBlockStore(object):
+    """Sequence of blocks kept compressed in memory.
+    
+    Blocks that have to be kept between processing stages (e.g. masks, label
+    maps or sparse predictions) often compress very well. This container 
+    compresses each block when it's stored, and decompresses it when it's 
+    accessed, so that many more blocks fit in memory
+    
+        block_slices, blocks, _ = block_split(x, nblocks, pad_width=8)
+        store = CompressedBlockStore(blocks)
+        del blocks
+        ...
+        y, _ = block_stack(store, block_slices, pad_width=8)
+    
+    The most recently accessed blocks are kept decompressed in a small LRU 
+    cache. Blocks returned by the store are read-only, because changes would
+    not be stored. To modify a block, assign the new block, store[i] = block.
+    
+    Args:
+        blocks: (def None) Iterable of blocks to store.
+        
+        codec: (def 'auto') Compression codec, 'blosc', 'lz4' or 'zlib'. By
+        default, the fastest codec installed (zlib is always available).
+        
+        level: (def None) Compression level. By default, a fast level of the
+        codec.
+        
+        cache_size: (def 2) Number of decompressed blocks kept in the cache.
+        
+    Attributes:
+        codec: Name of the codec.
+        
+        dtype: dtype of the blocks (None until a block is stored).
+        
+        nbytes: Compressed size of all blocks in bytes.
+        
+        raw_nbytes: Uncompressed size of all blocks in bytes.
+    """
+    
+    def __init__(self, blocks=None, codec='auto', level=None, cache_size=2):
+        self.codec, self._compress, self._decompress = _get_codec(codec, level)
+        self.cache_size = cache_size
+        self.dtype = None
+        self._data = []
+        self._shapes = []
+        self._dtypes = []
+        self._cache = collections.OrderedDict()
+        if blocks is not None:
+            self.extend(blocks)
+            
+    def _encode(self, block):
+        block = np.ascontiguousarray(block)
+        if self.dtype is None:
+            self.dtype = block.dtype
+        return self._compress(block.tobytes()), block.shape, block.dtype
+    
+    def append(self, block):
+        """Compress and append a block."""
+        data, shape, dtype = self._encode(block)
+        self._data.append(data)
+        self._shapes.append(shape)
+        self._dtypes.append(dtype)
+        
+    def extend(self, blocks):
+        for block in blocks:
+            self.append(block)
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def shape(self, i):
+        """Shape of block i, without decompressing it."""
+        return self._shapes[i]
+    
+    @property
+    def nbytes(self):
+        return sum(len(d) for d in self._data)
+    
+    @property
+    def raw_nbytes(self):
+        return sum(int(np.prod(s)) * t.itemsize for s, t in zip(self._shapes, self._dtypes))
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('block index out of range')
+        
+        # most recently used blocks are at the end of the cache
+        block = self._cache.pop(i, None)
+        if block is None:
+            block = np.frombuffer(self._decompress(self._data[i]), dtype=self._dtypes[i])
+            block = block.reshape(self._shapes[i])
+        if self.cache_size > 0:
+            self._cache[i] = block
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return block
+    
+    def __setitem__(self, i, block):
+        if i < 0:
+            i += len(self)
+        self._data[i], self._shapes[i], self._dtypes[i] = self._encode(block)
+        self._cache.pop(i, None)
+        
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+###############################################################################
+## block_split_dask, block_stack_dask, block_apply_dask
+###############################################################################
+
+def block_split_dask(x, nblocks, pad_width=0, mode='constant', **kwargs):
+    """Split an array into padded blocks as Dask arrays.
+    
+    Dask equivalent of block_split(). The blocks have exactly the same 
+    geometry and padding values, but they are lazy Dask arrays (one chunk 
+    each) that can be processed on a Dask cluster
+    
+        block_slices, blocks = block_split_dask(x, nblocks, pad_width=8, mode='reflect')
+        blocks = [b.map_blocks(func, dtype=b.dtype) for b in blocks]
+        y = block_stack_dask(blocks, block_slices, pad_width=8)
+        y.compute()
+    
+    Padding is computed with dask.array.pad(), which supports all the modes
+    of numpy.pad().
+    
+    Args:
+        x: nd-array (numpy), Dask array, or array-like with attributes shape, 
+        dtype and __getitem__ (e.g. HDF5/Zarr dataset).
+        
+        nblocks, pad_width, mode, ...: As in block_split(). nblocks='auto' is not
+        supported (use block_auto_nblocks()).
+        
+    Returns:
+        block_slices: List of tuples of slice objects (as in block_split()).
+        
+        blocks: List of Dask arrays, one per block, with 
+        blocks[i] = xout[block_slices[i]].
+    """
+    import dask.array as da
+    
+    ndims = len(x.shape)
+    if isinstance(nblocks, str):
+        raise ValueError("nblocks='auto' is not supported. Use block_auto_nblocks() to compute nblocks")
+    if np.isscalar(nblocks):
+        nblocks = [nblocks] * ndims
+    pad_width = _pad_width_tuple(pad_width, ndims)
+    
+    # chunk the array like the blocks (without padding), so that each block 
+    # depends on as few chunks as possible
+    idx_start, idx_end = _block_idx(x.shape, nblocks)
+    chunks = tuple(tuple(e - s + 1 for s, e in zip(starts, ends)) 
+                   for starts, ends in zip(idx_start, idx_end))
+    if isinstance(x, da.Array):
+        xd = x.rechunk(chunks)
+    else:
+        xd = da.from_array(x, chunks=chunks)
+        
+    # pad the whole array, with the same values as numpy.pad()
+    if np.max(pad_width) > 0:
+        xd = da.pad(xd, tuple((int(a), int(b)) for a, b in pad_width), mode=mode, **kwargs)
+    
+    # geometry of the blocks, computed exactly as in block_split(). We use a
+    # dummy array to avoid reading x
+    block_slices, _, _ = block_split(np.broadcast_to(np.zeros(1, dtype=np.uint8), x.shape), 
+                                     nblocks, pad_width=pad_width, lazy=True)
+    
+    # each block is a single chunk
+    blocks = [xd[sl].rechunk(-1) for sl in block_slices]
+    
+    return block_slices, blocks
+
+def block_stack_dask(blocks, block_slices, pad_width=0, shape=None, fill_value=0):
+    """Reassemble Dask blocks into a Dask array.
+    
+    Dask equivalent of block_stack(). The padding is removed from each block,
+    and the blocks are concatenated lazily.
+    
+    Args:
+        blocks: List of Dask arrays (e.g. from block_split_dask(), after 
+        processing). Each processed block must have the shape of the input 
+        block.
+        
+        block_slices: Block slices with padding, in list or array format.
+        
+        pad_width: (def 0) Padding used to split the blocks.
+        
+        shape: (def None) Shape of the original array, if there are missing 
+        blocks (see BlockIndex).
+        
+        fill_value: (def 0) Value of the regions without blocks.
+        
+    Returns:
+        y: Dask array.
+    """
+    import dask.array as da
+    
+    index = BlockIndex(block_slices, pad_width=pad_width, shape=shape)
+    ndims = index.geom.shape[1]
+    pad_width = _pad_width_tuple(pad_width, ndims)
+    dtype = blocks[0].dtype if len(blocks) > 0 else np.float64
+    
+    # block or filler array for each cell of the grid, as nested lists
+    def cell(grid_idx):
+        i = index.grid[grid_idx]
+        if i >= 0:
+            b = blocks[i]
+            return b[tuple(slice(p[0], b.shape[d] - p[1]) for d, p in enumerate(pad_width))]
+        cell_shape = tuple(int(e[j + 1] - e[j]) for e, j in zip(index.edges, grid_idx))
+        return da.full(cell_shape, fill_value, dtype=dtype)
+    
+    def nested(prefix):
+        d = len(prefix)
+        if d == ndims:
+            return cell(prefix)
+        return [nested(prefix + (j,)) for j in range(index.grid.shape[d])]
+    
+    y = da.block(nested(()))
+    
+    # add filler at the end of the array, if the blocks don't reach the edge
+    if y.shape != index.shape:
+        y = da.pad(y, [(0, n - m) for n, m in zip(index.shape, y.shape)], 
+                   mode='constant', constant_values=fill_value)
+    return y
+
+def block_apply_dask(x, func, nblocks, pad_width=0, mode='constant', dtype=None, 
+                     func_kwargs=None, **kwargs):
+    """Apply a function to each padded block of an array with Dask.
+    
+    Split x with the same geometry and padding as block_split(), apply func to
+    each padded block, remove the padding and reassemble the result. The 
+    result is a lazy Dask array, which can be computed with any Dask scheduler
+    (e.g. a distributed cluster)
+    
+        y = block_apply_dask(x, scipy.ndimage.gaussian_filter, nblocks=(4, 4),
+                             pad_width=8, mode='reflect', func_kwargs={'sigma': 2})
+        y = y.compute()
+    
+    Args:
+        x: Array, as in block_split_dask().
+        
+        func: Function that takes a padded block (np.ndarray) and returns an 
+        array of the same shape.
+        
+        nblocks, pad_width, mode: As in block_split().
+        
+        dtype: (def None) dtype of the output of func. By default, x.dtype.
+        
+        func_kwargs: (def None) Dictionary of keyword arguments for func.
+        
+        ...: Extra keyword arguments are passed to numpy.pad(), as in 
+        block_split().
+        
+    Returns:
+        y: Dask array with the shape of x.
+    """
+    if dtype is None:
+        dtype = x.dtype
+    block_slices, blocks = block_split_dask(x, nblocks, pad_width=pad_width, mode=mode, **kwargs)
+    if func_kwargs is None:
+        func_kwargs = {}
+    blocks = [b.map_blocks(func, dtype=dtype, **func_kwargs) for b in blocks]
+    return block_stack_dask(blocks, block_slices, pad_width=pad_width)
+
+###############################################################################
+## BlockExecutor, InProcessExecutor, ProcessQueueExecutor
+###############################################################################
+
+class BlockExecutor(object):
+    """Interface of the executors that run block tasks for block_apply().
+    
+    An executor runs tasks func(*args), where each task is identified by a 
+    key (in block_apply(), the block index). Tasks are submitted with 
+    submit(), and finished tasks are collected with fetch(), in the order 
+    they finish, which may be different from the order of submission
+    
+        with ProcessQueueExecutor(n_workers=4) as executor:
+            executor.submit(0, func, block0)
+            executor.submit(1, func, block1)
+            key, result, error, elapsed = executor.fetch()
+    
+    To run blocks on other machines, derive a class from BlockExecutor that 
+    sends the tasks to the cluster in submit() and receives the results in 
+    fetch(). Exceptions raised by func must be returned by fetch() rather
+    than raised, so that the caller can retry the task.
+    
+    Attributes:
+        max_pending: Maximum number of tasks that the caller should keep 
+        submitted and not fetched, to bound the memory used by the blocks in 
+        flight.
+    """
+    
+    max_pending = 1
+    
+    def submit(self, key, func, *args):
+        """Submit task func(*args), identified by key."""
+        raise NotImplementedError
+    
+    def fetch(self):
+        """Wait for a submitted task to finish.
+        
+        Returns:
+            key: Key of the task.
+            
+            result: Output of func(*args), or None if the task failed.
+            
+            error: None, or the exception raised by the task.
+            
+            elapsed: Time in seconds spent running the task.
+        """
+        raise NotImplementedError
+    
+    def close(self):
+        """Release the resources of the executor."""
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+def _run_task(func, args):
+    """Run func(*args). Returns (result, error, elapsed)."""
+    t0 = _clock()
+    try:
+        result, error = func(*args), None
+    except Exception as e:
+        result, error = None, e
+    return result, error, _clock() - t0
+
+class InProcessExecutor(BlockExecutor):
+    """Executor that runs the tasks in the calling process.
+    
+    Tasks are run one by one when they are fetched. This is the default 
+    executor of block_apply(), and is useful for debugging.
+    """
+    
+    max_pending = 1
+    
+    def __init__(self):
+        self._tasks = collections.deque()
+    
+    def submit(self, key, func, *args):
+        self._tasks.append((key, func, args))
+        
+    def fetch(self):
+        if len(self._tasks) == 0:
+            raise ValueError('No tasks submitted')
+        key, func, args = self._tasks.popleft()
+        result, error, elapsed = _run_task(func, args)
+        return key, result, error, elapsed
+
+def _queue_worker(worker_id, tasks, results):
+    """Loop of a ProcessQueueExecutor worker process."""
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        key, func, args = task
+        result, error, elapsed = _run_task(func, args)
+        
+        # the exception may not be picklable
+        if error is not None:
+            try:
+                pickle.dumps(error)
+            except Exception:
+                error = Exception(traceback.format_exception_only(type(error), error)[-1].strip())
+        results.put((worker_id, key, result, error, elapsed))
+
+class ProcessQueueExecutor(BlockExecutor):
+    """Executor that runs the tasks in local worker processes.
+    
+    Tasks and results are sent through multiprocessing queues, so this 
+    executor works like a small local cluster: func, the blocks and the 
+    results must be picklable (e.g. func must be defined at module level, or
+    be a functools.partial of such a function). Each worker has its own task
+    queue and runs one task at a time, so the executor knows which task each
+    worker is running. If a worker process dies, fetch() returns its task 
+    with an error, and a new worker is started.
+    
+    Args:
+        n_workers: (def None) Number of worker processes. By default, the 
+        number of CPUs.
+        
+        max_pending: (def 2*n_workers) Maximum number of tasks in flight.
+    """
+    
+    def __init__(self, n_workers=None, max_pending=None):
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        if n_workers < 1:
+            raise ValueError('n_workers must be >= 1')
+        if max_pending is None:
+            max_pending = 2 * n_workers
+        self.n_workers = n_workers
+        self.max_pending = max_pending
+        self._results = multiprocessing.Queue()
+        
+        # tasks waiting for a worker, and task run by each worker
+        self._waiting = collections.deque()
+        self._workers = [None] * n_workers
+        self._assigned = [None] * n_workers
+        for worker_id in range(n_workers):
+            self._start_worker(worker_id)
+            
+    def _start_worker(self, worker_id):
+        tasks = multiprocessing.Queue()
+        w = multiprocessing.Process(target=_queue_worker, args=(worker_id, tasks, self._results),
+                                    name='pysto-block-worker')
+        w.daemon = True
+        w.start()
+        self._workers[worker_id] = (w, tasks)
+        
+    def _dispatch(self):
+        # send waiting tasks to idle workers
+        for worker_id in range(self.n_workers):
+            if len(self._waiting) == 0:
+                return
+            if self._assigned[worker_id] is None:
+                task = self._waiting.popleft()
+                self._assigned[worker_id] = task
+                self._workers[worker_id][1].put(task)
+        
+    def submit(self, key, func, *args):
+        self._waiting.append((key, func, args))
+        self._dispatch()
+        
+    def fetch(self):
+        if (len(self._waiting) == 0) and all(t is None for t in self._assigned):
+            raise ValueError('No tasks submitted')
+        while True:
+            try:
+                worker_id, key, result, error, elapsed = self._results.get(timeout=0.5)
+            except queue.Empty:
+                # a worker that has died fails its task, and is replaced
+                for worker_id, (w, tasks) in enumerate(self._workers):
+                    if w.exitcode is not None:
+                        task = self._assigned[worker_id]
+                        self._assigned[worker_id] = None
+                        self._start_worker(worker_id)
+                        self._dispatch()
+                        if task is not None:
+                            error = Exception('Worker process exited with code ' + str(w.exitcode))
+                            return task[0], None, error, 0.0
+                continue
+            self._assigned[worker_id] = None
+            self._dispatch()
+            return key, result, error, elapsed
+            
+    def close(self):
+        for w, tasks in self._workers:
+            tasks.put(None)
+        for w, tasks in self._workers:
+            w.join(timeout=5)
+            if w.is_alive():
+                w.terminate()
+            tasks.close()
+        self._workers = []
+        self._results.close()
+
+###############################################################################
+## block_apply
+###############################################################################
+
+@cached('block_apply', ignore=('executor', 'retries'), skip_if_set=('out',))
+@instrumented('block_apply')
+def block_apply(x, func, nblocks, pad_width=0, mode='constant', executor=None, 
+                retries=2, dtype=None, out=None, **kwargs):
+    """Apply a function to each padded block of an array with an executor.
+    
+    The array is split with the same geometry and padding as block_split(),
+    func is applied to each padded block by the executor, and the results
+    (without padding) are written to the output array as they arrive
+    
+        with ProcessQueueExecutor(n_workers=4) as executor:
+            y = block_apply(x, func, nblocks=(4, 4), pad_width=8, 
+                            mode='reflect', executor=executor)
+    
+    Blocks are read when they are submitted (lazily if x is an array-like, 
+    see block_split(..., lazy=True)), and at most executor.max_pending 
+    blocks are in flight at any time. A block whose task fails is submitted
+    again, up to 'retries' times.
+    
+    The time spent by each block is recorded by pysto.instrument (info 
+    'block_times' and 'attempts' of the 'block_apply' call).
+    
+    Args:
+        x: nd-array (numpy), or array-like (see block_split()).
+        
+        func: Function that takes a padded block and returns an array of the
+        same shape.
+        
+        nblocks, pad_width, mode: As in block_split().
+        
+        executor: (def None) BlockExecutor. By default, InProcessExecutor().
+        
+        retries: (def 2) Number of times a failed block is submitted again.
+        
+        dtype: (def None) dtype of the output array. By default, the dtype of
+        the first result.
+        
+        out: (def None) Output array (or array-like) with the shape of x. 
+        
+        ...: Extra keyword arguments are passed to numpy.pad(), as in 
+        block_split().
+        
+    Returns:
+        y: Array with the shape of x (out, if provided).
+    """
+    
+    # lazy split, so that blocks are only read when submitted
+    block_slices, blocks, _ = block_split(x, nblocks, pad_width=pad_width, mode=mode, 
+                                          lazy=True, **kwargs)
+    nb = len(block_slices)
+    ndims = len(x.shape)
+    pad_width = _pad_width_tuple(pad_width, ndims)
+    
+    # block limits without padding
+    geom = block_slices_to_array(block_slices)
+    geom[:, :, 1] -= np.array([p[0] + p[1] for p in pad_width], dtype=np.intp)
+    
+    prof = current()
+    own_executor = executor is None
+    if own_executor:
+        executor = InProcessExecutor()
+    
+    block_times = np.zeros(nb)
+    attempts = np.zeros(nb, dtype=np.intp)
+    
+    def submit(i):
+        with prof.stage('read'):
+            block = blocks[i]
+        executor.submit(i, func, block)
+        attempts[i] += 1
+    
+    try:
+        next_i = 0
+        in_flight = 0
+        ndone = 0
+        while ndone < nb:
+            
+            # keep the executor busy, without too many blocks in memory
+            while (next_i < nb) and (in_flight < max(executor.max_pending, 1)):
+                submit(next_i)
+                next_i += 1
+                in_flight += 1
+                
+            with prof.stage('wait'):
+                i, result, error, elapsed = executor.fetch()
+            in_flight -= 1
+            block_times[i] += elapsed
+            
+            # retry failed blocks
+            if error is not None:
+                if attempts[i] > retries:
+                    raise Exception('Block ' + str(i) + ' failed after ' + str(attempts[i]) 
+                                    + ' attempts: ' + repr(error))
+                submit(i)
+                in_flight += 1
+                continue
+                
+            # write the result without padding
+            result = np.asarray(result)
+            if result.shape != blocks.shape(i):
+                raise ValueError('func must return an array with the shape of the block')
+            if out is None:
+                out = np.empty(x.shape, dtype=result.dtype if dtype is None else dtype)
+            with prof.stage('write') as st:
+                out[tuple(slice(a, b) for a, b in geom[i])] = \
+                    result[tuple(slice(p[0], result.shape[d] - p[1]) for d, p in enumerate(pad_width))]
+                st.add_bytes(result.nbytes)
+            ndone += 1
+    finally:
+        if own_executor:
+            executor.close()
+            
+    prof.set_info(nblocks=nb, block_times=block_times, attempts=attempts)
+    return out
@@ -0,0 +1,499 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/pysto/cache.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+###############################################################################
+## Summary of functions in this module:
+##
+##   ResultCache:
+##      Directory of results stored as .npy files, keyed by a content hash of
+##      the inputs and parameters of a call, with a size cap and LRU eviction.
+##
+##   enable, disable, enabled, caching:
+##      Switch on/off the process-wide result cache used by pysto functions.
+##
+##   cached:
+##      Decorator used on pysto functions to cache their results.
+##
+## Caching is opt-in. It's enabled for the whole process with enable(), within
+## a caching() context, or by setting the environment variable 
+## PYSTO_CACHE_DIR to the cache directory (and optionally PYSTO_CACHE_MAX_GB 
+## to its maximum size). When disabled, cached functions are called directly,
+## so the overhead is a flag check per call.
+##
+## When enabled, the arguments of each call to a cached function (arrays, 
+## SimpleITK images, HistogramAccumulators, files given by path, scalars, 
+## ...) are hashed together with the name of the function. If a result with
+## that key is in the cache, it's loaded memory-mapped (read-only, without 
+## copying it to memory) instead of calling the function. Otherwise, the 
+## function is called and its result saved. Calls with arguments that cannot
+## be hashed (e.g. lambda functions) are not cached.
+##
+## Example:
+##
+##     import pysto.cache as pcache
+##     with pcache.caching('/tmp/pysto_cache', max_bytes=10*2**30):
+##         imout = matchHist(imref, im)   # computed and saved
+##         imout = matchHist(imref, im)   # loaded from the cache
+##
+###############################################################################
+
+import os
+import threading
+import contextlib
+import functools
+import hashlib
+import inspect
+import numpy as np
+
+# xxhash is optional. It hashes large arrays several times faster than 
+# hashlib.blake2b
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# version of the format of the keys and files. Changing it invalidates the 
+# results saved by previous versions
+_CACHE_VERSION = 1
+
+# number of bytes of an array hashed at a time, so that non-contiguous arrays
+# and memmaps are hashed without copying them completely to memory
+_HASH_CHUNK = 1 << 24
+
+###############################################################################
+## Hashing of the arguments
+###############################################################################
+
+class _Uncacheable(Exception):
+    """Raised when an argument of a call cannot be hashed."""
+    pass
+
+def _new_hasher():
+    """128-bit hash object, xxh3 if available, blake2b otherwise."""
+    if xxhash is not None:
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size=16)
+
+def _update_array(h, x):
+    """Add the dtype, shape and contents of an array to hash h."""
+    if x.dtype.hasobject:
+        raise _Uncacheable('arrays of objects cannot be hashed')
+    h.update(('ndarray' + x.dtype.str + repr(x.shape)).encode())
+    if x.ndim == 0 or x.size == 0:
+        h.update(x.tobytes())
+        return
+    
+    # hash the array by chunks of rows (no copy for C-contiguous chunks)
+    row_nbytes = max(1, x[0].nbytes)
+    nrows = max(1, _HASH_CHUNK // row_nbytes)
+    for i in range(0, x.shape[0], nrows):
+        chunk = np.ascontiguousarray(x[i:i+nrows])
+        h.update(chunk.reshape(-1).view(np.uint8))
+
+def _update(h, value, is_file=False):
+    """Add an argument value to hash h. Raises _Uncacheable if it can't be 
+    hashed."""
+    
+    # path of a file, hashed by name, size and modification time
+    if is_file and isinstance(value, str):
+        try:
+            st = os.stat(value)
+        except OSError:
+            raise _Uncacheable('cannot access file ' + value)
+        h.update(('file' + repr((os.path.abspath(value), st.st_size, st.st_mtime_ns))).encode())
+    elif value is None or isinstance(value, (bool, int, float, complex, str)):
+        h.update((type(value).__name__ + repr(value)).encode())
+    elif isinstance(value, bytes):
+        h.update(b'bytes' + repr(len(value)).encode())
+        h.update(value)
+    elif isinstance(value, np.generic):
+        _update_array(h, np.asarray(value))
+    elif isinstance(value, np.ndarray):
+        _update_array(h, value)
+    elif isinstance(value, (tuple, list)):
+        h.update((type(value).__name__ + repr(len(value))).encode())
+        for v in value:
+            _update(h, v)
+    elif isinstance(value, dict):
+        h.update(('dict' + repr(len(value))).encode())
+        for k in sorted(value):
+            _update(h, k)
+            _update(h, value[k])
+    elif isinstance(value, np.dtype):
+        h.update(('dtype' + value.str).encode())
+    elif type(value).__module__.startswith('SimpleITK'):
+        import SimpleITK as sitk
+        if not isinstance(value, sitk.Image):
+            raise _Uncacheable('cannot hash SimpleITK object of type ' + str(type(value)))
+        h.update(('sitk.Image' + repr((value.GetOrigin(), value.GetSpacing(), 
+                                       value.GetDirection(), 
+                                       value.GetNumberOfComponentsPerPixel()))).encode())
+        _update_array(h, sitk.GetArrayViewFromImage(value))
+    elif hasattr(value, 'to_bytes') and hasattr(type(value), 'from_bytes'):
+        # serializable pysto objects, e.g. HistogramAccumulator
+        h.update(type(value).__name__.encode())
+        _update(h, value.to_bytes())
+    elif isinstance(value, functools.partial):
+        h.update(b'partial')
+        _update(h, value.func)
+        _update(h, value.args)
+        _update(h, value.keywords)
+    elif callable(value):
+        # functions are hashed by name. Functions defined inside other 
+        # functions (including lambdas) can't be told apart by name, and 
+        # bound methods depend on the state of their object
+        if inspect.ismethod(value):
+            raise _Uncacheable('cannot hash bound method ' + repr(value))
+        module = 'numpy' if isinstance(value, np.ufunc) else getattr(value, '__module__', None)
+        qualname = getattr(value, '__qualname__', getattr(value, '__name__', None))
+        name = str(module) + '.' + str(qualname)
+        if '<' in name or module is None or qualname is None:
+            raise _Uncacheable('cannot hash function ' + repr(value))
+        h.update(('function' + name).encode())
+    else:
+        raise _Uncacheable('cannot hash object of type ' + str(type(value)))
+
+###############################################################################
+## ResultCache
+###############################################################################
+
+class ResultCache(object):
+    """Directory of results stored as .npy files, with a size cap.
+    
+        cache = ResultCache(path, max_bytes=2**30)
+        cache.put(key, result)
+        result = cache.get(key)
+    
+    Results are numpy arrays, numpy/Python scalars or lists of scalars, 
+    saved to <path>/<key>-<kind>.npy. Arrays are loaded memory-mapped and 
+    read-only. Each file is written to a temporary file first and then 
+    renamed, so several processes can share the cache directory.
+    
+    When the total size of the results goes over max_bytes, the least 
+    recently used results are deleted. The modification time of a file is 
+    updated each time it's read, so it's the time of its last use.
+    
+    Args:
+        path: Directory of the cache. It's created if it doesn't exist.
+        
+        max_bytes: (def 1 GB) Maximum total size of the cached files. None 
+        means no limit.
+        
+    Attributes:
+        nhits, nmisses: Number of get() calls that found/didn't find the 
+        result.
+    """
+    
+    # kinds of results, and the suffix of their file names
+    _KINDS = ('array', 'scalar', 'list')
+    
+    def __init__(self, path, max_bytes=2**30):
+        if max_bytes is not None and max_bytes < 0:
+            raise ValueError('max_bytes must be >= 0')
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.nhits = 0
+        self.nmisses = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+    
+    def key(self, name, *values):
+        """Content hash of a function name and argument values.
+        
+        Args:
+            name: Name of the function.
+            
+            values: Argument values. Paths wrapped in _FileArg are hashed by
+            the file they point to.
+            
+        Returns:
+            Hexadecimal string, or None if any value cannot be hashed.
+        """
+        h = _new_hasher()
+        h.update(('pysto-cache' + repr(_CACHE_VERSION) + name).encode())
+        try:
+            for v in values:
+                if isinstance(v, _FileArg):
+                    _update(h, v.value, is_file=True)
+                else:
+                    _update(h, v)
+        except _Uncacheable:
+            return None
+        return h.hexdigest()
+    
+    def _file(self, key, kind):
+        return os.path.join(self.path, key + '-' + kind + '.npy')
+    
+    def get(self, key):
+        """Result saved with key.
+        
+        Returns:
+            found: True if the result is in the cache.
+            
+            result: The result, or None if not found. Arrays are read-only
+            np.memmaps.
+        """
+        for kind in self._KINDS:
+            filename = self._file(key, kind)
+            try:
+                if kind == 'array':
+                    x = np.load(filename, mmap_mode='r', allow_pickle=False)
+                else:
+                    x = np.load(filename, allow_pickle=False)
+            except (IOError, OSError, ValueError):
+                # the file doesn't exist, was evicted by another process, or
+                # was left incomplete
+                continue
+            
+            # mark the result as recently used
+            try:
+                os.utime(filename, None)
+            except OSError:
+                pass
+            self.nhits += 1
+            if kind == 'scalar':
+                return True, x[()]
+            elif kind == 'list':
+                return True, [v for v in x]
+            return True, x
+        self.nmisses += 1
+        return False, None
+    
+    def put(self, key, result):
+        """Save a result with key. Results of other types, or bigger than
+        max_bytes, are not saved.
+        
+        Returns:
+            True if the result was saved.
+        """
+        if isinstance(result, np.ndarray):
+            kind = 'array'
+        elif isinstance(result, (np.generic, bool, int, float, complex)):
+            kind = 'scalar'
+        elif isinstance(result, list) and all(isinstance(v, (np.generic, int, float)) for v in result):
+            kind = 'list'
+        else:
+            return False
+        x = np.asarray(result)
+        if x.dtype.hasobject:
+            return False
+        if self.max_bytes is not None and x.nbytes > self.max_bytes:
+            return False
+        
+        # write to a temporary file and rename it, so that readers never see
+        # incomplete files
+        filename = self._file(key, kind)
+        tmp = os.path.join(self.path, '.tmp-%d-%d-%s.npy' % (os.getpid(), threading.get_ident(), key))
+        try:
+            np.save(tmp, x, allow_pickle=False)
+            os.replace(tmp, filename)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict(keep=filename)
+        return True
+    
+    def _files(self):
+        """(mtime, size, path) of the cached files."""
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npy') and not entry.name.startswith('.tmp-'):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime_ns, st.st_size, entry.path))
+        return files
+    
+    @property
+    def nbytes(self):
+        """Total size of the cached files."""
+        return sum(f[1] for f in self._files())
+    
+    def __len__(self):
+        return len(self._files())
+    
+    def evict(self, keep=None):
+        """Delete the least recently used files until the total size is at 
+        most max_bytes. File keep (e.g. the one just saved) is deleted last."""
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            files = self._files()
+            total = sum(f[1] for f in files)
+            if total <= self.max_bytes:
+                return
+            files.sort(key=lambda f: (f[2] == keep, f[0]))
+            for mtime, size, filename in files:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+                total -= size
+    
+    def clear(self):
+        """Delete all the cached files."""
+        for mtime, size, filename in self._files():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+class _FileArg(object):
+    """Argument value that is the path of a file, hashed by the file name, 
+    size and modification time instead of by the string."""
+    def __init__(self, value):
+        self.value = value
+
+###############################################################################
+## enable / disable / caching
+###############################################################################
+
+# process-wide cache used by cached functions, or None if caching is disabled
+_cache = None
+
+def enable(path, max_bytes=2**30):
+    """Enable the process-wide result cache.
+    
+    Args:
+        path: Directory of the cache.
+        
+        max_bytes: (def 1 GB) Maximum total size of the cached files. None 
+        means no limit.
+        
+    Returns:
+        The ResultCache.
+    """
+    global _cache
+    _cache = ResultCache(path, max_bytes=max_bytes)
+    return _cache
+
+def disable():
+    """Disable the process-wide result cache. The cached files are kept."""
+    global _cache
+    _cache = None
+
+def enabled():
+    """True if the result cache is enabled."""
+    return _cache is not None
+
+@contextlib.contextmanager
+def caching(path, max_bytes=2**30):
+    """Enable the result cache within a context.
+    
+        with caching(path, max_bytes=2**30) as cache:
+            ...
+    
+    The cache that was active before the context (if any) is restored at 
+    the end.
+    
+    Returns:
+        cache: The ResultCache.
+    """
+    global _cache
+    previous = _cache
+    cache = enable(path, max_bytes=max_bytes)
+    try:
+        yield cache
+    finally:
+        _cache = previous
+
+###############################################################################
+## cached
+###############################################################################
+
+def cached(name, ignore=(), file_args=(), skip_if_set=()):
+    """Decorator that caches the results of a pysto function.
+    
+        @cached('TypicalBorderIntensity', file_args=('im',))
+        @instrumented('TypicalBorderIntensity')
+        def TypicalBorderIntensity(im, mode='median'):
+            ...
+    
+    The key of a call is the hash of the name and of all the argument values
+    (after applying the defaults), so positional and keyword arguments give 
+    the same key.
+    
+    Args:
+        name: Name of the function in the keys.
+        
+        ignore: (def ()) Names of arguments that don't change the result 
+        (e.g. the executor), and are not hashed.
+        
+        file_args: (def ()) Names of arguments that can be paths of files. 
+        When they are strings, the file is hashed by name, size and 
+        modification time.
+        
+        skip_if_set: (def ()) Names of arguments that disable caching when 
+        they are not None (e.g. out, as the function has side effects).
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = _cache
+            if cache is None:
+                return func(*args, **kwargs)
+            
+            # argument values, in the order of the signature
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            if any(bound.arguments.get(a) is not None for a in skip_if_set):
+                return func(*args, **kwargs)
+            values = []
+            for arg, value in bound.arguments.items():
+                if arg in ignore:
+                    continue
+                values.append(arg)
+                values.append(_FileArg(value) if arg in file_args else value)
+            
+            # load the result, or compute and save it
+            key = cache.key(name, *values)
+            if key is None:
+                return func(*args, **kwargs)
+            found, result = cache.get(key)
+            if found:
+                return result
+            result = func(*args, **kwargs)
+            cache.put(key, result)
+            return result
+        return wrapper
+    return decorator
+
+# process-wide cache enabled by environment variables
+if os.environ.get('PYSTO_CACHE_DIR', ''):
+    enable(os.environ['PYSTO_CACHE_DIR'], 
+           max_bytes=int(float(os.environ.get('PYSTO_CACHE_MAX_GB', '1')) * 2**30))
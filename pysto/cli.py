@@ -0,0 +1,355 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/pysto/cli.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+###############################################################################
+## Summary of functions in this module:
+##
+##   main:
+##      Entry point of the pysto-batch command, that applies pysto functions to
+##      directories of images in parallel:
+##
+##          pysto-batch matchhist --ref ref.png in/ out/
+##          pysto-batch imfuse in_a/ in_b/ out/
+##
+##      Images are read in a background thread while the previous ones are
+##      processed on a pool of worker processes, and the throughput is
+##      reported at the end.
+##
+##   fit_reference:
+##      Histograms of the reference images of matchhist, computed once.
+##
+##   run_batch:
+##      Apply a task to lists of image files on a pool of processes, with
+##      threaded prefetching of the reads.
+##
+###############################################################################
+
+import os
+import sys
+import argparse
+import multiprocessing
+import numpy as np
+from pysto.imgproc import matchHist, imfuse, HistogramAccumulator
+from pysto.blockproc import block_prefetch, InProcessExecutor, ProcessQueueExecutor
+from pysto.instrument import _clock
+
+# extensions of the image files processed in the input directories
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+
+###############################################################################
+## image input/output
+###############################################################################
+
+def _imread(path):
+    """Read an image file with OpenCV, with colour channels in RGB(A) order.
+    Raises IOError if the file cannot be read."""
+    import cv2
+    im = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if im is None:
+        raise IOError('Cannot read image ' + path)
+    if im.ndim == 3 and im.shape[2] == 3:
+        im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+    elif im.ndim == 3 and im.shape[2] == 4:
+        im = cv2.cvtColor(im, cv2.COLOR_BGRA2RGBA)
+    return im
+
+def _imwrite(path, im):
+    """Write an RGB(A) or grayscale image with OpenCV. Raises IOError if the 
+    file cannot be written."""
+    import cv2
+    if im.ndim == 3 and im.shape[2] == 3:
+        im = cv2.cvtColor(im, cv2.COLOR_RGB2BGR)
+    elif im.ndim == 3 and im.shape[2] == 4:
+        im = cv2.cvtColor(im, cv2.COLOR_RGBA2BGRA)
+    if not cv2.imwrite(path, im):
+        raise IOError('Cannot write image ' + path)
+
+def _list_images(path):
+    """Sorted names of the image files in a directory."""
+    return sorted(f for f in os.listdir(path)
+                  if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS
+                  and os.path.isfile(os.path.join(path, f)))
+
+###############################################################################
+## tasks run by the worker processes
+###############################################################################
+
+# accumulators deserialized by each worker, so that the reference is only 
+# decoded once per process rather than once per image
+_worker_refs = {}
+
+def _matchhist_task(im, out_path, ref_bytes, nbr_bins, precision):
+    """Match the histogram of im to the serialized reference, and write the
+    result to out_path."""
+    ref = _worker_refs.get(ref_bytes)
+    if ref is None:
+        ref = HistogramAccumulator.from_bytes(ref_bytes)
+        _worker_refs.clear()
+        _worker_refs[ref_bytes] = ref
+    channel_axis = None if im.ndim == 2 else -1
+    imout = matchHist(ref, im, nbr_bins=nbr_bins, channel_axis=channel_axis, 
+                      precision=precision)
+    _imwrite(out_path, imout)
+    return imout.nbytes
+
+def _imfuse_task(a, b, out_path):
+    """Fuse images a and b, and write the result to out_path."""
+    imout = imfuse(a, b)
+    _imwrite(out_path, imout)
+    return imout.nbytes
+
+###############################################################################
+## batch processing
+###############################################################################
+
+def fit_reference(paths, nbr_bins=256):
+    """Histograms of one or more reference images, for matchHist().
+    
+    The reference images are read once, and their histograms accumulated 
+    with the same bins, spanning the intensity range of all of them.
+    
+    Args:
+        paths: List of paths to the reference images. They must all be 
+        grayscale, or all have the same number of channels.
+        
+        nbr_bins: (def 256) Number of bins of the histograms.
+        
+    Returns:
+        HistogramAccumulator with the histograms of the reference images.
+    """
+    
+    ims = [_imread(p) for p in paths]
+    if len(set((im.shape[2] if im.ndim == 3 else 0) for im in ims)) > 1:
+        raise ValueError('All reference images must have the same number of channels')
+    channel_axis = None if ims[0].ndim == 2 else -1
+    
+    # intensity range of each channel, over all the reference images
+    if channel_axis is None:
+        lo = min(float(im.min()) for im in ims)
+        hi = max(float(im.max()) for im in ims)
+        value_range = (lo, hi if hi > lo else lo + 1)
+    else:
+        lo = np.min([im.reshape(-1, im.shape[-1]).min(axis=0) for im in ims], axis=0)
+        hi = np.max([im.reshape(-1, im.shape[-1]).max(axis=0) for im in ims], axis=0)
+        value_range = [(float(l), float(h) if h > l else float(l) + 1) 
+                       for l, h in zip(lo, hi)]
+    
+    # accumulate the histograms of all the reference images
+    acc = HistogramAccumulator(value_range, nbr_bins=nbr_bins, channel_axis=channel_axis)
+    for im in ims:
+        acc.update(im)
+    return acc
+
+def _read_inputs(paths):
+    """Generator of the images in each tuple of paths. A file that cannot be
+    read yields the exception instead, so that the batch can continue."""
+    for p in paths:
+        try:
+            yield tuple(_imread(x) for x in p)
+        except Exception as e:
+            yield e
+
+def run_batch(func, in_paths, out_paths, args=(), jobs=None, prefetch=4):
+    """Apply a task to batches of input images on a pool of processes.
+    
+    The input images are read by a background thread (block_prefetch()) in
+    the calling process, while the previous images are processed by the 
+    workers, so that reading overlaps with computation. Each task is 
+    
+        func(*images, out_path, *args)
+    
+    and returns the number of bytes of the output image.
+    
+    Args:
+        func: Picklable function (defined at module level).
+        
+        in_paths: List of tuples, with the paths of the input images of 
+        each task.
+        
+        out_paths: List of output paths, one per task.
+        
+        args: (def ()) Extra arguments of func, the same for all tasks.
+        
+        jobs: (def None) Number of worker processes. By default, the number 
+        of CPUs. With jobs=1, tasks run in the calling process.
+        
+        prefetch: (def 4) Maximum number of tasks read in advance.
+        
+    Returns:
+        stats: dict with the number of files processed ('nfiles'), bytes 
+        read ('nbytes_in') and written ('nbytes_out'), wall time ('time') 
+        and the list of (path, error message) of the failed tasks 
+        ('errors').
+    """
+    
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs < 1:
+        raise ValueError('jobs must be >= 1')
+    if jobs == 1:
+        executor = InProcessExecutor()
+    else:
+        executor = ProcessQueueExecutor(n_workers=jobs)
+    
+    stats = {'nfiles': 0, 'nbytes_in': 0, 'nbytes_out': 0, 'errors': []}
+    
+    def collect():
+        # wait for a task to finish, and add it to the statistics
+        key, result, error, elapsed = executor.fetch()
+        if error is None:
+            stats['nfiles'] += 1
+            stats['nbytes_out'] += result
+        else:
+            stats['errors'].append((in_paths[key][0], str(error)))
+    
+    t0 = _clock()
+    with executor:
+        
+        # submit the images as they are read, keeping a bounded number of 
+        # tasks in flight
+        npending = 0
+        images = block_prefetch(_read_inputs(in_paths), depth=prefetch)
+        for key, ims in enumerate(images):
+            if isinstance(ims, Exception):
+                stats['errors'].append((in_paths[key][0], str(ims)))
+                continue
+            while npending >= executor.max_pending:
+                collect()
+                npending -= 1
+            stats['nbytes_in'] += sum(im.nbytes for im in ims)
+            executor.submit(key, func, *(ims + (out_paths[key],) + tuple(args)))
+            npending += 1
+        
+        # wait for the remaining tasks
+        while npending > 0:
+            collect()
+            npending -= 1
+            
+    stats['time'] = _clock() - t0
+    return stats
+
+def _report(command, stats, jobs, stream=sys.stdout):
+    """Print the throughput of a batch, and its errors."""
+    t = max(stats['time'], 1e-9)
+    mb = stats['nbytes_in'] / 1e6
+    stream.write('%s: %d files (%.1f MB) in %.2f s, %.1f files/s, %.1f MB/s, %d workers\n'
+                 % (command, stats['nfiles'], mb, t, stats['nfiles'] / t, mb / t, jobs))
+    for path, error in stats['errors']:
+        stream.write('%s: error: %s: %s\n' % (command, path, error))
+
+###############################################################################
+## main
+###############################################################################
+
+def _parser():
+    """Command line parser of pysto-batch."""
+    parser = argparse.ArgumentParser(
+        prog='pysto-batch', 
+        description='Apply pysto functions to directories of images in parallel.')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    # options common to all commands
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    common.add_argument('--prefetch', type=int, default=4,
+                        help='number of images read in advance (default: 4)')
+    common.add_argument('-q', '--quiet', action='store_true',
+                        help='do not report the throughput')
+    
+    p = subparsers.add_parser('matchhist', parents=[common],
+                              help='match the histograms of the images to a reference')
+    p.add_argument('--ref', required=True, action='append',
+                   help='reference image, whose histogram is computed once. It can be '
+                   'repeated to accumulate the histograms of several images')
+    p.add_argument('--bins', type=int, default=256,
+                   help='number of histogram bins (default: 256)')
+    p.add_argument('--precision', choices=('float64', 'float32'), default='float64',
+                   help='precision of the intensity mapping (default: float64)')
+    p.add_argument('in_dir', help='directory with the input images')
+    p.add_argument('out_dir', help='output directory')
+    
+    p = subparsers.add_parser('imfuse', parents=[common],
+                              help='fuse the images with the same name in two directories')
+    p.add_argument('in_dir_a', help='directory with the first images')
+    p.add_argument('in_dir_b', help='directory with the second images')
+    p.add_argument('out_dir', help='output directory')
+    return parser
+
+def main(argv=None):
+    """Entry point of the pysto-batch command.
+    
+    Args:
+        argv: (def None) List of command line arguments. By default, 
+        sys.argv[1:].
+        
+    Returns:
+        Exit status: 0 if all images were processed, 1 if any failed, 2 for
+        usage errors.
+    """
+    
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_usage(sys.stderr)
+        return 2
+    jobs = args.jobs if args.jobs is not None else multiprocessing.cpu_count()
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    
+    if args.command == 'matchhist':
+        
+        # fit the reference once, and send it serialized to the workers
+        ref = fit_reference(args.ref, nbr_bins=args.bins)
+        names = _list_images(args.in_dir)
+        in_paths = [(os.path.join(args.in_dir, f),) for f in names]
+        out_paths = [os.path.join(args.out_dir, f) for f in names]
+        stats = run_batch(_matchhist_task, in_paths, out_paths, 
+                          args=(ref.to_bytes(), args.bins, args.precision),
+                          jobs=jobs, prefetch=args.prefetch)
+        
+    elif args.command == 'imfuse':
+        
+        # pairs of images with the same name in both directories
+        names_b = set(_list_images(args.in_dir_b))
+        names = [f for f in _list_images(args.in_dir_a) if f in names_b]
+        in_paths = [(os.path.join(args.in_dir_a, f), os.path.join(args.in_dir_b, f)) 
+                    for f in names]
+        out_paths = [os.path.join(args.out_dir, f) for f in names]
+        stats = run_batch(_imfuse_task, in_paths, out_paths, 
+                          jobs=jobs, prefetch=args.prefetch)
+    
+    if not args.quiet:
+        _report(args.command, stats, jobs)
+    return 1 if stats['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
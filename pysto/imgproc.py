@@ -35,23 +35,426 @@ along with this program.  If not, see
 ##   block_split:
 ##      Split an nd-array into blocks with or without overlapping between the blocks.
 ##
+##   block_slices_to_array, block_slices_from_array:
+##      Convert block slices to/from a compact (nblocks, ndim, 2) array.
+##
+##   block_auto_nblocks:
+##      Number of blocks for block_split() so that blocks fit a memory budget.
+##
+##   LazyBlocks:
+##      Sequence of blocks that are read from an array-like (e.g. HDF5/Zarr
+##      dataset or memmap) only when accessed.
+##
+##   block_stack:
+##      Reassemble blocks into an nd-array.
+##
+##   BlockIndex:
+##      Spatial index over the blocks, to find the blocks in a region of 
+##      interest.
+##
+##   block_stack_roi:
+##      Reassemble only a region of interest from the blocks that intersect it.
+##
 ##   imfuse: 
 ##      Composite of two images.
 ##
+##   HistogramAccumulator:
+##      Histograms with fixed bins accumulated chunk by chunk, that can be 
+##      merged, and used as reference by matchHist().
+##
 ##   matchHist: 
 ##      Modify image intensities to match the histogram of a reference image.
 ##
+##   matchHistLocal:
+##      Match the histogram of each tile of an image, blending the mappings
+##      of neighbouring tiles (CLAHE-style).
+##
+## Some functions have an accelerated backend with compiled kernels (see 
+## pysto/_kernels.py), selected with argument backend='numpy' (default), 
+## 'numba' or 'auto'. 'auto' uses numba if it's installed, and falls back to
+## the pure-NumPy implementation otherwise.
+##
 ###############################################################################
 
 import numpy as np
-import cv2
 import itertools
+from pysto.instrument import instrumented, current
+from pysto.cache import cached
+
+# Note: cv2 is imported inside the functions that need it, so that importing
+# this module (e.g. to use only block_split) does not pay for loading OpenCV
+
+###############################################################################
+## Backend selection
+###############################################################################
+
+def _get_kernels(backend):
+    """Module with the compiled kernels for the chosen backend, or None for
+    the pure-NumPy implementation."""
+    if backend == 'numpy':
+        return None
+    if backend not in ('auto', 'numba'):
+        raise ValueError("backend must be 'auto', 'numba' or 'numpy'")
+    try:
+        from pysto import _kernels
+    except ImportError:
+        if backend == 'numba':
+            raise
+        return None
+    return _kernels
+
+###############################################################################
+## Auxiliary functions for block processing
+###############################################################################
+
+def _pad_width_tuple(pad_width, ndims):
+    """Convert pad_width given as a scalar or a (pad_before,pad_after) tuple
+    to a ((pad_before,pad_after), (pad_before,pad_after),...) tuple."""
+    
+    # if pad_width given as a scalar, convert to (pad_before,pad_after) tuple
+    if (np.isscalar(pad_width)):
+        pad_width = (pad_width, pad_width)
+        
+    # if pad_width given as a (pad_before,pad_after) tuple, convert to
+    # ((pad_before,pad_after), (pad_before,pad_after),...) tuple
+    if (isinstance(pad_width, tuple) and not(isinstance(pad_width[0], tuple))):
+        pad_width = (pad_width,) * ndims
+        
+    return pad_width
+
+def _block_idx(shape, nblocks, chunks=None):
+    """Start and end indices of the blocks along each dimension.
+    
+    Returns two lists, idx_start[d] and idx_end[d], with the first and last 
+    (inclusive) index of each block along dimension d, as decided by 
+    numpy.array_split(). If chunks is given (chunk size along each 
+    dimension), whole chunks are distributed between the blocks instead, so
+    that block boundaries are aligned with chunk boundaries.
+    """
+    idx_start = []
+    idx_end = []
+    for d in range(len(shape)):
+        if chunks is None:
+            idx = np.array_split(range(shape[d]), nblocks[d])
+            idx_start += [[item[0] for item in idx]]
+            idx_end += [[item[-1] for item in idx]]
+        else:
+            nchunks = -(-shape[d] // chunks[d])
+            if nblocks[d] > nchunks:
+                raise ValueError('There cannot be more blocks along a dimension than chunks when align_to_chunks=True')
+            idx = np.array_split(range(nchunks), nblocks[d])
+            idx_start += [[item[0] * chunks[d] for item in idx]]
+            idx_end += [[min((item[-1] + 1) * chunks[d], shape[d]) - 1 for item in idx]]
+    return idx_start, idx_end
+
+# padding modes that can be applied to each block locally, producing the same
+# values as padding the whole array
+_LAZY_PAD_MODES = ('constant', 'edge', 'linear_ramp', 'reflect', 'symmetric')
+
+def _read_block(x, block_slice, pad_width, mode, **kwargs):
+    """Read one padded block from an array-like.
+    
+    block_slice is referred to the padded array, as returned by block_split().
+    Only the part of the block inside x is read (x[...]), and the elements 
+    outside of x are filled locally with numpy.pad().
+    """
+    src = []
+    pad = []
+    for d in range(len(x.shape)):
+        # block limits referred to the unpadded array
+        start = block_slice[d].start - pad_width[d][0]
+        stop = block_slice[d].stop - pad_width[d][0]
+        src += [slice(max(start, 0), min(stop, x.shape[d]), 1)]
+        pad += [(src[d].start - start, stop - src[d].stop)]
+        
+        # reflecting needs enough elements inside the array
+        n = src[d].stop - src[d].start
+        if ((mode == 'reflect') and (max(pad[d]) >= n)) \
+            or ((mode == 'symmetric') and (max(pad[d]) > n)):
+            raise ValueError('Block too small to be padded with mode=' + mode + ' without reading the whole array')
+    
+    # read block. Subclasses of np.ndarray (e.g. memmap) return a view, so we
+    # copy it. Other array-likes (e.g. HDF5 datasets) already return a copy
+    block = x[tuple(src)]
+    if isinstance(x, np.ndarray):
+        block = np.array(block)
+    else:
+        block = np.asarray(block)
+        
+    # add the padding that falls outside the array
+    if any(p != (0, 0) for p in pad):
+        block = np.pad(block, pad, mode, **kwargs)
+    return block
+
+def _block_occupancy(x, nblocks, idx_start, idx_end, mask=None, background=None):
+    """Fraction of foreground elements in each block (without padding).
+    
+    Foreground elements are those set to True in mask, or those different 
+    from background. The mask can have a lower resolution than x (e.g. a
+    thumbnail of a slide), in which case the block limits are scaled to the 
+    mask size. If the mask has fewer dimensions than x, the last dimensions of
+    x (e.g. colour channels) are ignored. With a background value per channel,
+    an element is foreground if any of its channels differs from the 
+    background.
+    
+    Returns:
+        occupancy: 1D array with the occupancy of each block, in the same 
+        order as the blocks produced by block_split().
+    """
+    
+    if mask is not None:
+        f = np.asarray(mask)
+        if f.dtype != bool:
+            raise TypeError('mask must be of type bool')
+        if f.ndim > len(x.shape):
+            raise ValueError('mask cannot have more dimensions than x')
+    elif isinstance(x, np.ndarray):
+        if np.ndim(background) == 0:
+            f = x != background
+        else:
+            f = np.any(x != np.asarray(background), axis=-1)
+    else:
+        # array-likes are read block by block, so that the whole array is 
+        # never in memory
+        occupancy = []
+        for b_start, b_end in zip(itertools.product(*idx_start), itertools.product(*idx_end)):
+            block = np.asarray(x[tuple(slice(s, e+1, 1) for s, e in zip(b_start, b_end))])
+            if np.ndim(background) == 0:
+                fg = block != background
+            else:
+                fg = np.any(block != np.asarray(background), axis=-1)
+            occupancy += [np.count_nonzero(fg) / float(fg.size)]
+        return np.array(occupancy)
+    
+    # add up the foreground elements in each block, one dimension at a time
+    counts = f
+    block_size = np.ones((1,) * f.ndim)
+    for d in range(f.ndim):
+        if f.shape[d] < nblocks[d]:
+            raise ValueError('mask must have at least as many elements as blocks along each dimension')
+        starts = [s * f.shape[d] // x.shape[d] for s in idx_start[d]]
+        counts = np.add.reduceat(counts, starts, axis=d, dtype=np.int64)
+        sz_shape = [1] * f.ndim
+        sz_shape[d] = nblocks[d]
+        block_size = block_size * np.diff(starts + [f.shape[d]]).reshape(sz_shape)
+    occupancy = counts / block_size
+    
+    # repeat the occupancy along the dimensions of x not in the mask
+    occupancy = occupancy.reshape(occupancy.shape + (1,) * (len(x.shape) - f.ndim))
+    return np.broadcast_to(occupancy, tuple(nblocks)).ravel()
+
+def _block_geometry(idx_start, idx_end):
+    """(nblocks, ndim, 2) array with the [start, stop] indices of each block,
+    from the lists of first and last (inclusive) indices along each 
+    dimension. Blocks are in the order of itertools.product()."""
+    starts = np.meshgrid(*idx_start, indexing='ij')
+    ends = np.meshgrid(*idx_end, indexing='ij')
+    geom = np.empty((starts[0].size, len(starts), 2), dtype=np.intp)
+    for d in range(len(starts)):
+        geom[:, d, 0] = starts[d].ravel()
+        geom[:, d, 1] = ends[d].ravel() + 1
+    return geom
+
+def _block_slice(block_slices, i):
+    """Tuple of slices of block i, with block_slices in list or array 
+    format."""
+    if isinstance(block_slices, np.ndarray):
+        return tuple(slice(start, stop, 1) for start, stop in block_slices[i])
+    return tuple(block_slices[i])
+
+###############################################################################
+## block_slices_to_array, block_slices_from_array
+###############################################################################
+
+def block_slices_to_array(block_slices):
+    """Convert block slices to compact array format.
+    
+        a = block_slices_to_array(block_slices)
+    
+    Args:
+        block_slices: List of tuples of slice objects (e.g. output of 
+        block_split()). Slices must have step 1 or None. If it's already an 
+        array, it's returned unchanged.
+        
+    Returns:
+        a: (nblocks, ndim, 2) integer array, with a[i, d, :] = [start, stop]
+        of block i along dimension d.
+    """
+    if isinstance(block_slices, np.ndarray):
+        return block_slices
+    a = np.array([[(sl.start, sl.stop) for sl in block_slice] for block_slice in block_slices],
+                 dtype=np.intp)
+    if len(block_slices) == 0:
+        a = a.reshape(0, 0, 2)
+    return a
+
+def block_slices_from_array(a):
+    """Convert block slices from compact array format to a list of tuples of
+    slice objects.
+    
+        block_slices = block_slices_from_array(a)
+    
+    Args:
+        a: (nblocks, ndim, 2) integer array, with a[i, d, :] = [start, stop]
+        of block i along dimension d. If it's already a list, it's returned 
+        unchanged.
+        
+    Returns:
+        block_slices: List of tuples of slice objects, one per block.
+    """
+    if not isinstance(a, np.ndarray):
+        return a
+    return [tuple(slice(start, stop, 1) for start, stop in g) for g in a.tolist()]
+
+###############################################################################
+## block_auto_nblocks
+###############################################################################
+
+def block_auto_nblocks(shape, dtype, memory_budget, pad_width=0, n_workers=1, 
+                       copies=2, chunks=None):
+    """Number of blocks for block_split() so that blocks fit a memory budget.
+    
+    Compute the smallest block grid such that the blocks that are being 
+    processed at the same time fit in the memory budget
+    
+        nblocks = block_auto_nblocks(x.shape, x.dtype, memory_budget=2*1024**3, 
+                                     pad_width=8, n_workers=4)
+    
+    Each of the n_workers has memory_budget/n_workers bytes, and keeps 'copies'
+    padded copies of its block in flight (e.g. the block and the processed 
+    output). Blocks are split greedily along the dimension that reduces the
+    padded block size most per extra block, so that the number of blocks (and
+    the Python overhead and padding overlap) stays low.
+    
+    Args:
+        shape: Shape of the array to split.
+        
+        dtype: dtype of the array (or of the processed blocks, if larger).
+        
+        memory_budget: Memory budget in bytes for all workers.
+        
+        pad_width: (def 0) Padding, as in block_split().
+        
+        n_workers: (def 1) Number of blocks processed at the same time.
+        
+        copies: (def 2) Number of padded copies of each block in flight.
+        
+        chunks: (def None) Chunk size of the array, if blocks are going to be
+        aligned to chunks (see block_split(..., align_to_chunks=True)).
+        
+    Returns:
+        nblocks: List with the number of blocks in each dimension.
+    """
+    
+    ndims = len(shape)
+    pad_width = _pad_width_tuple(pad_width, ndims)
+    pad_width_total = [np.sum(pad) for pad in pad_width]
+    itemsize = np.dtype(dtype).itemsize
+    budget = float(memory_budget) / n_workers / copies
+    
+    # length of the largest padded block along dimension d
+    def block_length(d, nb):
+        if chunks is None:
+            return -(-shape[d] // nb) + pad_width_total[d]
+        nchunks = -(-shape[d] // chunks[d])
+        return min(-(-nchunks // nb) * chunks[d], shape[d]) + pad_width_total[d]
+    
+    # maximum number of blocks along each dimension
+    if chunks is None:
+        max_nblocks = list(shape)
+    else:
+        max_nblocks = [-(-n // c) for n, c in zip(shape, chunks)]
+    
+    nblocks = [1] * ndims
+    lengths = [block_length(d, 1) for d in range(ndims)]
+    block_bytes = np.prod(lengths, dtype=np.float64) * itemsize
+    while block_bytes > budget:
+        
+        # block size and total number of blocks if we add one more block 
+        # along each dimension. Choose the one with the largest reduction of 
+        # block size per extra block
+        best = None
+        best_gain = 0.0
+        for d in range(ndims):
+            if nblocks[d] >= max_nblocks[d]:
+                continue
+            new_bytes = block_bytes / lengths[d] * block_length(d, nblocks[d] + 1)
+            extra_blocks = np.prod(nblocks, dtype=np.float64) / nblocks[d]
+            gain = (block_bytes - new_bytes) / extra_blocks
+            if (best is None) or (gain > best_gain):
+                best = d
+                best_gain = gain
+        if best is None:
+            raise ValueError('The array cannot be split into blocks that fit in the memory budget')
+        
+        nblocks[best] += 1
+        lengths[best] = block_length(best, nblocks[best])
+        block_bytes = np.prod(lengths, dtype=np.float64) * itemsize
+        
+    return nblocks
+
+###############################################################################
+## LazyBlocks
+###############################################################################
+
+class LazyBlocks(object):
+    """Sequence of blocks read from an array-like only when accessed.
+    
+    This is the 'blocks' output of block_split(..., lazy=True). Block i is
+    read and padded each time blocks[i] is accessed, and iterating the 
+    sequence reads the blocks one by one, so the whole array is never loaded
+    into memory.
+    
+    Attributes:
+        x: Array-like with attributes shape, dtype, and __getitem__ that 
+        accepts a tuple of slices (e.g. np.memmap, h5py.Dataset, zarr.Array).
+        
+        block_slices: List of tuples of slice objects, or (nblocks, ndim, 2)
+        array (see block_slices_to_array()), referred to the padded array.
+        
+        pad_width, mode, kwargs: Padding parameters (see numpy.pad).
+        
+        dtype: dtype of the blocks.
+    """
+    
+    def __init__(self, x, block_slices, pad_width, mode='constant', **kwargs):
+        self.x = x
+        self.block_slices = block_slices
+        self.pad_width = pad_width
+        self.mode = mode
+        self.kwargs = kwargs
+        self.dtype = np.dtype(x.dtype)
+        
+    def __len__(self):
+        return len(self.block_slices)
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        prof = current()
+        with prof.stage('read') as st:
+            block = _read_block(self.x, _block_slice(self.block_slices, i), self.pad_width, 
+                                self.mode, **self.kwargs)
+            st.add_bytes(block.nbytes)
+        return block
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+            
+    def shape(self, i):
+        """Shape of block i, without reading it."""
+        return tuple(sl.stop - sl.start for sl in _block_slice(self.block_slices, i))
 
 ###############################################################################
 ## block_split
 ###############################################################################
 
-def block_split(x, nblocks, by_reference=False, pad_width=0, mode='constant', **kwargs):
+@instrumented('block_split')
+def block_split(x, nblocks, by_reference=False, pad_width=0, mode='constant',
+                lazy=None, align_to_chunks=False, mask=None, background=None,
+                min_occupancy=0.0, memory_budget=None, n_workers=1,
+                slices_format='list', pool=None, **kwargs):
     """Split an nd-array into blocks.
     
     Split an N-dimensional array into blocks with or without overlapping 
@@ -93,13 +496,52 @@ def block_split(x, nblocks, by_reference=False, pad_width=0, mode='constant', **
     
         blocks[i]=xout[block_slices[i]]
     
+    Large arrays stored on disk (e.g. HDF5/Zarr datasets or memmaps) can be
+    split without loading them into memory with lazy=True (default for inputs
+    that are not np.ndarray). Then, 'blocks' is a LazyBlocks sequence, and 
+    each block is read (and padded, if necessary) only when it's accessed. 
+    The padded array is not created, so xout=None
+    
+        block_slices, blocks, _ = block_split(dataset, nblocks, pad_width=8, mode='reflect')
+        for sl, block in zip(block_slices, blocks):
+            ...
+    
+    In lazy mode, only padding modes 'constant', 'edge', 'linear_ramp', 
+    'reflect' and 'symmetric' are supported, as the others need values from 
+    the whole array.
+    
+    Blocks that are mostly background (e.g. empty areas of a slide) can be 
+    skipped. The occupancy of each block (fraction of foreground elements, 
+    without padding) is computed first from a foreground mask, or from a 
+    background value, and only blocks with occupancy > min_occupancy are 
+    extracted and returned
+    
+        block_slices, blocks, xout = block_split(x, nblocks, mask=mask)
+        bg = TypicalBorderIntensity(x)
+        block_slices, blocks, xout = block_split(x, nblocks, background=bg, min_occupancy=0.1)
+        
+    The skipped regions can be filled with a constant when the blocks are 
+    reassembled, block_stack(..., shape=x.shape, fill_value=bg).
+    
+    When the blocks are split and stacked many times (e.g. thousands of tiles
+    with the same shape), the block copies can reuse the memory of previous 
+    blocks from a buffer pool, and be returned to the pool after stacking
+    
+        pool = blockproc.BufferPool()
+        block_slices, blocks, xout = block_split(x, nblocks, pad_width=8, pool=pool)
+        y, _ = block_stack(blocks, block_slices, pad_width=8, pool=pool)
+    
     Args:
-        x: nd-array (numpy).
+        x: nd-array (numpy), or array-like with attributes shape, dtype and 
+        __getitem__ accepting a tuple of slices.
         
         nblocks: Scalar or list of the same length as x.shape, with the number 
         of blocks to create in each dimension. If nblocks is a scalar, then 
         that scalar applies to all dimensions. The number of blocks cannot be
         larger than the number of elements in the corresponding dimension.
+        If nblocks='auto', the number of blocks is computed so that the 
+        padded blocks processed by n_workers fit in memory_budget (see 
+        block_auto_nblocks()).
         
         by_reference: (def False) Whether blocks are returns as sliced arrays 
         (by reference) or as copies of the slice array (by value). Changes to 
@@ -112,31 +554,82 @@ def block_split(x, nblocks, by_reference=False, pad_width=0, mode='constant', **
         block, adding elements around the border of x as required. These 
         parameters are the same used by function numpy.pad.
         
+        lazy: (def None) Whether blocks are read from x only when accessed 
+        (see above). By default, lazy=True if x is not a np.ndarray.
+        
+        align_to_chunks: (def False) Align block boundaries to the storage 
+        chunks of x (attribute x.chunks, e.g. HDF5/Zarr datasets), so that 
+        reading or writing a block never touches a chunk partially. Then, the
+        number of blocks in a dimension cannot be larger than the number of 
+        chunks.
+        
+        mask: (def None) Boolean foreground mask to skip background blocks. 
+        It can have lower resolution than x (block limits are scaled to the 
+        mask size), and fewer dimensions (e.g. no colour channel).
+        
+        background: (def None) Alternatively to mask, background value (or 
+        list of values per channel, in the last dimension of x). Elements 
+        different from the background are foreground.
+        
+        min_occupancy: (def 0.0) Blocks with a fraction of foreground elements
+        <= min_occupancy are skipped. Only used if mask or background are 
+        provided.
+        
+        memory_budget: (def None) Memory budget in bytes, for nblocks='auto'.
+        
+        n_workers: (def 1) Number of blocks processed at the same time, for
+        nblocks='auto'.
+        
+        slices_format: (def 'list') Format of output block_slices, 'list' or
+        'array' (see below).
+        
+        pool: (def None) Buffer pool with methods acquire(shape, dtype) and 
+        release(buffer) (e.g. blockproc.BufferPool). Blocks copied by value 
+        are written to buffers acquired from the pool. Not used with 
+        by_reference=True or lazy=True.
+        
     Returns:
-        block_slices: List of slice objects. Each slice applied to x produces 
-        the corresponding block, blocks[i]=xout[block_slices[i]].
+        block_slices: List of tuples of slice objects. Each slice applied to x
+        produces the corresponding block, blocks[i]=xout[block_slices[i]].
+        With slices_format='array', compact (nblocks, ndim, 2) integer array 
+        with the [start, stop] indices of each block instead. This is much 
+        faster to build and to send to other processes when there are many 
+        blocks. Slices can be obtained with block_slices_from_array().
         
         blocks: List of blocks. Each block is a sliced array (a chunk of the 
-        output array).
+        output array). If lazy=True, LazyBlocks sequence.
         
-        xout: Array after padding. If pad_width=0, then xout=x.
+        xout: Array after padding. If pad_width=0, then xout=x. If lazy=True,
+        xout=None.
     """
     
     # number of dimensions
     ndims = len(x.shape)
 
+    # pad_width as ((pad_before,pad_after), (pad_before,pad_after),...) tuple
+    pad_width = _pad_width_tuple(pad_width, ndims)
+    
+    # chunk size of the array, to align blocks with chunks
+    chunks = None
+    if align_to_chunks:
+        chunks = getattr(x, 'chunks', None)
+        if chunks is None:
+            raise ValueError('align_to_chunks=True requires an array with attribute chunks')
+    
+    # number of blocks computed from the memory budget
+    if isinstance(nblocks, str) and (nblocks == 'auto'):
+        if memory_budget is None:
+            raise ValueError("nblocks='auto' requires a memory_budget")
+        nblocks = block_auto_nblocks(x.shape, x.dtype, memory_budget, pad_width=pad_width,
+                                     n_workers=n_workers, chunks=chunks)
+
     # if nblocks given as a scalar, converto to tuple
     if (np.isscalar(nblocks)):
         nblocks = [nblocks]*ndims
     
-    # if pad_width given as a scalar, convert to (pad_before,pad_after) tuple
-    if (np.isscalar(pad_width)):
-        pad_width = (pad_width, pad_width)
-        
-    # if pad_width given as a (pad_before,pad_after) tuple, convert to
-    # ((pad_before,pad_after), (pad_before,pad_after),...) tuple
-    if (isinstance(pad_width, tuple) and not(isinstance(pad_width[0], tuple))):
-        pad_width = (pad_width,) * ndims
+    # by default, arrays that are not numpy arrays are read lazily
+    if lazy is None:
+        lazy = not isinstance(x, np.ndarray)
         
     # input arguments checks
     if (len(nblocks) != ndims):
@@ -151,15 +644,32 @@ def block_split(x, nblocks, by_reference=False, pad_width=0, mode='constant', **
     if (by_reference & np.min(pad_width)>0):
         raise Exception('Blocks with padding cannot be returned by reference, because some padding elements will be outside the array and others will overlap')
 
+    if lazy and by_reference:
+        raise ValueError('Blocks cannot be returned by reference with lazy=True')
+    
+    if lazy and (mode not in _LAZY_PAD_MODES):
+        raise ValueError('mode must be one of ' + str(_LAZY_PAD_MODES) + ' with lazy=True')
+    
+    if slices_format not in ('list', 'array'):
+        raise ValueError("slices_format must be 'list' or 'array'")
+    
+    # instrumentation of the call (no-op unless enabled)
+    prof = current()
+    prof.set_info(nblocks=int(np.prod(nblocks)))
+
     # get two lists:
     # idx_start[d] = starting indices of each block along dimension d
     # idx_end[d] = ditto for end indices
-    idx_start = []
-    idx_end = []
-    for d in range(ndims):
-        idx = np.array_split(range(x.shape[d]), nblocks[d])
-        idx_start += [[item[0] for item in idx]]
-        idx_end += [[item[-1] for item in idx]]
+    idx_start, idx_end = _block_idx(x.shape, nblocks, chunks)
+    
+    # blocks that will be extracted (by default, all of them)
+    if (mask is not None) or (background is not None):
+        with prof.stage('occupancy'):
+            keep = _block_occupancy(x, nblocks, idx_start, idx_end, mask=mask, 
+                                    background=background) > min_occupancy
+        prof.set_info(nblocks_kept=int(np.count_nonzero(keep)))
+    else:
+        keep = None
     
     # total amount of padding (total=before+after) in each dimension
     pad_width_total = [np.sum(pad) for pad in pad_width]
@@ -169,37 +679,46 @@ def block_split(x, nblocks, by_reference=False, pad_width=0, mode='constant', **
     # idx_end := idx_end + total padding
     idx_end = [i+w for i,w in zip(idx_end, pad_width_total)]
         
-    # create indices for each block in the array (we use iterators, but you can
-    # see the indices using e.g. list(idx_start))
-    idx_start = itertools.product(*idx_start)
-    idx_end = itertools.product(*idx_end)
+    # block limits as a (nblocks, ndim, 2) array of [start, stop] indices,
+    # without the background blocks
+    with prof.stage('slices'):
+        geom = _block_geometry(idx_start, idx_end)
+        if keep is not None:
+            geom = geom[keep]
+        if slices_format == 'list':
+            block_slices = block_slices_from_array(geom)
+        else:
+            block_slices = geom
+
+    # lazy blocks are read from the array when accessed
+    if lazy:
+        return block_slices, LazyBlocks(x, block_slices, pad_width, mode, **kwargs), None
 
     # add external margins to the array, if necessary (padding also removes the
     # reference to the input array, so if we want that the output blocks link 
     # by reference to the input array, we cannot pad)
     if (not(by_reference)):
-        x = np.lib.pad(x, pad_width, mode, **kwargs)
+        with prof.stage('pad') as st:
+            x = np.pad(x, pad_width, mode, **kwargs)
+            st.add_bytes(x.nbytes)
     
     # iterate to extract all blocks from array
     blocks = []
-    block_slices = []
-    for (b_start, b_end) in zip(idx_start, idx_end):
-        
-        # create a slice object per dimension
-        this_block_slice = []
-        for d in range(ndims):
-            this_block_slice += [slice(b_start[d],b_end[d]+1,1)]
-
-        # keep copy of slice for output
-        block_slices += [this_block_slice]
+    for g in geom:
         
         # extract block from array
+        this_block_slice = tuple(slice(start, stop, 1) for start, stop in g)
         if (by_reference):
             this_block = x[this_block_slice]
+        elif pool is not None:
+            with prof.stage('copy'):
+                src = x[this_block_slice]
+                this_block = pool.acquire(src.shape, src.dtype)
+                np.copyto(this_block, src)
         else:
-            this_block = np.copy(x[this_block_slice])
-        
-        # add margins to block
+            with prof.stage('copy') as st:
+                this_block = np.copy(x[this_block_slice])
+                st.add_bytes(this_block.nbytes)
         
         # add block to output list
         blocks += [this_block]
@@ -210,7 +729,30 @@ def block_split(x, nblocks, by_reference=False, pad_width=0, mode='constant', **
 ## block_stack
 ###############################################################################
 
-def block_stack(blocks, block_slices, pad_width=0):
+def _coverage_bitmap(shape, geom):
+    """Bitmap of the elements covered by the blocks, packed with 
+    np.packbits() along the last axis. geom is the (nblocks, ndim, 2) array 
+    of blocks without padding."""
+    shape = tuple(int(s) for s in shape)
+    cov = np.zeros(shape[:-1] + ((shape[-1] + 7) // 8,), dtype=np.uint8)
+    for g in geom:
+        
+        # bits of the block along the last axis, packed
+        start, stop = int(g[-1, 0]), int(g[-1, 1])
+        if stop <= start:
+            continue
+        row = np.zeros(stop + (-stop) % 8, dtype=bool)
+        row[start:stop] = True
+        packed = np.packbits(row)[start // 8:]
+        
+        # set the bits in the other dimensions of the block
+        sl = tuple(slice(a, b, 1) for a, b in g[:-1]) + (slice(start // 8, start // 8 + len(packed), 1),)
+        cov[sl] |= packed
+    return cov
+
+@instrumented('block_stack')
+def block_stack(blocks, block_slices, pad_width=0, out=None, shape=None, fill_value=None,
+                pool=None, coverage=False, dtype=None):
     """Reassemble blocks into an nd-array.
     
     Stack a list of blocks to reassemble the original array. This function 
@@ -221,45 +763,115 @@ def block_stack(blocks, block_slices, pad_width=0):
     If the blocks were created with overlap (padding), the padding is removed
     before the blocks are stacked.
     
+    The output can be written directly to an array-like stored on disk (e.g. 
+    HDF5/Zarr dataset or memmap), block by block, so that the whole array is
+    never in memory
+    
+        block_stack(blocks, block_slices, pad_width=0, out=dataset)
+    
+    In that case, blocks can be any iterable (e.g. a generator that processes
+    each block of a LazyBlocks sequence). To write whole storage chunks, use 
+    block_split(..., align_to_chunks=True).
+    
+    If some blocks were skipped in block_split() (e.g. background blocks), 
+    the shape of the original array cannot always be deduced from the slices,
+    so it needs to be given, and the skipped regions are set to fill_value
+    
+        x, block_slices_no_padding = block_stack(blocks, block_slices, pad_width=0, shape=x.shape, fill_value=0)
+    
+    The output is only initialised when the blocks don't cover it completely,
+    and it keeps the dtype of the blocks (e.g. integer label maps). To know 
+    which elements were written by a block, request a coverage bitmap, with 
+    one bit per element packed along the last axis
+    
+        x, block_slices_no_padding, cov = block_stack(blocks, block_slices, shape=x.shape, coverage=True)
+        written = np.unpackbits(cov, axis=-1, count=x.shape[-1]).astype(bool)
+    
     Args:
         blocks: List of blocks (output of block_split). Each block is a sliced 
         array (a chunk of the array we want to recover). The blocks may be 
-        overlapping if padding was chosen in block_split().
+        overlapping if padding was chosen in block_split(). It can also be a
+        LazyBlocks sequence, or any iterable if out is provided.
         
         block_slices: List of slice objects with padding. Each slice applied to 
         the original padded x produces the corresponding padded block, 
-        blocks[i]=x_padded[block_slices[i]].
+        blocks[i]=x_padded[block_slices[i]]. It can also be a (nblocks, ndim, 2)
+        array (see block_slices_to_array()).
         
         pad_width: (def 0) Scalar or tuple describing the amount of padding 
         that was used in block_split().
         
+        out: (def None) Array-like with attributes shape and __setitem__ where
+        the output is written. It must have the shape of the original array.
+        By default, a new np.ndarray is created.
+        
+        shape: (def None) Shape of the output array. By default, it's the 
+        smallest shape that contains all the blocks, or out.shape.
+        
+        fill_value: (def None) Value of the output where there are no blocks.
+        By default, NaN for new float arrays, and not initialised for other
+        arrays. If the blocks cover the whole output, it's not used, and the
+        output is not initialised.
+        
+        pool: (def None) Buffer pool (see block_split()). Each block is 
+        released to the pool after it has been copied to the output, so the 
+        blocks must not be used afterwards.
+        
+        coverage: (def False) Also return the coverage bitmap.
+        
+        dtype: (def None) dtype of the new output array. By default, the 
+        dtype of the blocks. Blocks are cast when copied to the output, so 
+        e.g. float64 blocks can be stacked into a float32 array without an
+        intermediate float64 array.
+        
     Returns:
-        x: nd-array (numpy).
+        x: nd-array (numpy), or out if provided.
         
         block_slices_no_padding: List of slice objects without padding. Each 
         slice applied to x produces one non-overlapping block, 
-        block_no_padding=x[block_slices_no_padding].
+        block_no_padding=x[block_slices_no_padding]. It's an array if
+        block_slices is an array.
+        
+        cov: (only if coverage=True) uint8 array, np.packbits() along the 
+        last axis of a boolean array that is True where x was written by a 
+        block.
     """
 
     # number of blocks (length of the list of blocks, whereas in block_split(),
-    # nblocks is a tuple with the number of blocks in each axis)
-    nblocks = len(blocks)
+    # nblocks is a tuple with the number of blocks in each axis). When writing
+    # to out, blocks can be an iterable without length
+    nblocks = len(block_slices)
+    
+    # block limits as (nblocks, ndim, 2) array of [start, stop] indices
+    geom = block_slices_to_array(block_slices)
+    
+    # no blocks (e.g. all blocks were skipped as background in block_split()).
+    # The output is only the fill value, and its shape must be given
+    if nblocks == 0:
+        if out is not None:
+            x = out
+            if fill_value is not None:
+                x[...] = fill_value
+        elif shape is not None:
+            x = np.full(tuple(shape), np.nan if fill_value is None else fill_value, dtype=dtype)
+        else:
+            raise ValueError('shape or out must be provided when there are no blocks')
+        if coverage:
+            return x, block_slices, _coverage_bitmap(x.shape, geom)
+        return x, block_slices
     
     # number of dimensions
-    ndims = len(block_slices[0])
+    ndims = geom.shape[1]
     
-    # if pad_width given as a scalar, convert to (pad_before,pad_after) tuple
-    if (np.isscalar(pad_width)):
-        pad_width = (pad_width, pad_width)
-        
-    # if pad_width given as a (pad_before,pad_after) tuple, convert to
-    # ((pad_before,pad_after), (pad_before,pad_after),...) tuple
-    if (isinstance(pad_width, tuple) and not(isinstance(pad_width[0], tuple))):
-        pad_width = (pad_width,) * ndims
+    # pad_width as ((pad_before,pad_after), (pad_before,pad_after),...) tuple
+    pad_width = _pad_width_tuple(pad_width, ndims)
 
     # input arguments checks
-    if (nblocks != len(block_slices)):
+    if hasattr(blocks, '__len__') and (len(blocks) != nblocks):
         raise Exception('Not the same number of blocks as slices')
+    
+    if (out is None) and not hasattr(blocks, '__getitem__'):
+        raise ValueError('blocks must be a sequence, unless out is provided')
         
     if (len(pad_width) != ndims):
         raise Exception('pad_width must have one (p_before,p_after) tuple per dimension in x')
@@ -267,44 +879,280 @@ def block_stack(blocks, block_slices, pad_width=0):
     # size of whole output array. We get the start and stop value of every 
     # slice. If start=X, it means the array has at least size X+1. If stop=X, 
     # the array has at least X elements
-    x_shape = [0] * ndims
-    for d in range(ndims):
-        x_shape[d] = np.max([[sl[d].start + 1]+[sl[d].stop] for sl in block_slices]) - pad_width[d][0]
-        x_shape[d] -= pad_width[d][1]
+    pad_width_before = np.array([pad[0] for pad in pad_width], dtype=np.intp)
+    pad_width_after = np.array([pad[1] for pad in pad_width], dtype=np.intp)
+    x_shape = np.max(np.maximum(geom[:, :, 0] + 1, geom[:, :, 1]), axis=0) \
+        - pad_width_before - pad_width_after
+    x_shape = [int(xs) for xs in x_shape]
     
+    # the blocks must fit in the output shape, if given
+    if (shape is None) and (out is not None):
+        shape = out.shape
+    if shape is not None:
+        if (len(shape) != ndims) or any(s < xs for s, xs in zip(shape, x_shape)):
+            raise ValueError('The blocks do not fit in an array of shape ' + str(tuple(shape)))
+        x_shape = shape
+    
+    # instrumentation of the call (no-op unless enabled)
+    prof = current()
+    prof.set_info(nblocks=nblocks)
+
     # init output array
-    x = np.empty(tuple(x_shape), dtype=blocks[0].dtype)
-    x[:] = np.NAN
+    if out is not None:
+        if tuple(out.shape) != tuple(x_shape):
+            raise ValueError('out must have shape ' + str(tuple(x_shape)))
+        x = out
+    else:
+        with prof.stage('alloc') as st:
+            # sequences of blocks (e.g. LazyBlocks) can tell the dtype without
+            # reading a block
+            if dtype is None:
+                dtype = getattr(blocks, 'dtype', None)
+            if dtype is None:
+                dtype = blocks[0].dtype
+            x = np.empty(tuple(x_shape), dtype=dtype)
+            st.add_bytes(x.nbytes)
 
-    # remove padding from block_slices
-    block_slices_no_padding = []
-    for sl, b in zip(block_slices, blocks):
-        
-        # reindex slice so that it points to the block without padding
-        this_block_slice = [] # referred to full output array
-        slice_to_remove_padding = [] # referred to current block, only to remove padding
-        for d in range(ndims):
-            # slice referred to the full output array
-            this_block_slice += [slice(sl[d].start,
-                                       sl[d].stop  - pad_width[d][0] - pad_width[d][1],
-                                       sl[d].step)]
+    # remove padding from block_slices. Slices are referred to the full output
+    # array
+    geom_no_padding = geom.copy()
+    geom_no_padding[:, :, 1] -= pad_width_before + pad_width_after
+    
+    # the output only needs to be initialised where there are no blocks. The 
+    # blocks of block_split() don't overlap, so they cover the whole output 
+    # if their total size is the size of the output
+    covered = np.sum(np.prod(geom_no_padding[:, :, 1] - geom_no_padding[:, :, 0], axis=1)) \
+        == np.prod(x_shape)
+    if not covered:
+        if fill_value is not None:
+            with prof.stage('fill'):
+                x[...] = fill_value
+        elif (out is None) and np.issubdtype(x.dtype, np.inexact):
+            with prof.stage('fill'):
+                x[...] = np.nan
     
-            # local slice only to remove the padding in current block
-            slice_to_remove_padding += [slice(pad_width[d][0],
-                                              b.shape[d] - pad_width[d][1],1)]
+    for g, b in zip(geom_no_padding, blocks):
         
-        block_slices_no_padding += [this_block_slice]
+        # slice referred to the full output array, and local slice only to 
+        # remove the padding in current block
+        this_block_slice = tuple(slice(start, stop, 1) for start, stop in g)
+        slice_to_remove_padding = tuple(slice(pad_width[d][0], b.shape[d] - pad_width[d][1], 1)
+                                        for d in range(ndims))
         
         # assign current block (without padding) to output array
-        x[this_block_slice] = b[slice_to_remove_padding]
+        with prof.stage('copy'):
+            x[this_block_slice] = b[slice_to_remove_padding]
+        
+        # return the block memory to the pool, to be reused by the next split
+        if pool is not None:
+            pool.release(b)
     
-
+    # return slices in the same format they were given
+    if isinstance(block_slices, np.ndarray):
+        block_slices_no_padding = geom_no_padding
+    else:
+        block_slices_no_padding = block_slices_from_array(geom_no_padding)
+    
+    if coverage:
+        with prof.stage('coverage') as st:
+            cov = _coverage_bitmap(x_shape, geom_no_padding)
+            st.add_bytes(cov.nbytes)
+        return x, block_slices_no_padding, cov
     return x, block_slices_no_padding
     
+###############################################################################
+## BlockIndex
+###############################################################################
+
+class BlockIndex(object):
+    """Spatial index over the blocks produced by block_split().
+    
+    Answers which blocks intersect a region of interest (ROI), without 
+    checking every block
+    
+        index = BlockIndex(block_slices, pad_width=8)
+        idx = index.query((slice(100, 200), slice(0, 50)))
+    
+    Blocks from block_split() form a grid (possibly with missing background 
+    blocks). The index keeps the sorted block boundaries along each dimension,
+    and a dense array with the block number of each grid cell, so a query 
+    costs one binary search per dimension plus the number of blocks returned.
+    
+    Attributes:
+        geom: (nblocks, ndim, 2) array with the [start, stop] indices of each 
+        block without padding, referred to the original array.
+        
+        shape: Shape of the original array.
+        
+        edges: List with the sorted block boundaries along each dimension.
+        
+        grid: Array with the block number of each grid cell, or -1 if there's 
+        no block.
+    """
+    
+    def __init__(self, block_slices, pad_width=0, shape=None):
+        """
+        Args:
+            block_slices: Block slices with padding, as returned by 
+            block_split(), in list or array format.
+            
+            pad_width: (def 0) Padding used in block_split().
+            
+            shape: (def None) Shape of the original array. By default, the 
+            smallest shape that contains all the blocks. It needs to be given
+            if background blocks were skipped.
+        """
+        geom = block_slices_to_array(block_slices)
+        ndims = geom.shape[1]
+        pad_width = _pad_width_tuple(pad_width, ndims)
+        
+        # block limits without padding, referred to the original array
+        self.geom = geom.copy()
+        self.geom[:, :, 1] -= np.array([np.sum(pad) for pad in pad_width], dtype=np.intp)
+        self.shape = tuple(int(n) for n in np.max(self.geom[:, :, 1], axis=0))
+        if shape is not None:
+            if (len(shape) != ndims) or any(s < n for s, n in zip(shape, self.shape)):
+                raise ValueError('The blocks do not fit in an array of shape ' + str(tuple(shape)))
+            self.shape = tuple(shape)
+        
+        # block boundaries along each dimension, and grid cell of each block
+        self.edges = []
+        cells = []
+        for d in range(ndims):
+            edges = np.unique(self.geom[:, d, :])
+            cell = np.searchsorted(edges, self.geom[:, d, 0])
+            if (edges[np.minimum(cell + 1, len(edges) - 1)] != self.geom[:, d, 1]).any():
+                raise ValueError('Blocks do not form a grid')
+            self.edges += [edges]
+            cells += [cell]
+        self.grid = -np.ones([len(e) - 1 for e in self.edges], dtype=np.intp)
+        self.grid[tuple(cells)] = np.arange(geom.shape[0])
+        
+    def __len__(self):
+        return self.geom.shape[0]
+    
+    def roi_array(self, roi):
+        """Convert ROI to a (ndim, 2) array of [start, stop] indices, clipped 
+        to the array."""
+        roi = np.array([sl.indices(n)[0:2] if isinstance(sl, slice) else sl 
+                        for sl, n in zip(roi, self.shape)], dtype=np.intp)
+        roi[:, 0] = np.clip(roi[:, 0], 0, self.shape)
+        roi[:, 1] = np.clip(roi[:, 1], roi[:, 0], self.shape)
+        return roi
+        
+    def query(self, roi):
+        """Blocks that intersect a region of interest.
+        
+        Args:
+            roi: Tuple of slice objects (step 1), or (ndim, 2) array of 
+            [start, stop] indices, referred to the original array.
+            
+        Returns:
+            idx: Array with the index of the intersecting blocks, in 
+            increasing order.
+        """
+        roi = self.roi_array(roi)
+        if (roi[:, 1] <= roi[:, 0]).any():
+            return np.zeros(0, dtype=np.intp)
+        cells = tuple(slice(np.searchsorted(e, start, side='right') - 1,
+                            np.searchsorted(e, stop, side='left'))
+                      for e, (start, stop) in zip(self.edges, roi))
+        idx = self.grid[cells].ravel()
+        return np.sort(idx[idx >= 0])
+
+###############################################################################
+## block_stack_roi
+###############################################################################
+
+@instrumented('block_stack_roi')
+def block_stack_roi(blocks, block_slices, roi, pad_width=0, index=None, shape=None, fill_value=None):
+    """Reassemble only a region of interest from blocks.
+    
+    Like block_stack(), but the output is only the region of interest (ROI) 
+    of the original array, and only the blocks that intersect the ROI are 
+    accessed. With a LazyBlocks sequence, the other blocks are never read
+    
+        index = BlockIndex(block_slices, pad_width=8)
+        y = block_stack_roi(blocks, block_slices, (slice(100, 200), slice(0, 50)),
+                            pad_width=8, index=index)
+    
+    Args:
+        blocks: Sequence of blocks (e.g. list or LazyBlocks), as in 
+        block_stack().
+        
+        block_slices: Block slices with padding, as returned by block_split(),
+        in list or array format.
+        
+        roi: Tuple of slice objects (step 1), or (ndim, 2) array of 
+        [start, stop] indices, referred to the original array. It's clipped 
+        to the array.
+        
+        pad_width: (def 0) Padding used in block_split().
+        
+        index: (def None) BlockIndex of the blocks. Pass it to avoid building
+        the index again in each call.
+        
+        shape: (def None) Shape of the original array, used to build the 
+        index (see BlockIndex).
+        
+        fill_value: (def None) Value for elements of the ROI not covered by 
+        any block, as in block_stack().
+        
+    Returns:
+        y: nd-array (numpy) with the region of interest.
+    """
+    
+    if index is None:
+        index = BlockIndex(block_slices, pad_width=pad_width, shape=shape)
+    ndims = index.geom.shape[1]
+    pad_width = _pad_width_tuple(pad_width, ndims)
+    roi = index.roi_array(roi)
+    
+    # instrumentation of the call (no-op unless enabled)
+    prof = current()
+    
+    # blocks that intersect the ROI
+    with prof.stage('query'):
+        idx = index.query(roi)
+    prof.set_info(nblocks=len(idx))
+    
+    # init output array
+    dtype = getattr(blocks, 'dtype', None)
+    y = None
+    for i in idx:
+        b = blocks[i]
+        if y is None:
+            with prof.stage('alloc'):
+                y = np.empty(tuple(roi[:, 1] - roi[:, 0]), dtype=b.dtype if dtype is None else dtype)
+                if fill_value is not None:
+                    y[...] = fill_value
+                elif np.issubdtype(y.dtype, np.inexact):
+                    y[...] = np.nan
+        
+        # intersection of the block (without padding) and the ROI, referred 
+        # to the original array
+        start = np.maximum(index.geom[i, :, 0], roi[:, 0])
+        stop = np.minimum(index.geom[i, :, 1], roi[:, 1])
+        
+        # copy the intersection from the block to the output
+        with prof.stage('copy'):
+            src = tuple(slice(lo - g + p[0], hi - g + p[0], 1) 
+                        for lo, hi, g, p in zip(start, stop, index.geom[i, :, 0], pad_width))
+            dst = tuple(slice(lo - r, hi - r, 1) for lo, hi, r in zip(start, stop, roi[:, 0]))
+            y[dst] = b[src]
+            
+    # no blocks in the ROI
+    if y is None:
+        if fill_value is None:
+            raise ValueError('No blocks in the ROI, and no fill_value given')
+        y = np.full(tuple(roi[:, 1] - roi[:, 0]), fill_value, dtype=dtype)
+    return y
+
 ###############################################################################
 ## imfuse
 ###############################################################################
 
+@instrumented('imfuse')
 def imfuse(a, b):
     """Composite of two images.
     
@@ -321,11 +1169,17 @@ def imfuse(a, b):
         necessary. Then, the RGB channels of C are set as C=(B,A,B)
     """
     
+    import cv2
+
+    # instrumentation of the call (no-op unless enabled)
+    prof = current()
+
     # convert to grayscale if colour images
-    if (len(a.shape)>2):
-        a = cv2.cvtColor(a, cv2.COLOR_RGB2GRAY)
-    if (len(b.shape)>2):
-        b = cv2.cvtColor(b, cv2.COLOR_RGB2GRAY)
+    with prof.stage('grayscale'):
+        if (len(a.shape)>2):
+            a = cv2.cvtColor(a, cv2.COLOR_RGB2GRAY)
+        if (len(b.shape)>2):
+            b = cv2.cvtColor(b, cv2.COLOR_RGB2GRAY)
     
     # check that both images have the same pixel type
     if type(a) is not type(b):
@@ -335,114 +1189,706 @@ def imfuse(a, b):
     sz = np.maximum(a.shape, b.shape)
     
     # zero-padding of images, if necessary, so that they match the output
-    a = np.lib.pad(a, ((0, sz[0]-a.shape[0]), (0, sz[1]-a.shape[1])), 'constant')
-    b = np.lib.pad(b, ((0, sz[0]-b.shape[0]), (0, sz[1]-b.shape[1])), 'constant')
+    with prof.stage('pad') as st:
+        a = np.pad(a, ((0, sz[0]-a.shape[0]), (0, sz[1]-a.shape[1])), 'constant')
+        b = np.pad(b, ((0, sz[0]-b.shape[0]), (0, sz[1]-b.shape[1])), 'constant')
+        st.add_bytes(a.nbytes + b.nbytes)
 
     # the output fused image 
-    return np.dstack((b, a, b))
+    with prof.stage('stack') as st:
+        c = np.dstack((b, a, b))
+        st.add_bytes(c.nbytes)
+    return c
 
 ###############################################################################
 ## matchHist
 ###############################################################################
 
-def matchHist(imref, im, maskref=np.ones(0, dtype=bool), mask=np.ones(0, dtype=bool), nbr_bins=256):
+# number of pixels processed at a time when computing histograms, to keep the
+# temporary arrays small
+_HIST_CHUNK = 65536
+
+# number of pixels mapped at a time by matchHist(), so that the temporary 
+# arrays of a chunk fit in the L2 cache
+_APPLY_CHUNK = 16384
+
+# integer images whose intensity range is smaller than this are mapped with a
+# look-up table
+_MAX_LUT_SIZE = 1 << 16
+
+def _precision_dtype(precision):
+    """dtype of the intermediate values for precision 'float64' or 
+    'float32'."""
+    if precision not in ('float64', 'float32'):
+        raise ValueError("precision must be 'float64' or 'float32'")
+    return np.dtype(precision)
+
+def _interp(x, xp, fp, dtype=np.float64):
+    """np.interp(x, xp, fp), computed in the given float dtype. np.interp()
+    always works in float64, which doubles the memory traffic of the 
+    temporary arrays for 8/16-bit images. xp must be increasing (repeated 
+    values are allowed, as in cumulative distribution functions)."""
+    dtype = np.dtype(dtype)
+    if dtype == np.float64:
+        return np.interp(x, xp, fp)
+    x = np.asarray(x).astype(dtype, copy=False)
+    xp = np.asarray(xp).astype(dtype)
+    fp = np.asarray(fp).astype(dtype)
+    
+    # slope of each segment (0 between repeated points)
+    dxp = np.diff(xp)
+    slope = np.zeros(dxp.shape, dtype=dtype)
+    np.divide(np.diff(fp), dxp, out=slope, where=dxp > 0)
+    
+    # segment of each value, and linear interpolation
+    j = np.searchsorted(xp, x, side='right') - 1
+    np.clip(j, 0, len(xp) - 2, out=j)
+    y = x - xp[j]
+    y *= slope[j]
+    y += fp[j]
+    
+    # values outside xp
+    y[x < xp[0]] = fp[0]
+    y[x >= xp[-1]] = fp[-1]
+    return y
+
+def _hist_edges(x, mn, mx, nbr_bins):
+    """Bin edges of np.histogram(x, nbr_bins) for data with min mn and max mx
+    (numpy scalars of x.dtype), or None for an empty array."""
+    if (mn is None):
+        first_edge, last_edge = 0, 1
+    else:
+        first_edge, last_edge = mn, mx
+        if not (np.isfinite(first_edge) and np.isfinite(last_edge)):
+            raise ValueError('autodetected range of [{}, {}] is not finite'.format(first_edge, last_edge))
+    if first_edge == last_edge:
+        first_edge = first_edge - 0.5
+        last_edge = last_edge + 0.5
+    bin_type = np.result_type(first_edge, last_edge, x)
+    if np.issubdtype(bin_type, np.integer):
+        bin_type = np.result_type(bin_type, float)
+    return np.linspace(first_edge, last_edge, nbr_bins + 1, endpoint=True, dtype=bin_type)
+
+def _masked_minmax(x, mask):
+    """Min and max of each channel of x[pixel, channel], only for pixels in
+    mask, without gathering the masked pixels. Returns two lists, with None
+    for all channels if the mask is empty."""
+    nchan = x.shape[1]
+    if not np.any(mask):
+        return [None] * nchan, [None] * nchan
+    
+    # initial values for the reductions, that any value replaces
+    if np.issubdtype(x.dtype, np.integer):
+        lo, hi = np.iinfo(x.dtype).min, np.iinfo(x.dtype).max
+    elif np.issubdtype(x.dtype, np.floating):
+        lo, hi = -np.inf, np.inf
+    else:
+        xm = x[mask]
+        return list(xm.min(axis=0)), list(xm.max(axis=0))
+    where = mask[:, np.newaxis]
+    mn = np.min(x, axis=0, where=where, initial=hi)
+    mx = np.max(x, axis=0, where=where, initial=lo)
+    return list(mn), list(mx)
+
+def _channel_hist_counts(x, mask, edges):
+    """Histogram counts of each channel of x[pixel, channel], with the bin 
+    edges of each channel (list of equal-width edges arrays). 
+    
+    The histograms of all channels are computed together, in one pass over 
+    the pixels, with the same bins and counts as 
+    np.histogram(x[mask, c], edges[c]) for each channel c. Values outside 
+    the edges and pixels outside the mask are not counted (they go to an
+    extra bin), so the masked pixels are not gathered.
+    
+    Returns:
+        counts: (channel, nbr_bins) array.
+    """
+    npix, nchan = x.shape
+    nbr_bins = len(edges[0]) - 1
+    use_mask = mask.size > 0
+    
+    # bin of each pixel. As np.histogram(), a first guess is computed from the
+    # bin width, and then corrected for rounding errors at the bin edges. 
+    # Values outside the edges or the mask go to an extra bin at the end, 
+    # that is dropped
+    first = np.array([e[0] for e in edges], dtype=np.float64)
+    last = np.array([e[-1] for e in edges], dtype=np.float64)
+    denom = last - first
+    edges_flat = np.concatenate([e.astype(np.float64) for e in edges])
+    edges_offset = np.arange(nchan) * (nbr_bins + 1)
+    counts_offset = np.arange(nchan) * nbr_bins
+    counts = np.zeros(nchan * nbr_bins + 1, dtype=np.intp)
+    for i in range(0, npix, _HIST_CHUNK):
+        xc = x[i:i + _HIST_CHUNK].astype(np.float64)
+        keep = (xc >= first) & (xc <= last)
+        if use_mask:
+            keep &= mask[i:i + _HIST_CHUNK, np.newaxis]
+        xc = np.where(keep, xc, first)
+        idx = ((xc - first) / denom * nbr_bins).astype(np.intp)
+        idx[idx == nbr_bins] -= 1
+        idx -= xc < edges_flat[idx + edges_offset]
+        idx += (xc >= edges_flat[idx + 1 + edges_offset]) & (idx != nbr_bins - 1)
+        idx += counts_offset
+        idx[~keep] = nchan * nbr_bins
+        counts += np.bincount(idx.ravel(), minlength=nchan * nbr_bins + 1)
+    return counts[:-1].reshape(nchan, nbr_bins)
+
+def _hist_cdf(counts, edges, normalized=False):
+    """Cumulative sum of the density histogram of each channel, as 
+    np.histogram(..., density=True)[0].cumsum(). Returns a 
+    (channel, nbr_bins) array.
+    
+    The legacy matchHist() compares these sums for the image and the 
+    reference, which are scaled by 1/bin width, so they are only comparable
+    when both histograms have the same bin width. With normalized=True, the
+    cumulative distribution function counts.cumsum()/counts.sum() is 
+    returned instead, which is comparable for any bins."""
+    cdf = np.empty(counts.shape, dtype=np.float64)
+    for c in range(counts.shape[0]):
+        if normalized:
+            cdf[c] = counts[c].cumsum() / float(counts[c].sum())
+        else:
+            db = np.array(np.diff(edges[c]), float)
+            cdf[c] = (counts[c] / db / counts[c].sum()).cumsum()
+    return cdf
+
+def _channel_hist_cdf(x, mask, nbr_bins, normalized=False):
+    """Bin edges and cumulative density histogram of each channel of 
+    x[pixel, channel], with nbr_bins bins spanning the range of each channel,
+    as np.histogram(x[mask, c], nbr_bins, density=True) (see _hist_cdf() for
+    normalized).
+    
+    Returns:
+        edges: List with the bin edges of each channel.
+        
+        cdf: (channel, nbr_bins) array with the cumulative sum of the density
+        histogram of each channel.
+    """
+    npix, nchan = x.shape
+    
+    # range of each channel, in one pass
+    if mask.size > 0:
+        mn, mx = _masked_minmax(x, mask)
+    elif npix > 0:
+        mn = x.min(axis=0)
+        mx = x.max(axis=0)
+    else:
+        mn = mx = [None] * nchan
+    edges = [_hist_edges(x, mn[c], mx[c], nbr_bins) for c in range(nchan)]
+    
+    return edges, _hist_cdf(_channel_hist_counts(x, mask, edges), edges, normalized)
+
+def _channels_last(im, channel_axis):
+    """View of im with the channels in the last axis, adding a channel axis
+    for images without one."""
+    if (channel_axis is None) or ((channel_axis == -1) and (im.ndim == 2)):
+        return im[..., np.newaxis]
+    return np.moveaxis(im, channel_axis, -1)
+
+class HistogramAccumulator(object):
+    """Histogram of an image that is accumulated chunk by chunk.
+    
+    The histogram of each channel has fixed bin edges, so partial histograms
+    computed from different chunks of a dataset (e.g. by different workers)
+    can be merged without gathering the pixels
+    
+        acc = HistogramAccumulator((0, 255), nbr_bins=256)
+        for chunk, chunk_mask in chunks:
+            acc.update(chunk, chunk_mask)
+        acc.merge(acc_from_other_worker)
+        imout = matchHist(acc, im)
+    
+    The accumulator can be passed as imref to matchHist(), and serialized 
+    with to_bytes() / from_bytes() (or pickle) to send it between processes.
+    
+    Args:
+        value_range: (lo, hi) tuple with the range of the histogram, or list 
+        of (lo, hi) tuples, one per channel. Values outside the range are not
+        counted. The last bin includes hi, as in np.histogram().
+        
+        nbr_bins: (def 256) Number of bins of each histogram.
+        
+        channel_axis: (def -1) Axis of the channels of the chunks, as in 
+        matchHist().
+        
+    Attributes:
+        edges: (channel, nbr_bins+1) array with the bin edges. None until the
+        number of channels is known (first update, if value_range is a 
+        single tuple).
+        
+        counts: (channel, nbr_bins) array with the number of pixels in each 
+        bin.
+    """
+    
+    def __init__(self, value_range, nbr_bins=256, channel_axis=-1):
+        self.nbr_bins = nbr_bins
+        self.channel_axis = channel_axis
+        self._value_range = value_range
+        self.edges = None
+        self.counts = None
+        if not np.isscalar(value_range[0]):
+            self._init_channels(len(value_range))
+            
+    def _init_channels(self, nchan):
+        if np.isscalar(self._value_range[0]):
+            ranges = [self._value_range] * nchan
+        else:
+            ranges = self._value_range
+        if len(ranges) != nchan:
+            raise ValueError('value_range must have one (lo, hi) tuple per channel')
+        for lo, hi in ranges:
+            if not (np.isfinite(lo) and np.isfinite(hi) and lo < hi):
+                raise ValueError('value_range must be finite, with lo < hi')
+        self.edges = np.array([np.linspace(lo, hi, self.nbr_bins + 1, endpoint=True) 
+                               for lo, hi in ranges])
+        self.counts = np.zeros((nchan, self.nbr_bins), dtype=np.int64)
+    
+    @property
+    def nchannels(self):
+        return None if self.counts is None else self.counts.shape[0]
+        
+    def update(self, chunk, mask=np.ones(0, dtype=bool)):
+        """Add the pixels of a chunk of the image to the histograms.
+        
+        Args:
+            chunk: Image chunk, with the channel axis given by channel_axis.
+            
+            mask: (def no mask) Bool mask with the shape of chunk, without 
+            the channel axis. Pixels set to False are ignored.
+            
+        Returns:
+            self
+        """
+        if mask.dtype != "bool":
+            raise TypeError("mask must be of type bool")
+        chunk = _channels_last(np.asarray(chunk), self.channel_axis)
+        if (mask.size > 0) and (mask.shape != chunk.shape[:-1]):
+            raise ValueError('mask must have the same shape as chunk, without channels')
+        if self.counts is None:
+            self._init_channels(chunk.shape[-1])
+        if chunk.shape[-1] != self.nchannels:
+            raise ValueError('chunk must have ' + str(self.nchannels) + ' channels')
+        self.counts += _channel_hist_counts(chunk.reshape(-1, chunk.shape[-1]), mask.ravel(), 
+                                            list(self.edges))
+        return self
+    
+    def merge(self, other):
+        """Add the histograms of another accumulator with the same bins.
+        
+        Returns:
+            self
+        """
+        if other.counts is None:
+            return self
+        if self.counts is None:
+            self.edges = other.edges.copy()
+            self.counts = np.zeros(other.counts.shape, dtype=np.int64)
+        if (self.edges.shape != other.edges.shape) or not np.array_equal(self.edges, other.edges):
+            raise ValueError('Histograms with different bins cannot be merged')
+        self.counts += other.counts
+        return self
+    
+    def cdf(self):
+        """(channel, nbr_bins) array with the cumulative distribution function
+        of each channel, counts.cumsum() / counts.sum()."""
+        if self.counts is None:
+            raise ValueError('Empty histogram')
+        return _hist_cdf(self.counts, self.edges, normalized=True)
+    
+    def to_bytes(self):
+        """Compact serialization of the accumulator. The counts are stored 
+        with the smallest integer type that fits them, compressed."""
+        import io
+        import zlib
+        if self.counts is None:
+            raise ValueError('Empty histogram')
+        counts = self.counts.astype(np.min_scalar_type(int(self.counts.max())))
+        buf = io.BytesIO()
+        np.savez(buf, edges=self.edges, counts=counts, channel_axis=np.array(
+            -2**31 if self.channel_axis is None else self.channel_axis))
+        return zlib.compress(buf.getvalue())
+    
+    @classmethod
+    def from_bytes(cls, data):
+        """Accumulator serialized with to_bytes()."""
+        import io
+        import zlib
+        f = np.load(io.BytesIO(zlib.decompress(data)))
+        edges = f['edges']
+        channel_axis = int(f['channel_axis'])
+        acc = cls([(e[0], e[-1]) for e in edges], nbr_bins=edges.shape[1] - 1,
+                  channel_axis=None if channel_axis == -2**31 else channel_axis)
+        acc.edges = edges
+        acc.counts = f['counts'].astype(np.int64)
+        return acc
+
+@cached('matchHist')
+@instrumented('matchHist')
+def matchHist(imref, im, maskref=np.ones(0, dtype=bool), mask=np.ones(0, dtype=bool), nbr_bins=256, 
+              backend='numpy', channel_axis=-1, precision='float64'):
     """Modify image intensities to match the histogram of a reference image.
     
     imout = matchHist(imref, im)
     
     Args:
-        imref, im: Grayscale or colour 2D images [row, col, channel]. im is the
-                   image we want to modify so that it matches the histogram 
-                   (channel by channel) of imref.
+        imref, im: Grayscale or colour images. By default, 2D images [row, col]
+                   are grayscale, and other images have the channels in the 
+                   last axis, e.g. [row, col, channel] or 
+                   [row, col, slice, channel]. im is the image we want to 
+                   modify so that it matches the histogram (channel by 
+                   channel) of imref. imref and im can have different sizes,
+                   but they must have the same number of dimensions and 
+                   channels. imref can also be a HistogramAccumulator with 
+                   the histograms of the reference (e.g. accumulated over a 
+                   dataset), in which case maskref is not used.
 
     Returns:                   
-        imout: The modified version of im.
+        imout: The modified version of im. 2D grayscale images are returned 
+               with a channel axis, [row, col, 1].
                    
-    imout = matchHist(imref, im, maskref=[], mask=[], nbr_bins=256)
+    imout = matchHist(imref, im, maskref=[], mask=[], nbr_bins=256, backend='numpy', channel_axis=-1, precision='float64')
     
     Optional:
         maskref, mask: Bool masks for imref, im, respectively. The masks must 
-                       have the same number of [rows,cols] as their respective
-                       images, but only 1 channel. Pixels set to False in the
+                       have the same shape as their respective images, 
+                       without the channel axis. Pixels set to False in the
                        mask are completely ignored (default: no mask)
                        
         nbr_bins: Number of bins used to compute histograms (default: 256)
+        
+        backend: 'numpy' (default) uses the pure-NumPy implementation. 
+                 'numba' uses compiled kernels that compute each histogram 
+                 and map the intensities without temporary copies of the 
+                 image. 'auto' uses numba if it's installed, and numpy 
+                 otherwise. The first numba call in a new environment 
+                 compiles the kernels (a few seconds) and writes them to the
+                 numba cache, so numba is only worth it for large images or
+                 many calls. Both backends raise ValueError if the image has 
+                 non-finite values
+                 
+        channel_axis: Axis of the channels (default: -1, with 2D images 
+                 treated as grayscale). None for images without a channel
+                 axis (e.g. a grayscale 3D volume [row, col, slice]), in 
+                 which case imout has the same shape as im. One histogram is
+                 computed per channel over the whole image, not per slice
+                 
+        precision: 'float64' (default) or 'float32'. Precision of the 
+                 temporary arrays used to map the intensities. 'float32' 
+                 halves their memory footprint and bandwidth, and is accurate
+                 enough for 8/16-bit images. Only used by the numpy backend
     """
     
-    # duplicate inputs, to avoid modifying the objects they point to outside
-    # this function
-    imout = im.copy()
-    imrefaux = imref.copy()
+    # instrumentation of the call (no-op unless enabled)
+    prof = current()
     
     # mask must be boolean
     if maskref.dtype != "bool":
         raise TypeError("maskref must be of type bool")
     if mask.dtype != "bool":
         raise TypeError("mask must be of type bool")
+    
+    # reference given by its histograms
+    ref_hist = isinstance(imref, HistogramAccumulator)
+    
+    # dtype of the intermediate values
+    dtype = _precision_dtype(precision)
+    
+    if (not ref_hist) and (imref.ndim != im.ndim):
+        raise ValueError('imref and im must have the same number of dimensions')
+    
+    # images with the channels in the last axis. The output is a C-contiguous
+    # copy of the image, so that it can be viewed as [pixel, channel] and
+    # modified without changing the input
+    with prof.stage('copy') as st:
+        imout = _channels_last(im, channel_axis).copy()
+        st.add_bytes(imout.nbytes)
+    nchan = imout.shape[-1]
+    if ref_hist:
+        nchan_ref = imref.nchannels
+    else:
+        imrefaux = _channels_last(imref, channel_axis)
+        nchan_ref = imrefaux.shape[-1]
+    if nchan_ref != nchan:
+        raise ValueError('imref and im must have the same number of channels')
         
-    # mask must have only one channel. The same is applied to each image 
-    # channel
-    if maskref.ndim > 2:
-        raise ValueError("maskref can have at most one channel")
-    if mask.ndim > 2:
-        raise ValueError("mask can have at most one channel")
-        
-    # grayscale images will be treated as multi-channel images with 1 channel
-    if len(imrefaux.shape) < 3:
-        imrefaux = imrefaux[:,:,np.newaxis]
-    if len(imout.shape) < 3:
-        imout = imout[:,:,np.newaxis]
-    
-    # masks must have the same [rows,cols] as the corresponding image
-    if (len(maskref) > 0) & (maskref.shape != imref.shape[0:2]):
-        raise ValueError('maskref must have the same [rows,col] as imref')
-    if (len(mask) > 0) & (mask.shape != im.shape[0:2]):
-        raise ValueError('mask must have the same [rows,col] as im')
-    
-    # compute histogram of each channel of the reference and converted images
-    for i in range(0, imrefaux.shape[2]):
-        
-        # extract channel from the image
-        chanref = imrefaux[:, :, i]
-        chan = imout[:, :, i]
-        
-        # extract masked pixels, if masks are provided. Otherwise, use all 
-        # pixels flattening the channel
-        if len(maskref) > 0:
-            chanref_flat = chanref[maskref]
-        else:
-            chanref_flat = chanref.flatten()
-            
-        if len(mask) > 0:
-            chan_flat = chan[mask]
-        else:
-            chan_flat = chan.flatten()
-
-        # compute histograms
-        imhistref, binsref = np.histogram(chanref_flat, nbr_bins, normed=True)
-        imhist, bins = np.histogram(chan_flat, nbr_bins, normed=True)
-            
-        # cumulative distribution function
-        cdfhistref = imhistref.cumsum()
-        cdfhist = imhist.cumsum()
+    # masks must have the same shape as the corresponding image, without 
+    # channels
+    if (not ref_hist) and (maskref.size > 0) and (maskref.shape != imrefaux.shape[:-1]):
+        raise ValueError('maskref must have the same shape as imref, without channels')
+    if (mask.size > 0) and (mask.shape != imout.shape[:-1]):
+        raise ValueError('mask must have the same shape as im, without channels')
+    
+    # [pixel, channel] views of the images, and [pixel] views of the masks
+    out2 = imout.reshape(-1, nchan)
+    mask = mask.ravel()
+    if not ref_hist:
+        ref2 = imrefaux.reshape(-1, nchan)
+        maskref = maskref.ravel()
+    
+    # accelerated backend (the compiled kernels compute the reference 
+    # histograms from the image)
+    kernels = None if ref_hist else _get_kernels(backend)
+    if kernels is not None:
+        with prof.stage('kernel'):
+            kernels.match_hist(np.ascontiguousarray(ref2), out2, maskref, mask, nbr_bins)
+    else:
+        
+        # compute histograms of all the channels of the reference and 
+        # converted images
+        with prof.stage('histogram'):
+            # the bins of an accumulated histogram are different from the 
+            # bins of the image, so the cumulative distribution functions 
+            # must be normalized (see _hist_cdf())
+            if ref_hist:
+                edgesref, cdfref = imref.edges, imref.cdf()
+            else:
+                edgesref, cdfref = _channel_hist_cdf(ref2, maskref, nbr_bins)
+            edges, cdf = _channel_hist_cdf(out2, mask, nbr_bins, normalized=ref_hist)
         
         # bin centers
-        cbinsref = (binsref[:-1] + binsref[1:]) / 2.0
-        cbins = (bins[:-1] + bins[1:]) / 2.0
+        cbinsref = [(e[:-1] + e[1:]) / 2.0 for e in edgesref]
+        cbins = [(e[:-1] + e[1:]) / 2.0 for e in edges]
         
-        # map intensity values in current channel so that they match the 
-        # reference histogram
-        chan_flat_to_cdf = np.interp(chan_flat, cbins, cdfhist)
-        chan_flat_mapped = np.interp(chan_flat_to_cdf, cdfhistref, cbinsref)
+        # integer images with a small range of values are mapped with a 
+        # look-up table, computing the mapping once per value instead of once
+        # per pixel
+        luts = [None] * nchan
+        if np.issubdtype(out2.dtype, np.integer):
+            for c in range(nchan):
+                lo, hi = int(np.ceil(edges[c][0])), int(np.floor(edges[c][-1]))
+                if hi - lo < _MAX_LUT_SIZE:
+                    values = np.arange(lo, hi + 1, dtype=out2.dtype)
+                    luts[c] = (lo, _interp(_interp(values, cbins[c], cdf[c], dtype), cdfref[c], 
+                                           cbinsref[c], dtype).astype(out2.dtype))
         
-        # tranfer corrected pixels to image
-        if len(mask) > 0:
-            chan[mask] = chan_flat_mapped
+        # map intensity values so that they match the reference histogram. 
+        # The image is processed in chunks of pixels, all channels of a chunk
+        # at a time, so that the temporary arrays are small and stay in cache
+        # while the chunk is written to the output
+        with prof.stage('interp') as st:
+            st.add_bytes(2 * min(_APPLY_CHUNK, out2.shape[0]) * dtype.itemsize)
+            for i in range(0, out2.shape[0], _APPLY_CHUNK):
+                out_chunk = out2[i:i + _APPLY_CHUNK]
+                where = mask[i:i + _APPLY_CHUNK] if mask.size > 0 else True
+                for c in range(nchan):
+                    chan = out_chunk[:, c]
+                    if luts[c] is not None:
+                        lo, lut = luts[c]
+                        
+                        # pixels outside the mask can be outside the range of
+                        # the look-up table
+                        idx = chan.astype(np.intp) - lo
+                        if mask.size > 0:
+                            np.clip(idx, 0, len(lut) - 1, out=idx)
+                        chan_mapped = lut[idx]
+                    else:
+                        chan_mapped = _interp(_interp(chan, cbins[c], cdf[c], dtype), 
+                                              cdfref[c], cbinsref[c], dtype)
+                    
+                    # write the mapped values in place. With a mask, pixels 
+                    # outside the mask keep their values, without gathering 
+                    # and scattering the masked pixels
+                    np.copyto(chan, chan_mapped, casting='unsafe', where=where)
+    
+    # return corrected image, with the channels where they were
+    if channel_axis is None:
+        return imout[..., 0]
+    elif (channel_axis == -1) and (im.ndim == 2):
+        return imout
+    return np.moveaxis(imout, -1, channel_axis)
+
+###############################################################################
+## matchHistLocal
+###############################################################################
+
+def _tile_interp_weights(idx_start, idx_end, n):
+    """Bilinear interpolation between the centres of the tiles along one 
+    dimension of length n. For each index, the first of the two neighbouring
+    tiles, the second one, and the weight of the second one. Indices before 
+    the first centre or after the last one take only the closest tile."""
+    centres = (np.array(idx_start, dtype=np.float64) + np.array(idx_end, dtype=np.float64)) / 2.0
+    p = np.arange(n, dtype=np.float64)
+    j0 = np.clip(np.searchsorted(centres, p, side='right') - 1, 0, len(centres) - 1)
+    j1 = np.minimum(j0 + 1, len(centres) - 1)
+    denom = centres[j1] - centres[j0]
+    denom[denom == 0] = 1.0
+    w1 = np.clip((p - centres[j0]) / denom, 0.0, 1.0)
+    return j0, j1, w1
+
+@cached('matchHistLocal')
+@instrumented('matchHistLocal')
+def matchHistLocal(imref, im, nblocks, maskref=np.ones(0, dtype=bool), mask=np.ones(0, dtype=bool),
+                   nbr_bins=256, nbr_levels=None, channel_axis=-1, precision='float64'):
+    """Match the histogram of each tile of an image to a reference histogram.
+    
+    imout = matchHistLocal(imref, im, nblocks)
+    
+    Local version of matchHist(), to correct uneven illumination, in the 
+    style of CLAHE. im is split into a grid of tiles with the same geometry
+    as block_split(im, nblocks), and the histogram of each tile is matched to
+    the histogram of imref, producing one intensity mapping (look-up table) 
+    per tile. To avoid seams between tiles, the mapped value of each pixel 
+    is interpolated (bilinearly in 2D, N-linearly in N-D) between the 
+    look-up tables of the 2^N tiles whose centres surround the pixel.
+    
+    Args:
+        imref, im: Images, as in matchHist(). imref can also be a 
+                   HistogramAccumulator.
+                   
+        nblocks: Scalar or list with the number of tiles in each dimension of
+                 im, without the channel axis (see block_split()).
+
+    Returns:                   
+        imout: The modified version of im, with the same shape.
+                   
+    imout = matchHistLocal(imref, im, nblocks, maskref=[], mask=[], nbr_bins=256, nbr_levels=None, channel_axis=-1, precision='float64')
+    
+    Optional:
+        maskref, mask, nbr_bins, channel_axis, precision: As in 
+                       matchHist(). Pixels outside the mask are not used for
+                       the tile histograms, and are not modified. Tiles 
+                       without any pixels in the mask use the histogram of 
+                       the whole image.
+                       
+        nbr_levels: Number of intensity levels of the look-up tables, spaced
+                       evenly between the min and max of im. Values between
+                       levels are interpolated linearly. By default, one 
+                       level per value for integer images with a range of at
+                       most 65536 values (exact mapping), and 4096 otherwise
+    """
+    
+    # instrumentation of the call (no-op unless enabled)
+    prof = current()
+    
+    # mask must be boolean
+    if maskref.dtype != "bool":
+        raise TypeError("maskref must be of type bool")
+    if mask.dtype != "bool":
+        raise TypeError("mask must be of type bool")
+    
+    # dtype of the intermediate values
+    dtype = _precision_dtype(precision)
+    
+    # images with the channels in the last axis
+    imaux = _channels_last(im, channel_axis)
+    shape = imaux.shape[:-1]
+    ndims = len(shape)
+    nchan = imaux.shape[-1]
+    if (mask.size > 0) and (mask.shape != shape):
+        raise ValueError('mask must have the same shape as im, without channels')
+    if np.isscalar(nblocks):
+        nblocks = [nblocks] * ndims
+    if len(nblocks) != ndims:
+        raise ValueError('nblocks must have one element per dimension of im, without channels')
+    
+    # histograms of the reference. Each tile has a different range, so the 
+    # cumulative distribution functions are normalized (see _hist_cdf())
+    with prof.stage('histogram'):
+        if isinstance(imref, HistogramAccumulator):
+            edgesref, cdfref = imref.edges, imref.cdf()
         else:
-            chan = np.reshape(chan_flat_mapped, chan.shape)
-            
-        imout[:, :, i] = chan
+            imrefaux = _channels_last(imref, channel_axis)
+            if (maskref.size > 0) and (maskref.shape != imrefaux.shape[:-1]):
+                raise ValueError('maskref must have the same shape as imref, without channels')
+            edgesref, cdfref = _channel_hist_cdf(imrefaux.reshape(-1, imrefaux.shape[-1]), 
+                                                 maskref.ravel(), nbr_bins, normalized=True)
+        if len(edgesref) != nchan:
+            raise ValueError('imref and im must have the same number of channels')
+        cbinsref = [(e[:-1] + e[1:]) / 2.0 for e in edgesref]
         
-    # return corrected image
-    return imout
+        # histogram of the whole image, for tiles without pixels
+        x2 = imaux.reshape(-1, nchan)
+        edges_all, cdf_all = _channel_hist_cdf(x2, mask.ravel(), nbr_bins, normalized=True)
     
+    # intensity levels of the look-up tables, between the min and max of im
+    mn = np.array([e[0] for e in edges_all], dtype=np.float64)
+    mx = np.array([e[-1] for e in edges_all], dtype=np.float64)
+    if nbr_levels is None:
+        if np.issubdtype(im.dtype, np.integer) and np.all(mx - mn <= 65536):
+            mn = np.ceil(mn)
+            mx = np.floor(mx)
+            nbr_levels = int(np.max(mx - mn)) + 1
+            mx = mn + nbr_levels - 1
+        else:
+            nbr_levels = 4096
+    nbr_levels = max(nbr_levels, 2)
+    levels = np.linspace(mn, mx, nbr_levels, axis=1)
+    
+    # tiles, with the same geometry as block_split()
+    idx_start, idx_end = _block_idx(shape, nblocks)
+    geom = _block_geometry(idx_start, idx_end)
+    
+    # look-up table of each tile and channel, lut[tile, channel, level]
+    lut = np.empty((len(geom), nchan, nbr_levels), dtype=np.float64)
+    with prof.stage('lut') as st:
+        for t, g in enumerate(geom):
+            sl = tuple(slice(a, b) for a, b in g)
+            tile = imaux[sl].reshape(-1, nchan)
+            tile_mask = mask[sl].ravel() if mask.size > 0 else mask
+            if (tile_mask.size > 0) and not np.any(tile_mask):
+                edges, cdf = edges_all, cdf_all
+            else:
+                edges, cdf = _channel_hist_cdf(tile, tile_mask, nbr_bins, normalized=True)
+            for c in range(nchan):
+                cbins = (edges[c][:-1] + edges[c][1:]) / 2.0
+                lut[t, c] = np.interp(np.interp(levels[c], cbins, cdf[c]), cdfref[c], cbinsref[c])
+        st.add_bytes(lut.nbytes)
+    
+    # neighbouring tiles and interpolation weights along each dimension. The 
+    # tiles are in C order, so the index of a tile is the dot product of its
+    # grid position and the strides
+    strides = np.cumprod([1] + list(nblocks[:0:-1]))[::-1]
+    interp = [_tile_interp_weights(s, e, n) for s, e, n in zip(idx_start, idx_end, shape)]
+    
+    # output
+    with prof.stage('copy') as st:
+        imout = np.empty(im.shape, dtype=im.dtype)
+        out = _channels_last(imout, channel_axis)
+        st.add_bytes(imout.nbytes)
+    
+    # apply the blended look-up tables in chunks of rows, to keep the 
+    # temporary arrays small
+    row_size = max(int(np.prod(shape[1:])), 1)
+    nrows = max(_HIST_CHUNK // row_size, 1)
+    with prof.stage('apply'):
+        for r0 in range(0, shape[0], nrows):
+            r1 = min(r0 + nrows, shape[0])
+            
+            # tile index and weight of each of the 2^ndims corners, broadcast
+            # to the chunk
+            corners = []
+            for corner in itertools.product((0, 1), repeat=ndims):
+                tile_idx = 0
+                weight = 1.0
+                for d in range(ndims):
+                    j0, j1, w1 = interp[d]
+                    sel = slice(r0, r1) if d == 0 else slice(None)
+                    bshape = [1] * ndims
+                    bshape[d] = -1
+                    j = (j1 if corner[d] else j0)[sel].reshape(bshape)
+                    w = (w1 if corner[d] else 1.0 - w1)[sel].reshape(bshape)
+                    tile_idx = tile_idx + j * strides[d]
+                    weight = weight * w.astype(dtype)
+                corners.append((tile_idx, weight))
+            
+            for c in range(nchan):
+                
+                # position of each value between the look-up table levels
+                v = imaux[r0:r1, ..., c].astype(dtype)
+                pos = np.clip((v - dtype.type(levels[c, 0])) / dtype.type(levels[c, 1] - levels[c, 0]), 
+                              0, nbr_levels - 1)
+                l0 = np.minimum(pos.astype(np.intp), nbr_levels - 2)
+                f = pos - l0.astype(dtype)
+                
+                # blend the look-up tables of the neighbouring tiles
+                lutc = lut[:, c, :].astype(dtype)
+                acc = np.zeros(v.shape, dtype=dtype)
+                for tile_idx, weight in corners:
+                    acc += weight * (lutc[tile_idx, l0] * (1.0 - f) + lutc[tile_idx, l0 + 1] * f)
+                
+                # pixels outside the mask keep their values
+                if mask.size > 0:
+                    np.copyto(acc, v, where=~mask[r0:r1])
+                np.copyto(out[r0:r1, ..., c], acc, casting='unsafe')
+    
+    return imout
@@ -42,18 +42,28 @@ along with this program.  If not, see
 ##      matplotlib.imshow extended for the ITK Image class.
 ##
 ##   TypicalBorderIntensity:
-##      typical intensity value of the voxels on the perimeter of the image.
+##      typical intensity value of the voxels on the perimeter of the image
+##      (or of an image file, reading only its borders from disk).
+##
+##   imfuseITK:
+##      imfuse for SimpleITK images, resampled onto a shared physical grid.
 ##
 ###############################################################################
 
-import SimpleITK as sitk
-import matplotlib.pyplot as plt
+import collections
+import threading
 import numpy as np
+from pysto.instrument import instrumented, current
+from pysto.cache import cached
+
+# Note: SimpleITK and matplotlib.pyplot are imported inside the functions that
+# need them, so that importing this module is cheap until one of them is called
 
 ###############################################################################
 ## block_split
 ###############################################################################
 
+@instrumented('imshow')
 def imshow(im, **kwargs):
     """matplotlib.imshow extended for the ITK Image class.
     
@@ -71,6 +81,9 @@ def imshow(im, **kwargs):
         Same as matplotlib.imshow.
     """
 
+    import SimpleITK as sitk
+    import matplotlib.pyplot as plt
+
     origin = im.GetOrigin()
     spacing = im.GetSpacing()
     size = im.GetSize()
@@ -89,13 +102,22 @@ def imshow(im, **kwargs):
                 )
 
     
+    # instrumentation of the call (no-op unless enabled)
+    prof = current()
+    
     # pass the call to matplotlib.imshow
-    return plt.imshow(sitk.GetArrayFromImage(im), extent=extent, **kwargs)
+    with prof.stage('convert') as st:
+        x = sitk.GetArrayFromImage(im)
+        st.add_bytes(x.nbytes)
+    with prof.stage('plot'):
+        return plt.imshow(x, extent=extent, **kwargs)
 
 ###############################################################################
 ## TypicalBorderIntensity
 ###############################################################################
 
+@cached('TypicalBorderIntensity', file_args=('im',))
+@instrumented('TypicalBorderIntensity')
 def TypicalBorderIntensity(im, mode='median'):
     """Compute the typical values at the boundaries of SimpleITK Images or np.arrays
     
@@ -103,83 +125,333 @@ def TypicalBorderIntensity(im, mode='median'):
     voxels in its perimeter, and computes the typical value (median or mean). 
     If the input is an np.array, it's treated as a 1-channel image (greyscale).
     
+    If the input is a path to an image file, only the 2·ndim border slabs are
+    read from disk, using streamed region reads 
+    (ImageFileReader.SetExtractIndex/SetExtractSize), instead of loading the
+    whole image. For file formats that support region reads (e.g. MHA/NRRD,
+    uncompressed NIfTI), this avoids reading the interior of large volumes. 
+    Other formats are read in full by ITK, but only the borders are converted
+    to np.array. The result is the same as for the loaded image.
+    
     Args:
-        im: SimpleITK n-dimensional image, colour or greyscale, or a numpy 
-        array.
+        im: SimpleITK n-dimensional image, colour or greyscale, a numpy 
+        array, or a path (str) to an image file that SimpleITK can read.
         
         mode: Method to compute the typical value. Options are 'median' 
         (default) and 'mean'.
     """
-    
-    # convert input image to np.array type, if necessary, keeping a note of 
-    # whether it has more than one component (colour)
-    if type(im) == np.ndarray:
-        numberOfComponentsPerPixel = 1
-        dimension = im.ndim
-    elif type(im) == sitk.SimpleITK.Image:
-        numberOfComponentsPerPixel = im.GetNumberOfComponentsPerPixel()
-        dimension = im.GetDimension()
-        im = sitk.GetArrayFromImage(im)
+
+    import SimpleITK as sitk
+
+    # instrumentation of the call (no-op unless enabled)
+    prof = current()
+
+    # check mode before doing any work
+    if mode not in ('median', 'mean'):
+        raise Exception('Mode not implemented')
+
+    # get the number of components and size of the image, and a function to
+    # extract a border slab given a slice per dimension (in np.array order).
+    # For paths, the slab is read from disk instead of from memory
+    if isinstance(im, str):
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(im)
+        with prof.stage('read_info'):
+            reader.ReadImageInformation()
+        numberOfComponentsPerPixel = reader.GetNumberOfComponents()
+        dimension = reader.GetDimension()
         # Note: ITK Size=(50,100) image becomes np.array im.shape=(100,50)
+        size = tuple(reader.GetSize()[::-1])
+
+        def get_slab(slices):
+            # ITK index and size are in reverse order with respect to np.array
+            reader.SetExtractIndex([int(s.start) for s in slices[::-1]])
+            reader.SetExtractSize([int(s.stop - s.start) for s in slices[::-1]])
+            with prof.stage('read') as st:
+                slab = sitk.GetArrayFromImage(reader.Execute())
+                st.add_bytes(slab.nbytes)
+            return slab
+
     else:
-        raise Exception('Function not implemented for type(im) = ' + str(type(im)))
-    if numberOfComponentsPerPixel == 1:
-        size = im.shape
-    else:
-        size = im.shape[0:-1]
-        
-    # check that for colour images, the colour channel is the last index
-    if numberOfComponentsPerPixel > 1:
-        assert(im.shape[-1] == numberOfComponentsPerPixel)
-        
+
+        # convert input image to np.array type, if necessary, keeping a note 
+        # of whether it has more than one component (colour)
+        if type(im) == np.ndarray:
+            numberOfComponentsPerPixel = 1
+            dimension = im.ndim
+        elif type(im) == sitk.SimpleITK.Image:
+            numberOfComponentsPerPixel = im.GetNumberOfComponentsPerPixel()
+            dimension = im.GetDimension()
+            with prof.stage('convert') as st:
+                im = sitk.GetArrayFromImage(im)
+                st.add_bytes(im.nbytes)
+            # Note: ITK Size=(50,100) image becomes np.array im.shape=(100,50)
+        else:
+            raise Exception('Function not implemented for type(im) = ' + str(type(im)))
+        if numberOfComponentsPerPixel == 1:
+            size = im.shape
+        else:
+            size = im.shape[0:-1]
+
+        # check that for colour images, the colour channel is the last index
+        if numberOfComponentsPerPixel > 1:
+            assert(im.shape[-1] == numberOfComponentsPerPixel)
+
+        def get_slab(slices):
+            return im[tuple(slices)]
+
+    # extract the border slabs of the image, two per dimension
+    slabs = []
+    for d in range(dimension):
+
+        # to avoid repeating pixels, we avoid the first and last elements 
+        # of already sampled dimensions
+        slice_left_edge = [slice(1,size[d_prev]-1,1) for d_prev in range(d)]
+        slice_right_edge = [slice(1,size[d_prev]-1,1) for d_prev in range(d)]
+
+        # to sample the current dimension, we only take the first or last 
+        # elements, respectively for the left and right edges
+        slice_left_edge += [slice(0,1,1)]
+        slice_right_edge += [slice(size[d]-1,size[d],1)]
+
+        # from posterior dimensions, we take all elements
+        slice_left_edge += [slice(0,size[d_post],1) for d_post in range(d+1,dimension)]
+        slice_right_edge += [slice(0,size[d_post],1) for d_post in range(d+1,dimension)]
+
+        # empty slabs (image with <= 2 elements in a previous dimension) are
+        # skipped, as ITK would interpret an extract size of 0 as collapsing
+        # the dimension
+        if any([s.stop <= s.start for s in slice_left_edge]):
+            continue
+
+        # get border values in this slab, for all components
+        with prof.stage('extract') as st:
+            slabs.append(get_slab(slice_left_edge))
+            slabs.append(get_slab(slice_right_edge))
+            st.add_bytes(slabs[-2].nbytes + slabs[-1].nbytes)
+
     # initialise output
     typicalBorderIntensity = [None,] * numberOfComponentsPerPixel
     
     # loop colour channels
     for component in range(numberOfComponentsPerPixel):
 
-        # init variable to keep copy of all pixels on the edge
-        border_values = []
+        # keep copy of all pixels on the edge for this component
+        if numberOfComponentsPerPixel > 1:
+            border_values = [slab[..., component].flatten() for slab in slabs]
+        else:
+            border_values = [slab.flatten() for slab in slabs]
+        border_values = np.concatenate([[]] + border_values)
 
-        #print('*')
-        
-        for d in range(dimension):
-            
-            # to avoid repeating pixels, we avoid the first and last elements 
-            # of already sampled dimensions
-            slice_left_edge = [slice(1,size[d_prev]-1,1) for d_prev in range(d)]
-            slice_right_edge = [slice(1,size[d_prev]-1,1) for d_prev in range(d)]
-            
-            # to sample the current dimension, we only take the first or last 
-            # elements, respectively for the left and right edges
-            slice_left_edge += [slice(0,1,1)]
-            slice_right_edge += [slice(size[d]-1,size[d],1)]
-            
-            # from posterior dimensions, we take all elements
-            slice_left_edge += [slice(0,size[d_post],1) for d_post in range(d+1,dimension)]
-            slice_right_edge += [slice(0,size[d_post],1) for d_post in range(d+1,dimension)]
-
-            # colour channel index, if necessary            
-            if numberOfComponentsPerPixel>1:
-                slice_left_edge += [slice(component,component+1,1)]
-                slice_right_edge += [slice(component,component+1,1)]
-            
-            #print(slice_left_edge)
-            #print(slice_right_edge)
-            
-            # get border values in this slice and component
-            border_values = np.concatenate([border_values, im[slice_left_edge].flatten()])
-            border_values = np.concatenate([border_values, im[slice_right_edge].flatten()])
-            
-            # compute typical value
+        # compute typical value
+        with prof.stage('reduce'):
             if (mode == 'median'):
                  typicalBorderIntensity[component] = np.median(border_values)
-            elif (mode == 'mean'):
-                 typicalBorderIntensity[component] = np.mean(border_values)
             else:
-                raise Exception('Mode not implemented')
+                 typicalBorderIntensity[component] = np.mean(border_values)
 
     if numberOfComponentsPerPixel == 1:
         return typicalBorderIntensity[0]
     else:
         return typicalBorderIntensity
+
+###############################################################################
+## imfuseITK
+###############################################################################
+
+# maximum number of ResampleImageFilter objects kept by imfuseITK(), one per
+# output grid, interpolator, default value and pixel type
+_RESAMPLE_CACHE_SIZE = 8
+
+# cached ResampleImageFilter objects, least recently used first, and lock to 
+# share them between threads (the filters keep state between calls)
+_resample_cache = collections.OrderedDict()
+_resample_lock = threading.Lock()
+
+def _itk_interpolator(interpolator):
+    """sitk interpolator constant for 'nearest', 'linear' or 'bspline'."""
+    import SimpleITK as sitk
+    interpolators = {'nearest': sitk.sitkNearestNeighbor, 
+                     'linear': sitk.sitkLinear, 
+                     'bspline': sitk.sitkBSpline}
+    if interpolator not in interpolators:
+        raise ValueError("interpolator must be 'nearest', 'linear' or 'bspline'")
+    return interpolators[interpolator]
+
+def _itk_grid(im):
+    """Physical grid (size, origin, spacing, direction) of a SimpleITK image,
+    as a hashable tuple."""
+    return (tuple(int(s) for s in im.GetSize()), tuple(im.GetOrigin()), 
+            tuple(im.GetSpacing()), tuple(im.GetDirection()))
+
+def _itk_union_grid(a, b):
+    """Grid with the orientation of image a, the finest spacing of a and b,
+    and an extent that contains both images."""
+    dimension = a.GetDimension()
+    direction = np.reshape(a.GetDirection(), (dimension, dimension))
+    origin = np.array(a.GetOrigin())
+    
+    # corners of both images, in the physical frame of a (rotated by its 
+    # direction, with the origin of a)
+    corners = []
+    for im in (a, b):
+        size = im.GetSize()
+        for corner in np.ndindex(*([2] * dimension)):
+            idx = [c * (s - 1) for c, s in zip(corner, size)]
+            p = np.array(im.TransformContinuousIndexToPhysicalPoint(idx))
+            corners.append(np.dot(direction.T, p - origin))
+    corners = np.array(corners)
+    lo = corners.min(axis=0)
+    hi = corners.max(axis=0)
+    
+    # finest spacing of both images, and number of voxels to cover the extent
+    # (with a small tolerance for rounding errors of the corner coordinates)
+    spacing = np.minimum(a.GetSpacing(), b.GetSpacing())
+    size = np.floor((hi - lo) / spacing + 1e-6).astype(np.intp) + 1
+    
+    return (tuple(int(s) for s in size), 
+            tuple(float(o) for o in origin + np.dot(direction, lo)),
+            tuple(float(s) for s in spacing), tuple(a.GetDirection()))
+
+def _itk_resampler(grid, interpolator, default_value, pixel_id):
+    """Cached ResampleImageFilter that resamples onto grid. The caller must 
+    hold _resample_lock while using it."""
+    import SimpleITK as sitk
+    
+    key = (grid, interpolator, default_value, pixel_id)
+    resampler = _resample_cache.get(key)
+    if resampler is None:
+        size, origin, spacing, direction = grid
+        resampler = sitk.ResampleImageFilter()
+        resampler.SetSize(size)
+        resampler.SetOutputOrigin(origin)
+        resampler.SetOutputSpacing(spacing)
+        resampler.SetOutputDirection(direction)
+        resampler.SetInterpolator(interpolator)
+        resampler.SetDefaultPixelValue(default_value)
+        resampler.SetOutputPixelType(pixel_id)
+        _resample_cache[key] = resampler
+        while len(_resample_cache) > _RESAMPLE_CACHE_SIZE:
+            _resample_cache.popitem(last=False)
+    else:
+        _resample_cache.move_to_end(key)
+    return resampler
+
+def _itk_grayscale(im):
+    """Convert an RGB SimpleITK image to grayscale, with the same weights as 
+    cv2.COLOR_RGB2GRAY (used by imgproc.imfuse()). Scalar images are returned
+    unchanged."""
+    import SimpleITK as sitk
+    
+    ncomponents = im.GetNumberOfComponentsPerPixel()
+    if ncomponents == 1:
+        return im
+    if ncomponents != 3:
+        raise Exception('Function not implemented for images with ' 
+                        + str(ncomponents) + ' components')
+    
+    # weighted sum of the channels, cast back to the component type
+    pixel_id = sitk.VectorIndexSelectionCast(im, 0).GetPixelID()
+    gray = 0
+    for channel, weight in enumerate((0.299, 0.587, 0.114)):
+        gray = gray + weight * sitk.VectorIndexSelectionCast(im, channel, sitk.sitkFloat32)
+    if pixel_id not in (sitk.sitkFloat32, sitk.sitkFloat64):
+        gray = sitk.Round(gray)
+    return sitk.Cast(gray, pixel_id)
+
+@instrumented('imfuseITK')
+def imfuseITK(a, b, transform=None, reference=None, interpolator='linear', 
+              default_value=0.0):
+    """Composite of two SimpleITK images in physical space.
+    
+    Create a false-colour RGB image that combines two input images, like 
+    imgproc.imfuse(), but taking into account the origin, spacing and 
+    direction of the images. Both images are resampled onto a shared physical
+    grid, so they don't need to have the same size or to be aligned at index 
+    (0,0).
+    
+    C = imfuseITK(A, B)
+    C = imfuseITK(A, B, transform=T)
+    
+    The ResampleImageFilter of each output grid is set up once and cached, 
+    so that repeated calls with the same image geometries (e.g. previews of 
+    the moving image B at each iteration of a registration) only cost the 
+    resampling of the images. When an image is already on the output grid 
+    and needs no transform, it is not resampled.
+    
+    Args:
+        A, B: SimpleITK images, of the same dimension, grayscale or RGB. 
+        Typically, A is the fixed image and B the moving image of a 
+        registration.
+        
+        transform: (def None) sitk.Transform applied to B, mapping points of
+        the output grid to the physical space of B (the same convention as
+        the transforms computed by ITK registration). None means the 
+        identity.
+        
+        reference: (def None) SimpleITK image that defines the output grid 
+        (size, origin, spacing and direction). By default, the grid has the 
+        direction of A, the finest spacing of A and B, and an extent that 
+        contains both images (without applying the transform).
+        
+        interpolator: (def 'linear') Interpolation used to resample the 
+        images: 'nearest', 'linear' or 'bspline'.
+        
+        default_value: (def 0.0) Value of the output pixels outside of each 
+        image.
+        
+    Returns:
+        C: Output SimpleITK image with 3 components per pixel, and the same 
+        origin, spacing and direction as the output grid. It is built by 
+        converting A,B to grayscale, if necessary, and resampling them onto 
+        the grid with the pixel type of A. Then, the RGB channels of C are set
+        as C=(B,A,B).
+    """
+    
+    import SimpleITK as sitk
+
+    # instrumentation of the call (no-op unless enabled)
+    prof = current()
+
+    # check inputs
+    if not isinstance(a, sitk.Image) or not isinstance(b, sitk.Image):
+        raise TypeError('A and B must be SimpleITK images')
+    if a.GetDimension() != b.GetDimension():
+        raise ValueError('A and B must have the same dimension')
+    interpolator = _itk_interpolator(interpolator)
+
+    # convert to grayscale if colour images
+    with prof.stage('grayscale'):
+        a = _itk_grayscale(a)
+        b = _itk_grayscale(b)
+    
+    # shared output grid
+    with prof.stage('grid'):
+        if reference is None:
+            grid = _itk_union_grid(a, b)
+        else:
+            grid = _itk_grid(reference)
+
+    # resample both images onto the grid, with the pixel type of A, reusing 
+    # the filter set up for this grid
+    pixel_id = a.GetPixelID()
+    nresampled = 0
+    with prof.stage('resample') as st, _resample_lock:
+        resampler = _itk_resampler(grid, interpolator, float(default_value), pixel_id)
+        out = []
+        for im, tr in ((a, None), (b, transform)):
+            if tr is None and _itk_grid(im) == grid and im.GetPixelID() == pixel_id:
+                out.append(im)
+                continue
+            resampler.SetTransform(sitk.Transform() if tr is None else tr)
+            out.append(resampler.Execute(im))
+            nresampled += 1
+        a, b = out
+        st.add_bytes(nresampled * int(np.prod(grid[0])) * a.GetSizeOfPixelComponent())
+    prof.set_info(nresampled=nresampled)
+
+    # the output fused image 
+    with prof.stage('compose') as st:
+        c = sitk.Compose(b, a, b)
+        st.add_bytes(int(np.prod(grid[0])) * 3 * c.GetSizeOfPixelComponent())
+    return c
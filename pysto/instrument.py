@@ -0,0 +1,357 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/pysto/instrument.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+###############################################################################
+## Summary of functions in this module:
+##
+##   record:
+##      Context manager to record per-stage timings and allocated bytes of 
+##      pysto calls.
+##
+##   instrumented:
+##      Decorator used on pysto functions to instrument their calls.
+##
+##   current:
+##      Used inside pysto functions to time stages of the current call.
+##
+## Instrumentation is opt-in. It's enabled either within a record() context,
+## or for the whole process by setting the environment variable 
+## PYSTO_PROFILE=1 (each call is then reported to the logger 'pysto.instrument'
+## at DEBUG level). When disabled, instrumented functions are called directly
+## and current() returns a shared no-op object, so the overhead is a flag 
+## check and a few attribute lookups per call.
+##
+## Example:
+##
+##     import pysto.instrument as pinst
+##     with pinst.record() as stats:
+##         block_slices, blocks, xout = block_split(x, nblocks=4, pad_width=8)
+##     print(stats.totals())
+##     # {'block_split': {'pad': {'time': 0.012, 'nbytes': 4194304, 'count': 1}, ...}}
+##
+###############################################################################
+
+import os
+import time
+import threading
+import logging
+import contextlib
+import functools
+from collections import OrderedDict
+
+# wall clock with the best available resolution
+_clock = getattr(time, 'perf_counter', time.time)
+
+# active recorders. _enabled is a fast flag to check whether there's any
+_recorders = []
+_recorders_lock = threading.Lock()
+_enabled = False
+
+# per-thread stack of calls being instrumented
+_local = threading.local()
+
+###############################################################################
+## Stats objects
+###############################################################################
+
+class StageStats(object):
+    """Time (s), number of bytes allocated and number of times a stage was run
+    within a call."""
+    
+    __slots__ = ('time', 'nbytes', 'count')
+    
+    def __init__(self):
+        self.time = 0.0
+        self.nbytes = 0
+        self.count = 0
+        
+    def add_bytes(self, nbytes):
+        self.nbytes += int(nbytes)
+        
+    def as_dict(self):
+        return {'time': self.time, 'nbytes': self.nbytes, 'count': self.count}
+    
+    def __repr__(self):
+        return 'StageStats(' + repr(self.as_dict()) + ')'
+        
+class _Stage(object):
+    """Context manager that times one run of a stage."""
+    
+    __slots__ = ('stats', 't0')
+    
+    def __init__(self, stats):
+        self.stats = stats
+        
+    def __enter__(self):
+        self.t0 = _clock()
+        return self.stats
+    
+    def __exit__(self, *args):
+        self.stats.time += _clock() - self.t0
+        self.stats.count += 1
+        return False
+
+class CallStats(object):
+    """Statistics of one call to a pysto function.
+    
+    Attributes:
+        name: Name of the function.
+        
+        time: Total wall time of the call (s).
+        
+        stages: OrderedDict stage name -> StageStats, in order of first use.
+        
+        info: Dictionary with extra information about the call (e.g. the 
+        number of blocks).
+    """
+    
+    def __init__(self, name):
+        self.name = name
+        self.time = 0.0
+        self.stages = OrderedDict()
+        self.info = {}
+        self._t0 = None
+        
+    def stage(self, name):
+        """Context manager to time a stage of the call. Stages with the same
+        name are accumulated. It returns the StageStats, so that allocations
+        can be recorded with add_bytes()."""
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats()
+        return _Stage(stats)
+    
+    def add_bytes(self, name, nbytes):
+        """Record bytes allocated by a stage, without timing it."""
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats()
+        stats.add_bytes(nbytes)
+        
+    def set_info(self, **kwargs):
+        self.info.update(kwargs)
+        
+    @property
+    def nbytes(self):
+        """Total bytes allocated by all stages."""
+        return sum(s.nbytes for s in self.stages.values())
+    
+    def as_dict(self):
+        return {'name': self.name, 'time': self.time, 'nbytes': self.nbytes,
+                'stages': OrderedDict((k, v.as_dict()) for k, v in self.stages.items()),
+                'info': dict(self.info)}
+        
+    def __repr__(self):
+        return 'CallStats(' + repr(self.as_dict()) + ')'
+    
+    def __enter__(self):
+        self._t0 = _clock()
+        return self
+    
+    def __exit__(self, *args):
+        self.time = _clock() - self._t0
+        _report(self)
+        return False
+    
+class Stats(object):
+    """Collection of CallStats recorded within a record() context.
+    
+    Attributes:
+        calls: List of CallStats, in order of completion.
+        
+        callback: Function called with each CallStats as soon as the call 
+        finishes, or None. Useful to feed a metrics system.
+    """
+    
+    def __init__(self, callback=None):
+        self.calls = []
+        self.callback = callback
+        self._lock = threading.Lock()
+        
+    def _add(self, call_stats):
+        with self._lock:
+            self.calls.append(call_stats)
+        if self.callback is not None:
+            self.callback(call_stats)
+            
+    def totals(self):
+        """Aggregate stage stats over all calls, as a dictionary
+        {function name: {stage name: {'time':..., 'nbytes':..., 'count':...}}}.
+        The special stage '__call__' holds the total time and number of calls.
+        """
+        out = OrderedDict()
+        for c in self.calls:
+            f = out.setdefault(c.name, OrderedDict())
+            total = f.setdefault('__call__', {'time': 0.0, 'nbytes': 0, 'count': 0})
+            total['time'] += c.time
+            total['nbytes'] += c.nbytes
+            total['count'] += 1
+            for stage_name, s in c.stages.items():
+                t = f.setdefault(stage_name, {'time': 0.0, 'nbytes': 0, 'count': 0})
+                t['time'] += s.time
+                t['nbytes'] += s.nbytes
+                t['count'] += s.count
+        return out
+    
+    def __repr__(self):
+        return 'Stats(' + repr(self.totals()) + ')'
+    
+###############################################################################
+## No-op objects used when instrumentation is disabled
+###############################################################################
+
+class _NullStats(object):
+    """Stands in for CallStats and StageStats when instrumentation is 
+    disabled. All methods do nothing."""
+    
+    __slots__ = ()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        return False
+    
+    def stage(self, name):
+        return self
+    
+    def add_bytes(self, *args):
+        pass
+    
+    def set_info(self, **kwargs):
+        pass
+    
+_NULL = _NullStats()
+
+###############################################################################
+## instrumented / current
+###############################################################################
+
+def instrumented(name):
+    """Decorator that instruments calls to a pysto function.
+    
+        @instrumented('block_split')
+        def block_split(...):
+            prof = current()
+            with prof.stage('pad') as st:
+                x = np.pad(...)
+                st.add_bytes(x.nbytes)
+    
+    Args:
+        name: Name the function is reported with.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            stack = getattr(_local, 'stack', None)
+            if stack is None:
+                stack = _local.stack = []
+            call_stats = CallStats(name)
+            stack.append(call_stats)
+            try:
+                with call_stats:
+                    return func(*args, **kwargs)
+            finally:
+                stack.pop()
+        return wrapper
+    return decorator
+
+def current():
+    """Stats of the innermost instrumented call running in this thread.
+    
+    Returns:
+        A CallStats object if instrumentation is enabled, or a no-op object 
+        with the same interface otherwise.
+    """
+    if not _enabled:
+        return _NULL
+    stack = getattr(_local, 'stack', None)
+    if not stack:
+        return _NULL
+    return stack[-1]
+
+def enabled():
+    """True if any recorder is active."""
+    return _enabled
+
+def _report(call_stats):
+    with _recorders_lock:
+        recorders = list(_recorders)
+    for r in recorders:
+        r._add(call_stats)
+        
+def _push(stats):
+    global _enabled
+    with _recorders_lock:
+        _recorders.append(stats)
+        _enabled = True
+
+def _pop(stats):
+    global _enabled
+    with _recorders_lock:
+        _recorders.remove(stats)
+        _enabled = len(_recorders) > 0
+
+###############################################################################
+## record
+###############################################################################
+
+@contextlib.contextmanager
+def record(callback=None):
+    """Record per-stage timings and allocated bytes of pysto calls.
+    
+        with record(callback=None) as stats:
+            ...
+    
+    All pysto calls that finish within the context (from any thread) are 
+    added to stats. Contexts can be nested, and each one gets all the calls.
+    
+    Args:
+        callback: (def None) Function called with a CallStats object each time
+        a pysto call finishes.
+        
+    Returns:
+        stats: Stats object.
+    """
+    stats = Stats(callback=callback)
+    _push(stats)
+    try:
+        yield stats
+    finally:
+        _pop(stats)
+        
+# process-wide instrumentation enabled by environment variable. Calls are 
+# logged at DEBUG level
+if os.environ.get('PYSTO_PROFILE', '0') not in ('', '0'):
+    _logger = logging.getLogger(__name__)
+    _push(Stats(callback=lambda c: _logger.debug('%r', c)))
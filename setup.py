@@ -33,6 +33,12 @@ setup(
     extras_require={
         'dev': ['spyder', 'twine', 'wheel', 'setuptools'],
         'test': ['pytest'],
+        'bench': ['asv'],
+        'numba': ['numba'],
+        'dask': ['dask[array]'],
+    },
+    entry_points={
+        'console_scripts': ['pysto-batch=pysto.cli:main'],
     },
     description='Miscellaneous image processing functions',
     long_description=read('README.rst'),
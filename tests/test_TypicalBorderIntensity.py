@@ -94,3 +94,37 @@ def test_grayscale_Image_np_array():
     
     assert(typicalIntensity == 241.0)
 
+
+def test_color_Image_2D_file():
+    
+    # image file
+    im_file = os.path.join(data_path, 'euxassay_003820_14.jpg')
+    
+    # compute typical edge intensity reading only the borders from disk
+    typicalIntensity = pitk.TypicalBorderIntensity(im_file)
+    
+    test.assert_array_equal(typicalIntensity, [241.0, 241.0, 241.0])
+
+def test_grayscale_Image_3D_file(tmpdir):
+    
+    # synthetic 3D volume, with a different value in each border voxel
+    np.random.seed(0)
+    x = np.random.randint(0, 1000, size=(5, 7, 9)).astype(np.int16)
+    im = sitk.GetImageFromArray(x)
+    
+    # write it to a format that supports streamed region reads
+    im_file = str(tmpdir.join('vol.mha'))
+    sitk.WriteImage(im, im_file)
+    
+    # reading only the borders must give the same result as the full image
+    for mode in ('median', 'mean'):
+        assert(pitk.TypicalBorderIntensity(im_file, mode=mode) 
+               == pitk.TypicalBorderIntensity(im, mode=mode))
+        assert(pitk.TypicalBorderIntensity(im_file, mode=mode) 
+               == pitk.TypicalBorderIntensity(x, mode=mode))
+    
+    # degenerate image with only two elements along the first dimension
+    x = np.random.randint(0, 1000, size=(2, 4, 3)).astype(np.int16)
+    im_file = str(tmpdir.join('thin.mha'))
+    sitk.WriteImage(sitk.GetImageFromArray(x), im_file)
+    assert(pitk.TypicalBorderIntensity(im_file) == pitk.TypicalBorderIntensity(x))
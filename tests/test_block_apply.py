@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/tests/pysto/tests/test_block_apply.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+import os
+import numpy as np
+import pysto.imgproc as pymg
+import pysto.blockproc as pbp
+import pysto.instrument as pin
+
+# block functions are defined at module level, so that they can be sent to 
+# the worker processes
+def neighbours(b):
+    y = np.zeros(b.shape)
+    y[1:-1, 1:-1] = b[:-2, 1:-1] + b[2:, 1:-1] + b[1:-1, :-2] + b[1:-1, 2:]
+    return y
+
+def fail_once(b, flag_file):
+    # fails the first time it's called on the block that contains value 0
+    if (b == 0).any() and not os.path.exists(flag_file):
+        open(flag_file, 'w').close()
+        raise RuntimeError('transient error')
+    return b * 2
+
+def crash(b):
+    if (b == 0).any():
+        os._exit(1)
+    return b
+
+def test_block_apply():
+    
+    x = np.random.RandomState(0).rand(20, 13)
+    expected = neighbours(np.pad(x, 1, mode='reflect'))[1:-1, 1:-1]
+    
+    # in-process executor
+    with pin.record() as stats:
+        y = pbp.block_apply(x, neighbours, nblocks=(3, 2), pad_width=1, mode='reflect')
+    assert(np.allclose(y, expected))
+    info = [c for c in stats.calls if c.name == 'block_apply'][0].info
+    assert(len(info['block_times']) == 6)
+    assert((info['attempts'] == 1).all())
+    
+    # local worker processes
+    with pbp.ProcessQueueExecutor(n_workers=2) as executor:
+        y = pbp.block_apply(x, neighbours, nblocks=(3, 2), pad_width=1, mode='reflect',
+                            executor=executor, out=np.zeros(x.shape, dtype=np.float32))
+    assert(y.dtype == np.float32)
+    assert(np.allclose(y, expected))
+
+def test_block_apply_retries(tmpdir):
+    
+    import functools
+    x = np.array(range(6*8)).reshape(6, 8)
+    func = functools.partial(fail_once, flag_file=str(tmpdir.join('flag')))
+    
+    # failed block is retried
+    with pbp.ProcessQueueExecutor(n_workers=2) as executor:
+        with pin.record() as stats:
+            y = pbp.block_apply(x, func, nblocks=(2, 2), executor=executor)
+    assert((y == 2 * x).all())
+    info = [c for c in stats.calls if c.name == 'block_apply'][0].info
+    assert(list(info['attempts']) == [2, 1, 1, 1])
+    
+    # without retries, the error is raised
+    os.remove(str(tmpdir.join('flag')))
+    try:
+        pbp.block_apply(x, func, nblocks=(2, 2), retries=0)
+        assert(False)
+    except Exception as e:
+        assert('transient error' in str(e))
+        
+    # worker process that dies is replaced, and the block fails
+    with pbp.ProcessQueueExecutor(n_workers=2) as executor:
+        try:
+            pbp.block_apply(x, crash, nblocks=(2, 2), executor=executor, retries=1)
+            assert(False)
+        except Exception as e:
+            assert('exited' in str(e))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/tests/pysto/tests/test_block_dask.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+import pytest
+import numpy as np
+import pysto.imgproc as pymg
+import pysto.blockproc as pbp
+
+da = pytest.importorskip('dask.array')
+
+def test_block_split_dask():
+    
+    x = np.array(range(7*10*3), dtype=np.float32).reshape(7, 10, 3)
+    
+    # same geometry and padding as block_split()
+    for mode in ['constant', 'reflect', 'wrap']:
+        block_slices, blocks = pbp.block_split_dask(x, nblocks=(2, 3, 1), pad_width=((2, 2), (1, 0), (0, 0)), mode=mode)
+        block_slices_ref, blocks_ref, _ = pymg.block_split(x, nblocks=(2, 3, 1), pad_width=((2, 2), (1, 0), (0, 0)), mode=mode)
+        assert(block_slices == block_slices_ref)
+        assert(len(blocks) == len(blocks_ref))
+        for b, b_ref in zip(blocks, blocks_ref):
+            assert(isinstance(b, da.Array))
+            assert(b.numblocks == (1, 1, 1))
+            assert(np.array_equal(b.compute(), b_ref))
+    
+    # reassemble
+    block_slices, blocks = pbp.block_split_dask(x, nblocks=(2, 3, 1), pad_width=2)
+    y = pbp.block_stack_dask(blocks, block_slices, pad_width=2)
+    assert(isinstance(y, da.Array))
+    assert(np.array_equal(y.compute(), x))
+    
+    # input is already a Dask array
+    block_slices, blocks = pbp.block_split_dask(da.from_array(x, chunks=(3, 3, 3)), nblocks=(2, 3, 1), pad_width=2)
+    y = pbp.block_stack_dask(blocks, block_slices, pad_width=2)
+    assert(np.array_equal(y.compute(), x))
+
+def test_block_stack_dask_missing_blocks():
+    
+    x = np.zeros((8, 8), dtype=np.int16)
+    x[:4, :4] = 5
+    
+    # skip background blocks, and stack the rest with Dask
+    block_slices, blocks, _ = pymg.block_split(x, nblocks=(2, 2), pad_width=1, background=0)
+    assert(len(blocks) == 1)
+    blocks = [da.from_array(b) for b in blocks]
+    y = pbp.block_stack_dask(blocks, block_slices, pad_width=1, shape=x.shape, fill_value=-1)
+    expected = -np.ones(x.shape, dtype=np.int16)
+    expected[:4, :4] = 5
+    assert(y.dtype == np.int16)
+    assert(np.array_equal(y.compute(), expected))
+
+def test_block_apply_dask():
+    
+    x = np.random.RandomState(0).rand(20, 13)
+    
+    # function that uses the neighbourhood of each pixel
+    def func(b):
+        y = np.zeros(b.shape)
+        y[1:-1, 1:-1] = b[:-2, 1:-1] + b[2:, 1:-1] + b[1:-1, :-2] + b[1:-1, 2:]
+        return y
+    
+    y = pbp.block_apply_dask(x, func, nblocks=(3, 2), pad_width=1, mode='reflect')
+    expected = func(np.pad(x, 1, mode='reflect'))[1:-1, 1:-1]
+    assert(y.shape == x.shape)
+    assert(np.allclose(y.compute(), expected))
+    
+    # keyword arguments for func
+    def scaled(b, scale=1):
+        return b * scale
+    y = pbp.block_apply_dask(x, scaled, nblocks=(3, 2), pad_width=1, mode='reflect',
+                             func_kwargs={'scale': 3})
+    assert(np.allclose(y.compute(), 3 * x))
+    
+    # nblocks must be explicit
+    try:
+        pbp.block_apply_dask(x, scaled, nblocks='auto')
+        assert(False)
+    except ValueError:
+        pass
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/tests/test_block_index.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import pysto.imgproc as pymg
+
+def test_block_index_query():
+    
+    x = np.array(range(12*20)).reshape(12, 20)
+    block_slices, blocks, _ = pymg.block_split(x, nblocks=(3, 4), pad_width=2)
+    
+    # blocks are rows [0,4), [4,8), [8,12), and columns [0,5), [5,10), 
+    # [10,15), [15,20)
+    index = pymg.BlockIndex(block_slices, pad_width=2)
+    assert(len(index) == 12)
+    assert(index.shape == (12, 20))
+    assert(list(index.query((slice(0, 4), slice(0, 5)))) == [0])
+    assert(list(index.query((slice(3, 5), slice(4, 6)))) == [0, 1, 4, 5])
+    assert(list(index.query((slice(None), slice(19, 30)))) == [3, 7, 11])
+    assert(list(index.query(np.array([[8, 12], [0, 20]]))) == [8, 9, 10, 11])
+    assert(len(index.query((slice(5, 5), slice(0, 20)))) == 0)
+    
+    # index with missing (background) blocks
+    x = np.zeros((12, 20), dtype=np.uint8)
+    x[0:4, 1:7] = 200
+    x[9, 19] = 100
+    block_slices, blocks, _ = pymg.block_split(x, nblocks=(3, 4), background=0, slices_format='array')
+    index = pymg.BlockIndex(block_slices)
+    assert(len(index) == 3)
+    assert(list(index.query((slice(None), slice(None)))) == [0, 1, 2])
+    assert(list(index.query((slice(4, 12), slice(0, 15)))) == [])
+    assert(list(index.query((slice(4, 12), slice(0, 20)))) == [2])
+
+def test_block_stack_roi():
+    
+    x = np.array(range(10*12*14), dtype=np.float64).reshape(10, 12, 14)
+    block_slices, blocks, _ = pymg.block_split(x, nblocks=(3, 3, 4), pad_width=1, lazy=True)
+    
+    # only the intersecting blocks are read
+    index = pymg.BlockIndex(block_slices, pad_width=1)
+    for roi in [(slice(2, 7), slice(0, 12), slice(5, 6)),
+                (slice(0, 10), slice(0, 12), slice(0, 14)),
+                (slice(9, 10), slice(11, 12), slice(13, 20))]:
+        y = pymg.block_stack_roi(blocks, block_slices, roi, pad_width=1, index=index)
+        assert((y == x[roi]).all())
+        
+    # ROI with missing blocks
+    x = np.zeros((12, 20), dtype=np.uint8)
+    x[0:4, 1:7] = 200
+    block_slices, blocks, _ = pymg.block_split(x, nblocks=(3, 4), background=0)
+    y = pymg.block_stack_roi(blocks, block_slices, (slice(2, 6), slice(3, 12)), 
+                             shape=x.shape, fill_value=0)
+    assert(y.dtype == np.uint8)
+    assert((y == x[2:6, 3:12]).all())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/tests/test_block_prefetch.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+import time
+import threading
+import numpy as np
+import pysto.imgproc as pymg
+import pysto.blockproc as pbp
+
+def test_block_prefetch():
+    
+    x = np.array(range(6*5*10)).reshape(6, 5, 10)
+    block_slices, blocks, _ = pymg.block_split(x, nblocks=(2, 2, 3), pad_width=1, 
+                                               mode='edge', lazy=True)
+    
+    # prefetched blocks are the same, in the same order
+    prefetched = list(pbp.block_prefetch(blocks, depth=3))
+    assert(len(prefetched) == len(blocks))
+    for b, bp in zip(blocks, prefetched):
+        assert((b == bp).all())
+        
+    # reassembling the prefetched blocks recovers the array
+    x2, _ = pymg.block_stack(pbp.block_prefetch(blocks), block_slices, pad_width=1,
+                             out=np.empty(x.shape, dtype=x.dtype))
+    assert((x2 == x).all())
+
+# iterable that records how many blocks have been read
+class CountingBlocks(object):
+    
+    def __init__(self, n, fail_at=None):
+        self.n = n
+        self.read = 0
+        self.fail_at = fail_at
+        
+    def __iter__(self):
+        for i in range(self.n):
+            if i == self.fail_at:
+                raise IOError('cannot read block ' + str(i))
+            self.read += 1
+            yield np.full((2, 2), i)
+
+def test_block_prefetch_backpressure():
+    
+    blocks = CountingBlocks(20)
+    it = pbp.block_prefetch(blocks, depth=2)
+    assert(next(it)[0, 0] == 0)
+    time.sleep(0.3)
+    
+    # one block consumed, 2 in the queue and at most one waiting to be queued
+    assert(blocks.read <= 4)
+    
+    # stopping early stops the background thread
+    it.close()
+    assert(not any(t.name == 'pysto-block-prefetch' for t in threading.enumerate()))
+
+def test_block_prefetch_error():
+    
+    # errors are raised when the failing block is reached
+    it = pbp.block_prefetch(CountingBlocks(5, fail_at=3), depth=2)
+    assert([b[0, 0] for b in [next(it), next(it), next(it)]] == [0, 1, 2])
+    try:
+        next(it)
+        assert(False)
+    except IOError:
+        pass
@@ -315,3 +315,185 @@ def test_padding():
     # check that all blocks were computed as expected    
     for eb, b in zip(expected_blocks, blocks):
         assert((eb == b).all())
+
+# minimal chunked array-like (like an HDF5 or Zarr dataset), that records the
+# regions that are read or written
+class ChunkedArray(object):
+    
+    def __init__(self, x, chunks):
+        self.x = x
+        self.shape = x.shape
+        self.dtype = x.dtype
+        self.chunks = chunks
+        self.reads = []
+        self.writes = []
+        
+    def __getitem__(self, idx):
+        self.reads += [idx]
+        return self.x[idx].copy()
+    
+    def __setitem__(self, idx, value):
+        self.writes += [idx]
+        self.x[idx] = value
+
+def test_lazy_blocks():
+    
+    x = np.array(range(12*20)).reshape(12, 20)
+    xc = ChunkedArray(x, chunks=(4, 5))
+    
+    # lazy blocks must be the same as the blocks computed on the whole array
+    for mode, kwargs in [('constant', {'constant_values': 7}), ('edge', {}),
+                         ('reflect', {}), ('symmetric', {}), 
+                         ('linear_ramp', {'end_values': -3})]:
+        block_slices, blocks, xout = pymg.block_split(x, nblocks=(3, 4), pad_width=2, 
+                                                      mode=mode, **kwargs)
+        block_slices_lazy, blocks_lazy, xout_lazy = pymg.block_split(xc, nblocks=(3, 4), 
+                                                                     pad_width=2, mode=mode, **kwargs)
+        
+        assert(isinstance(blocks_lazy, pymg.LazyBlocks))
+        assert(xout_lazy is None)
+        assert(block_slices == block_slices_lazy)
+        assert(len(blocks_lazy) == len(blocks))
+        for b, bl in zip(blocks, blocks_lazy):
+            assert((b == bl).all())
+            
+    # blocks are only read when accessed, and the whole array is never read
+    xc.reads = []
+    block_slices, blocks, _ = pymg.block_split(xc, nblocks=(3, 4), pad_width=2)
+    assert(xc.reads == [])
+    blocks[5]
+    assert(len(xc.reads) == 1)
+    assert(xc.reads[0] == (slice(2, 10, 1), slice(3, 12, 1)))
+    
+    # padding modes that need the whole array are not allowed
+    try:
+        pymg.block_split(xc, nblocks=(3, 4), pad_width=2, mode='wrap')
+        assert(False)
+    except ValueError:
+        pass
+
+def test_align_to_chunks():
+    
+    x = np.array(range(12*20)).reshape(12, 20)
+    xc = ChunkedArray(x, chunks=(5, 3))
+    
+    # 3 chunks in rows (5, 5, 2) and 7 chunks in columns (3, ..., 3, 2)
+    block_slices, blocks, _ = pymg.block_split(xc, nblocks=(2, 3), align_to_chunks=True)
+    starts = sorted(set([(sl[0].start, sl[1].start) for sl in block_slices]))
+    assert(sorted(set(s[0] for s in starts)) == [0, 10])
+    assert(sorted(set(s[1] for s in starts)) == [0, 9, 15])
+    
+    # blocks still cover the whole array
+    x2, _ = pymg.block_stack(blocks, block_slices)
+    assert((x2 == x).all())
+    
+    # there cannot be more blocks than chunks
+    try:
+        pymg.block_split(xc, nblocks=(4, 3), align_to_chunks=True)
+        assert(False)
+    except ValueError:
+        pass
+
+def test_skip_background_blocks():
+    
+    # image with foreground only in the top left corner
+    x = np.zeros((12, 20), dtype=np.uint8)
+    x[0:4, 1:7] = 200
+    
+    # skip blocks using a background value
+    block_slices, blocks, xout = pymg.block_split(x, nblocks=(3, 4), pad_width=1, background=0)
+    assert(len(blocks) == 2)
+    assert(block_slices == [(slice(0, 6, 1), slice(0, 7, 1)), (slice(0, 6, 1), slice(5, 12, 1))])
+    
+    # reassemble, filling the skipped blocks
+    x2, _ = pymg.block_stack(blocks, block_slices, pad_width=1, shape=x.shape, fill_value=0)
+    assert(x2.dtype == x.dtype)
+    assert((x2 == x).all())
+    
+    # skip using an occupancy threshold (first block is 16/20 foreground, 
+    # second block is 8/20)
+    block_slices, blocks, xout = pymg.block_split(x, nblocks=(3, 4), background=0, min_occupancy=0.5)
+    assert(len(blocks) == 1)
+    
+    # skip using a lower resolution mask
+    mask = np.zeros((6, 10), dtype=bool)
+    mask[0:2, 0:3] = True
+    block_slices, blocks, xout = pymg.block_split(x, nblocks=(3, 4), mask=mask)
+    assert(len(blocks) == 2)
+    
+    # colour image, with a background value per channel. Blocks are not split
+    # along the channel dimension
+    xrgb = np.stack([x, x, x], axis=-1)
+    xrgb[10, 18, 1] = 255
+    block_slices, blocks, xout = pymg.block_split(xrgb, nblocks=(3, 4, 1), background=[0, 0, 0])
+    assert(len(blocks) == 3)
+    
+    # lazy array-likes give the same blocks
+    xc = ChunkedArray(xrgb, chunks=(4, 5, 3))
+    block_slices_lazy, blocks_lazy, _ = pymg.block_split(xc, nblocks=(3, 4, 1), background=[0, 0, 0])
+    assert(block_slices_lazy == block_slices)
+    
+    # all blocks are background
+    x0 = np.zeros((8, 8), dtype=np.uint8)
+    block_slices, blocks, _ = pymg.block_split(x0, nblocks=2, background=0)
+    assert(block_slices == [] and blocks == [])
+    x2, _ = pymg.block_stack(blocks, block_slices, shape=x0.shape, fill_value=0)
+    assert(x2.shape == x0.shape)
+    assert((x2 == 0).all())
+
+def test_auto_nblocks():
+    
+    # 1000x1000 float64 array is 8 MB. With a 2 MB budget and 2 copies per 
+    # block, blocks must be at most 1 MB (131072 elements)
+    nblocks = pymg.block_auto_nblocks((1000, 1000), np.float64, memory_budget=2*1024**2)
+    assert(np.prod(nblocks) == 8)
+    assert(np.ceil(1000 / nblocks[0]) * np.ceil(1000 / nblocks[1]) * 8 * 2 <= 2*1024**2)
+    
+    # more workers and padding need smaller blocks
+    nblocks_workers = pymg.block_auto_nblocks((1000, 1000), np.float64, memory_budget=2*1024**2, 
+                                              pad_width=8, n_workers=4)
+    assert(np.prod(nblocks_workers) > np.prod(nblocks))
+    lengths = [np.ceil(1000 / nb) + 16 for nb in nblocks_workers]
+    assert(np.prod(lengths) * 8 * 2 * 4 <= 2*1024**2)
+    
+    # the budget is too small for any block size
+    try:
+        pymg.block_auto_nblocks((10, 10), np.float64, memory_budget=100, pad_width=8)
+        assert(False)
+    except ValueError:
+        pass
+    
+    # block_split with nblocks='auto'
+    x = np.array(range(60*80), dtype=np.float32).reshape(60, 80)
+    block_slices, blocks, xout = pymg.block_split(x, nblocks='auto', pad_width=2, 
+                                                  memory_budget=4096, n_workers=2)
+    assert(max(b.nbytes for b in blocks) * 2 * 2 <= 4096)
+    x2, _ = pymg.block_stack(blocks, block_slices, pad_width=2)
+    assert((x == x2).all())
+
+def test_slices_array_format():
+    
+    x = np.array(range(5*6*10)).reshape(5, 6, 10)
+    
+    block_slices, blocks, xout = pymg.block_split(x, nblocks=(2, 2, 3), pad_width=1)
+    block_array, blocks_array, xout_array = pymg.block_split(x, nblocks=(2, 2, 3), pad_width=1, 
+                                                             slices_format='array')
+    
+    # compact array with [start, stop] of each block and dimension
+    assert(block_array.shape == (12, 3, 2))
+    assert((block_array[1] == [[0, 5], [0, 5], [4, 9]]).all())
+    
+    # conversion between both formats
+    assert(pymg.block_slices_from_array(block_array) == block_slices)
+    assert((pymg.block_slices_to_array(block_slices) == block_array).all())
+    
+    # array slices can be used in block_stack and lazy blocks
+    x2, block_array_no_padding = pymg.block_stack(blocks_array, block_array, pad_width=1)
+    assert((x2 == x).all())
+    assert(isinstance(block_array_no_padding, np.ndarray))
+    assert((block_array_no_padding[1] == [[0, 3], [0, 3], [4, 7]]).all())
+    
+    _, blocks_lazy, _ = pymg.block_split(x, nblocks=(2, 2, 3), pad_width=1, 
+                                         slices_format='array', lazy=True)
+    for b, bl in zip(blocks, blocks_lazy):
+        assert((b == bl).all())
@@ -95,4 +95,59 @@ def test_split_stack():
     aux_split_stack(R=5, C=10, nblocks=(2,2,3), S=5, 
                     pad_width=(2, 3), mode='constant', constant_values=0)
     
- 
\ No newline at end of file
+ 
+# check that blocks can be written to an output array block by block
+def test_stack_to_out():
+    
+    x = np.array(range(6*5*10)).reshape(6, 5, 10)
+    block_slices, blocks, _ = pymg.block_split(x, nblocks=(2, 2, 3), pad_width=2, lazy=True)
+    
+    # blocks can be a generator, e.g. processing each lazy block
+    out = np.zeros(x.shape, dtype=np.int64)
+    x2, _ = pymg.block_stack((b * 2 for b in blocks), block_slices, pad_width=2, out=out)
+    assert(x2 is out)
+    assert((out == x * 2).all())
+    
+    # out must have the shape of the original array
+    try:
+        pymg.block_stack(blocks, block_slices, pad_width=2, out=np.zeros((6, 5, 9)))
+        assert(False)
+    except ValueError:
+        pass
+
+def test_stack_coverage():
+    
+    # integer label map with background blocks
+    x = np.zeros((12, 21), dtype=np.uint16)
+    x[0:4, 0:7] = 2
+    x[8:12, 14:21] = 5
+    block_slices, blocks, _ = pymg.block_split(x, nblocks=(3, 3), pad_width=1, background=0)
+    assert(len(blocks) == 2)
+    
+    # output keeps the dtype of the blocks, and coverage tells where blocks 
+    # were written
+    y, _, cov = pymg.block_stack(blocks, block_slices, pad_width=1, shape=x.shape, 
+                                 fill_value=7, coverage=True)
+    assert(y.dtype == np.uint16)
+    assert(cov.dtype == np.uint8 and cov.shape == (12, 3))
+    written = np.unpackbits(cov, axis=-1, count=x.shape[-1]).astype(bool)
+    expected = np.zeros(x.shape, dtype=bool)
+    expected[0:4, 0:7] = True
+    expected[8:12, 14:21] = True
+    assert((written == expected).all())
+    assert((y[written] == x[written]).all())
+    assert((y[~written] == 7).all())
+    
+    # blocks that cover the whole array
+    block_slices, blocks, _ = pymg.block_split(x, nblocks=(2, 5))
+    y, _, cov = pymg.block_stack(blocks, block_slices, coverage=True)
+    assert((y == x).all())
+    assert(np.unpackbits(cov, axis=-1, count=x.shape[-1]).all())
+
+def test_stack_dtype():
+    
+    x = np.random.RandomState(0).rand(10, 12)
+    block_slices, blocks, _ = pymg.block_split(x, nblocks=(2, 3), pad_width=1)
+    y, _ = pymg.block_stack(blocks, block_slices, pad_width=1, dtype=np.float32)
+    assert(y.dtype == np.float32)
+    assert((y == x.astype(np.float32)).all())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/tests/pysto/tests/test_block_store.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import pysto.imgproc as pymg
+import pysto.blockproc as pbp
+
+def test_compressed_block_store():
+    
+    # label map, that compresses well
+    x = np.zeros((40, 60), dtype=np.int32)
+    x[10:30, 5:50] = 3
+    block_slices, blocks, _ = pymg.block_split(x, nblocks=(2, 3), pad_width=2)
+    
+    store = pbp.CompressedBlockStore(blocks, codec='zlib', cache_size=1)
+    assert(len(store) == len(blocks))
+    assert(store.dtype == np.int32)
+    assert(store.nbytes < store.raw_nbytes / 5)
+    for i in range(len(blocks)):
+        assert(store.shape(i) == blocks[i].shape)
+        assert((store[i] == blocks[i]).all())
+        
+    # cached block is returned again, and blocks are read-only
+    assert(store[-1] is store[len(store) - 1])
+    assert(not store[0].flags.writeable)
+    
+    # replace a block
+    store[0] = blocks[0] + 1
+    assert((store[0] == blocks[0] + 1).all())
+    store[0] = blocks[0]
+    
+    # block_stack reads the store directly
+    y, _ = pymg.block_stack(store, block_slices, pad_width=2)
+    assert(y.dtype == np.int32)
+    assert((y == x).all())
+    
+    # default codec
+    store = pbp.CompressedBlockStore()
+    store.extend(blocks)
+    assert(store.codec in ('blosc', 'lz4', 'zlib'))
+    assert((store[2] == blocks[2]).all())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/tests/pysto/tests/test_buffer_pool.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import pysto.imgproc as pymg
+import pysto.blockproc as pbp
+
+def test_buffer_pool():
+    
+    pool = pbp.BufferPool()
+    a = pool.acquire((4, 5), np.float32)
+    assert(a.shape == (4, 5) and a.dtype == np.float32)
+    pool.release(a)
+    assert(pool.nbytes == a.nbytes)
+    
+    # same shape and dtype reuses the buffer, others are new
+    assert(pool.acquire((4, 5), np.float32) is a)
+    assert(pool.acquire((4, 5), np.float32) is not a)
+    assert(pool.acquire((4, 5), np.float64).dtype == np.float64)
+    assert(pool.nreused == 1 and pool.nallocated == 3)
+    
+    # views are not kept
+    pool.release(a[1:])
+    assert(pool.nbytes == 0)
+    
+    # size limit
+    pool = pbp.BufferPool(max_bytes=100)
+    pool.release(np.zeros(10))
+    pool.release(np.zeros(10))
+    assert(pool.nbytes == 80)
+
+def test_block_split_stack_pool():
+    
+    x = np.array(range(8*12*3), dtype=np.uint16).reshape(8, 12, 3)
+    pool = pbp.BufferPool()
+    
+    # split and stack several times, reusing the block buffers
+    for it in range(3):
+        block_slices, blocks, _ = pymg.block_split(x + it, nblocks=(2, 3, 1), pad_width=1, 
+                                                   mode='edge', pool=pool)
+        block_slices_ref, blocks_ref, _ = pymg.block_split(x + it, nblocks=(2, 3, 1), pad_width=1, 
+                                                           mode='edge')
+        for b, b_ref in zip(blocks, blocks_ref):
+            assert((b == b_ref).all())
+        y, _ = pymg.block_stack(blocks, block_slices, pad_width=1, pool=pool)
+        assert((y == x + it).all())
+    assert(pool.nallocated == 6)
+    assert(pool.nreused == 12)
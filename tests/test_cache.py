@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/tests/pysto/tests/test_cache.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+import os
+import functools
+import numpy as np
+import SimpleITK as sitk
+import pysto.cache as pcache
+import pysto.imgproc as pymg
+import pysto.imgprocITK as pitk
+import pysto.blockproc as pblk
+import pysto.instrument as pin
+
+# root and test data directories for pysto
+root_path = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+data_path = os.path.join(root_path, 'tests', 'data')
+
+def aux_ncalls(rec, name):
+    return len([c for c in rec.calls if c.name == name])
+
+def test_cache_disabled():
+    
+    # caching is opt-in
+    assert(not pcache.enabled())
+    x = np.random.rand(10, 10, 3)
+    with pin.record() as rec:
+        pymg.matchHist(x, x)
+        pymg.matchHist(x, x)
+    assert(aux_ncalls(rec, 'matchHist') == 2)
+
+def test_cache_matchHist(tmpdir):
+    
+    np.random.seed(0)
+    imref = np.random.randint(0, 256, size=(20, 30, 3)).astype(np.uint8)
+    im = np.random.randint(0, 200, size=(25, 15, 3)).astype(np.uint8)
+    expected = pymg.matchHist(imref, im)
+    
+    with pcache.caching(str(tmpdir)) as cache:
+        with pin.record() as rec:
+            out1 = pymg.matchHist(imref, im)
+            # the same call with keyword arguments is a hit
+            out2 = pymg.matchHist(imref=imref, im=im, nbr_bins=256)
+            # a different parameter or input is a miss
+            out3 = pymg.matchHist(imref, im, nbr_bins=128)
+            im[0, 0, 0] += 1
+            out4 = pymg.matchHist(imref, im)
+        assert(aux_ncalls(rec, 'matchHist') == 3)
+        assert(cache.nhits == 1)
+        assert(len(cache) == 3)
+    
+    # the cached result is loaded memory-mapped and read-only
+    assert(np.array_equal(out1, expected))
+    assert(np.array_equal(out2, expected))
+    assert(isinstance(out2, np.memmap))
+    assert(not out2.flags.writeable)
+    assert(not np.array_equal(out3, expected))
+    
+    # the previous state is restored at the end of the context
+    assert(not pcache.enabled())
+
+def test_cache_TypicalBorderIntensity_file(tmpdir):
+    
+    # copy of a test image, so that it can be modified
+    x = np.random.randint(0, 1000, size=(4, 6, 5)).astype(np.int16)
+    im_file = str(tmpdir.join('vol.mha'))
+    sitk.WriteImage(sitk.GetImageFromArray(x), im_file)
+    
+    with pcache.caching(str(tmpdir.join('cache'))) as cache:
+        
+        # files, images and colour results (lists) are cached
+        v1 = pitk.TypicalBorderIntensity(im_file)
+        v2 = pitk.TypicalBorderIntensity(im_file)
+        assert(v1 == v2 == pitk.TypicalBorderIntensity(x))
+        rgb = os.path.join(data_path, 'euxassay_003820_14.jpg')
+        assert(pitk.TypicalBorderIntensity(rgb) == [241.0, 241.0, 241.0])
+        assert(pitk.TypicalBorderIntensity(rgb) == [241.0, 241.0, 241.0])
+        assert(cache.nhits == 2)
+        
+        # a modified file is a miss
+        x[0, 0, :] = 2000
+        sitk.WriteImage(sitk.GetImageFromArray(x), im_file)
+        os.utime(im_file, ns=(0, os.stat(im_file).st_mtime_ns + 10**9))
+        assert(pitk.TypicalBorderIntensity(im_file) == pitk.TypicalBorderIntensity(x))
+        assert(cache.nhits == 2)
+
+def aux_double(block):
+    return 2 * block
+
+def test_cache_block_apply(tmpdir):
+    
+    x = np.arange(64, dtype=np.float32).reshape(8, 8)
+    
+    with pcache.caching(str(tmpdir)) as cache:
+        
+        # module-level functions and partials are hashed by name
+        y1 = pblk.block_apply(x, aux_double, nblocks=2)
+        y2 = pblk.block_apply(x, aux_double, nblocks=2, retries=0)
+        y3 = pblk.block_apply(x, functools.partial(np.multiply, 2), nblocks=2)
+        y4 = pblk.block_apply(x, functools.partial(np.multiply, 2), nblocks=2)
+        assert(cache.nhits == 2)
+        assert(np.array_equal(y1, 2 * x) and np.array_equal(y2, 2 * x))
+        assert(np.array_equal(y3, 2 * x) and np.array_equal(y4, 2 * x))
+        
+        # lambdas can't be hashed, and calls with out have side effects, so 
+        # they are not cached
+        n = len(cache)
+        pblk.block_apply(x, lambda b: 2 * b, nblocks=2)
+        out = np.zeros_like(x)
+        pblk.block_apply(x, aux_double, nblocks=2, out=out)
+        assert(np.array_equal(out, 2 * x))
+        assert(len(cache) == n)
+        assert(cache.nhits == 2)
+
+def test_result_cache_eviction(tmpdir):
+    
+    # cache that fits two 800-byte arrays (plus the .npy headers)
+    cache = pcache.ResultCache(str(tmpdir), max_bytes=2000)
+    keys = [cache.key('f', i) for i in range(3)]
+    assert(len(set(keys)) == 3)
+    
+    cache.put(keys[0], np.zeros(100))
+    cache.put(keys[1], np.ones(100))
+    
+    # use the first result, so that the second one is the least recently used
+    t = os.stat(cache._file(keys[0], 'array')).st_mtime_ns
+    os.utime(cache._file(keys[1], 'array'), ns=(t - 10**9, t - 10**9))
+    found, x = cache.get(keys[0])
+    assert(found and np.all(x == 0))
+    
+    # adding a third result evicts the second one
+    cache.put(keys[2], np.full(100, 2.0))
+    assert(len(cache) == 2)
+    assert(cache.nbytes <= 2000)
+    assert(cache.get(keys[1]) == (False, None))
+    assert(cache.get(keys[0])[0] and cache.get(keys[2])[0])
+    
+    # results bigger than the cache, or of unsupported types, are not saved
+    assert(not cache.put(cache.key('g'), np.zeros(1000)))
+    assert(not cache.put(cache.key('h'), {'a': 1}))
+    assert(cache.put(cache.key('i'), 3.5))
+    assert(cache.get(cache.key('i')) == (True, 3.5))
+    
+    # unhashable arguments give no key
+    assert(cache.key('f', lambda: 0) is None)
+    assert(cache.key('f', object()) is None)
+    
+    cache.clear()
+    assert(len(cache) == 0)
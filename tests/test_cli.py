@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/tests/pysto/tests/test_cli.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+import os
+import numpy as np
+import cv2
+import pysto.cli as pcli
+import pysto.imgproc as pymg
+
+# root and test data directories for pysto
+root_path = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+data_path = os.path.join(root_path, 'tests', 'data')
+
+def aux_make_dir(path, nfiles, channels=3, seed=0):
+    """Directory with random RGB or grayscale PNG images."""
+    np.random.seed(seed)
+    os.makedirs(path)
+    for i in range(nfiles):
+        shape = (20 + i, 30) if channels == 1 else (20 + i, 30, channels)
+        im = np.random.randint(0, 256, size=shape).astype(np.uint8)
+        cv2.imwrite(os.path.join(path, 'im%02d.png' % i), im)
+
+def test_matchhist(tmpdir):
+    
+    # input images, and reference image
+    in_dir = str(tmpdir.join('in'))
+    out_dir = str(tmpdir.join('out'))
+    aux_make_dir(in_dir, 5)
+    ref = os.path.join(data_path, 'left.png')
+    
+    # process the directory in the calling process, and with 2 workers
+    assert(pcli.main(['matchhist', '-q', '-j', '1', '--ref', ref, in_dir, out_dir]) == 0)
+    out1 = [pcli._imread(os.path.join(out_dir, f)) for f in pcli._list_images(out_dir)]
+    assert(pcli.main(['matchhist', '-q', '-j', '2', '--ref', ref, in_dir, out_dir]) == 0)
+    out2 = [pcli._imread(os.path.join(out_dir, f)) for f in pcli._list_images(out_dir)]
+    assert(len(out1) == 5)
+    
+    # outputs are the same as matching each image to the reference histogram
+    acc = pcli.fit_reference([ref])
+    for f, o1, o2 in zip(pcli._list_images(in_dir), out1, out2):
+        expected = pymg.matchHist(acc, pcli._imread(os.path.join(in_dir, f)))
+        assert(np.array_equal(o1, expected))
+        assert(np.array_equal(o2, expected))
+
+def test_matchhist_grayscale(tmpdir):
+    
+    # grayscale input and reference images
+    in_dir = str(tmpdir.join('in'))
+    out_dir = str(tmpdir.join('out'))
+    ref_dir = str(tmpdir.join('ref'))
+    aux_make_dir(in_dir, 2, channels=1, seed=1)
+    aux_make_dir(ref_dir, 2, channels=1, seed=2)
+    refs = [os.path.join(ref_dir, f) for f in pcli._list_images(ref_dir)]
+    
+    # the histograms of several reference images are accumulated
+    assert(pcli.main(['matchhist', '-q', '-j', '1', '--ref', refs[0], '--ref', refs[1], 
+                      in_dir, out_dir]) == 0)
+    acc = pcli.fit_reference(refs)
+    assert(acc.counts.sum() == sum(pcli._imread(r).size for r in refs))
+    for f in pcli._list_images(in_dir):
+        expected = pymg.matchHist(acc, pcli._imread(os.path.join(in_dir, f)), channel_axis=None)
+        assert(np.array_equal(pcli._imread(os.path.join(out_dir, f)), expected))
+
+def test_imfuse(tmpdir):
+    
+    # pairs of images with the same name, and an unpaired image
+    dir_a = str(tmpdir.join('a'))
+    dir_b = str(tmpdir.join('b'))
+    out_dir = str(tmpdir.join('out'))
+    aux_make_dir(dir_a, 3, seed=1)
+    aux_make_dir(dir_b, 2, seed=2)
+    
+    assert(pcli.main(['imfuse', '-q', '-j', '2', dir_a, dir_b, out_dir]) == 0)
+    assert(pcli._list_images(out_dir) == ['im00.png', 'im01.png'])
+    for f in pcli._list_images(out_dir):
+        expected = pymg.imfuse(pcli._imread(os.path.join(dir_a, f)), 
+                               pcli._imread(os.path.join(dir_b, f)))
+        assert(np.array_equal(pcli._imread(os.path.join(out_dir, f)), expected))
+
+def test_run_batch_errors(tmpdir):
+    
+    # a file that is not an image is reported as an error, and the rest of
+    # the batch is processed
+    in_dir = str(tmpdir.join('in'))
+    out_dir = str(tmpdir.join('out'))
+    aux_make_dir(in_dir, 2)
+    with open(os.path.join(in_dir, 'bad.png'), 'w') as f:
+        f.write('not an image')
+    
+    assert(pcli.main(['imfuse', '-q', '-j', '1', in_dir, in_dir, out_dir]) == 1)
+    assert(pcli._list_images(out_dir) == ['im00.png', 'im01.png'])
+    
+    # statistics of the batch
+    names = pcli._list_images(in_dir)
+    stats = pcli.run_batch(pcli._imfuse_task, 
+                           [(os.path.join(in_dir, f),) * 2 for f in names],
+                           [os.path.join(out_dir, f) for f in names], jobs=1)
+    assert(stats['nfiles'] == 2)
+    assert(len(stats['errors']) == 1)
+    assert(stats['errors'][0][0].endswith('bad.png'))
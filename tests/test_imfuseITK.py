@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/tests/pysto/tests/test_imfuseITK.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+import os
+import numpy as np
+import SimpleITK as sitk
+import pysto.imgproc as pymg
+import pysto.imgprocITK as pitk
+import pysto.instrument as pin
+
+# root and test data directories for pysto
+root_path = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+data_path = os.path.join(root_path, 'tests', 'data')
+
+def test_imfuseITK_same_grid():
+    
+    # RGB test images with the same origin and spacing, and different sizes
+    im1 = sitk.ReadImage(os.path.join(data_path, "left.png"))
+    im2 = sitk.ReadImage(os.path.join(data_path, "right.png"))
+    
+    # fuse images
+    imf = pitk.imfuseITK(im1, im2)
+    
+    # output grid contains both images, as the zero-padding in imfuse()
+    assert(imf.GetSize() == tuple(np.maximum(im1.GetSize(), im2.GetSize())))
+    assert(imf.GetOrigin() == im1.GetOrigin())
+    assert(imf.GetSpacing() == im1.GetSpacing())
+    assert(imf.GetNumberOfComponentsPerPixel() == 3)
+    
+    # same result as imfuse() on np.arrays, up to rounding differences in the
+    # RGB to grayscale conversion
+    expected = pymg.imfuse(sitk.GetArrayFromImage(im1), sitk.GetArrayFromImage(im2))
+    assert(np.abs(sitk.GetArrayFromImage(imf).astype(np.int16) - expected).max() <= 2)
+
+def test_imfuseITK_physical_space():
+    
+    # fixed image with unit spacing, and moving image with a different 
+    # origin and spacing, to the right of the fixed image
+    a = sitk.GetImageFromArray(np.arange(20, dtype=np.float32).reshape(4, 5))
+    b = sitk.GetImageFromArray(np.full((2, 2), 100, dtype=np.float32))
+    b.SetOrigin((6.0, 1.0))
+    b.SetSpacing((1.0, 2.0))
+    
+    # fuse images
+    imf = pitk.imfuseITK(a, b, interpolator='nearest')
+    
+    # the grid contains both images
+    assert(imf.GetSize() == (8, 4))
+    assert(imf.GetOrigin() == (0.0, 0.0))
+    assert(imf.GetSpacing() == (1.0, 1.0))
+    
+    # channels are (B, A, B), with A and B in their physical positions
+    x = sitk.GetArrayFromImage(imf)
+    assert(np.all(x[:, 0:5, 1] == np.arange(20).reshape(4, 5)))
+    assert(np.all(x[:, 5:, 1] == 0))
+    assert(np.all(x[:, 6:, 0] == 100))
+    assert(np.all(x[:, 0:6, 0] == 0))
+    assert(np.all(x[..., 0] == x[..., 2]))
+
+def test_imfuseITK_transform_cache():
+    
+    # fixed and moving images on the same grid
+    a = sitk.GetImageFromArray(np.zeros((10, 10), dtype=np.float32))
+    x = np.zeros((10, 10), dtype=np.float32)
+    x[4, 4] = 1
+    b = sitk.GetImageFromArray(x)
+    
+    # preview of several iterations of a registration, with the output grid 
+    # of the fixed image
+    with pin.record() as rec:
+        for dx in range(3):
+            tr = sitk.TranslationTransform(2, (float(dx), 0.0))
+            imf = pitk.imfuseITK(a, b, transform=tr, reference=a, 
+                                 interpolator='nearest')
+            
+            # the moving image is translated (the transform maps output 
+            # points to the moving image)
+            y = sitk.GetArrayFromImage(imf)[..., 0]
+            assert(y[4, 4 - dx] == 1)
+            assert(y.sum() == 1)
+    
+    # only the moving image is resampled, and the resampler is reused
+    calls = [c for c in rec.calls if c.name == 'imfuseITK']
+    assert(len(calls) == 3)
+    assert(all(c.info['nresampled'] == 1 for c in calls))
+    keys = [k for k in pitk._resample_cache if k[0] == pitk._itk_grid(a)]
+    assert(len(keys) == 1)
+
+def test_imfuseITK_errors():
+    
+    a = sitk.Image(4, 4, sitk.sitkUInt8)
+    b = sitk.Image(4, 4, 4, sitk.sitkUInt8)
+    
+    try:
+        pitk.imfuseITK(a, b)
+        assert(False)
+    except ValueError:
+        pass
+    try:
+        pitk.imfuseITK(a, a, interpolator='cubic')
+        assert(False)
+    except ValueError:
+        pass
+    try:
+        pitk.imfuseITK(sitk.GetArrayFromImage(a), a)
+        assert(False)
+    except TypeError:
+        pass
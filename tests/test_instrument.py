@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/tests/test_instrument.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+import pysto.imgproc as pymg
+import pysto.instrument as pinst
+
+def test_disabled():
+    
+    # without a record() context, instrumentation is disabled and current() 
+    # returns the no-op object
+    assert(not pinst.enabled())
+    assert(pinst.current() is pinst._NULL)
+    
+    # instrumented functions work as usual
+    x = np.arange(50).reshape(5, 10)
+    block_slices, blocks, xout = pymg.block_split(x, nblocks=(2, 2))
+    assert(len(blocks) == 4)
+
+def test_record():
+    
+    x = np.arange(50).reshape(5, 10)
+    
+    calls = []
+    with pinst.record(callback=calls.append) as stats:
+        assert(pinst.enabled())
+        block_slices, blocks, xout = pymg.block_split(x, nblocks=(2, 2), pad_width=1)
+        x2, _ = pymg.block_stack(blocks, block_slices, pad_width=1)
+    assert(not pinst.enabled())
+    assert((x == x2).all())
+    
+    # one CallStats per call, reported both to the callback and the stats
+    assert([c.name for c in stats.calls] == ['block_split', 'block_stack'])
+    assert(calls == stats.calls)
+    
+    # stages of block_split
+    c = stats.calls[0]
+    assert(sorted(c.stages) == ['copy', 'pad', 'slices'])
+    assert(c.stages['pad'].nbytes == xout.nbytes)
+    assert(c.stages['copy'].count == 4)
+    assert(c.stages['copy'].nbytes == sum(b.nbytes for b in blocks))
+    assert(c.info['nblocks'] == 4)
+    assert(c.time >= c.stages['pad'].time)
+    
+    # aggregated stats
+    totals = stats.totals()
+    assert(totals['block_split']['__call__']['count'] == 1)
+    assert(totals['block_stack']['copy']['count'] == 4)
+
+def test_nested_record():
+    
+    x = np.arange(50).reshape(5, 10)
+    
+    with pinst.record() as outer:
+        pymg.block_split(x, nblocks=2)
+        with pinst.record() as inner:
+            pymg.block_split(x, nblocks=2)
+        
+    assert(len(outer.calls) == 2)
+    assert(len(inner.calls) == 1)
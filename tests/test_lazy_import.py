@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+@file: pysto/tests/test_lazy_import.py
+@package: pysto
+@author: Ramón Casero <rcasero@gmail.com>
+@copyright: © 2017  Ramón Casero <rcasero@gmail.com>
+@license: GPL v3
+@version: 1.0.0
+
+This file is part of pysto.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details. The offer of this
+program under the terms of the License is subject to the License
+being interpreted in accordance with English Law and subject to any
+action against the University of Oxford being under the jurisdiction
+of the English Courts.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+"""
+
+import subprocess
+import sys
+
+# run python code in a fresh interpreter, and return the list of heavy modules
+# that have been imported
+def aux_loaded_modules(code):
+    
+    code += '\nimport sys\nprint(" ".join(m for m in ("numpy", "cv2", "SimpleITK", "matplotlib") if m in sys.modules))'
+    out = subprocess.check_output([sys.executable, '-c', code])
+    return out.decode().split()
+
+def test_import_package():
+    
+    # importing the package must not import any heavy dependency
+    assert(aux_loaded_modules('import pysto') == [])
+
+def test_import_submodules():
+    
+    # submodules only need numpy until an image-library function is called
+    assert(aux_loaded_modules('import pysto.imgproc') == ['numpy'])
+    assert(aux_loaded_modules('import pysto.imgprocITK') == ['numpy'])
+
+def test_lazy_api():
+    
+    # accessing a function from the package imports only its submodule
+    assert(aux_loaded_modules('import pysto; pysto.block_split') == ['numpy'])
+    
+    import pysto
+    import pysto.imgproc
+    assert(pysto.block_split is pysto.imgproc.block_split)
+    assert(pysto.imgprocITK.imshow is pysto.imshow)
+    assert('matchHist' in dir(pysto))
@@ -85,4 +85,227 @@ def test_matchHist():
 
     plt.show(block=False)
     plt.close()
-    
\ No newline at end of file
+    
+def test_matchHist_backends():
+    """Test that the numba and numpy backends produce the same results
+    """
+    
+    import numpy as np
+    import pytest
+    pytest.importorskip('numba')
+    
+    # read test images and their masks
+    imref = cv2.imread(os.path.join(data_path, "right.png"))
+    im = cv2.imread(os.path.join(data_path, "left.png"))
+    maskref = cv2.imread(os.path.join(data_path, "right_mask.png"))[:, :, 1]==255
+    mask = cv2.imread(os.path.join(data_path, "left_mask.png"))[:, :, 1]==255
+    
+    # colour images, with and without masks
+    for kwargs in [{}, {'maskref': maskref, 'mask': mask}]:
+        im_numpy = pymg.matchHist(imref, im, backend='numpy', **kwargs)
+        im_numba = pymg.matchHist(imref, im, backend='numba', **kwargs)
+        assert((im_numpy == im_numba).all())
+    
+    # grayscale float images
+    imref = imref[:, :, 0].astype(np.float64)
+    im = im[:, :, 0].astype(np.float64)
+    im_numpy = pymg.matchHist(imref, im, maskref=maskref, mask=mask, backend='numpy')
+    im_numba = pymg.matchHist(imref, im, maskref=maskref, mask=mask, backend='numba')
+    np.testing.assert_allclose(im_numpy, im_numba)
+    
+    # both backends reject non-finite values
+    im[0, 0] = np.nan
+    for backend in ['numpy', 'numba']:
+        try:
+            pymg.matchHist(imref, im, backend=backend)
+            assert(False)
+        except ValueError as e:
+            assert('not finite' in str(e))
+
+def test_matchHist_nd():
+    """Test matchHist() with N-D images and channel_axis
+    """
+    
+    import numpy as np
+    
+    imref = cv2.imread(os.path.join(data_path, "right.png"))
+    im = cv2.imread(os.path.join(data_path, "left.png"))
+    maskref = cv2.imread(os.path.join(data_path, "right_mask.png"))[:, :, 1]==255
+    mask = cv2.imread(os.path.join(data_path, "left_mask.png"))[:, :, 1]==255
+    im_matched = pymg.matchHist(imref, im, maskref=maskref, mask=mask)
+    
+    # channels in the first axis
+    im_matched_first = pymg.matchHist(np.moveaxis(imref, -1, 0), np.moveaxis(im, -1, 0),
+                                      maskref=maskref, mask=mask, channel_axis=0)
+    assert(im_matched_first.shape == (3,) + im.shape[0:2])
+    assert((np.moveaxis(im_matched_first, 0, -1) == im_matched).all())
+    
+    # 4D image [row, col, slice, channel], where each slice is the same 
+    # image, with 3D masks. The histograms of the whole volume are the same 
+    # as the histograms of one slice
+    vol_matched = pymg.matchHist(np.stack([imref] * 2, axis=2), np.stack([im] * 3, axis=2),
+                                 maskref=np.stack([maskref] * 2, axis=2), 
+                                 mask=np.stack([mask] * 3, axis=2))
+    assert(vol_matched.shape == im.shape[0:2] + (3, 3))
+    for i in range(3):
+        assert((vol_matched[:, :, i, :] == im_matched).all())
+    
+    # 3D grayscale volume without channels
+    vol = np.stack([im[:, :, 0]] * 2, axis=2)
+    vol_matched = pymg.matchHist(imref[:, :, 0:2], vol, channel_axis=None)
+    assert(vol_matched.shape == vol.shape)
+    expected = pymg.matchHist(imref[:, :, 0:2].reshape(-1, 1), vol.reshape(-1, 1), channel_axis=None)
+    assert((vol_matched == expected.reshape(vol.shape)).all())
+
+def test_histogram_accumulator():
+    """Test HistogramAccumulator, and matchHist() with an accumulated 
+    reference
+    """
+    
+    import pickle
+    import numpy as np
+    
+    imref = cv2.imread(os.path.join(data_path, "right.png"))
+    im = cv2.imread(os.path.join(data_path, "left.png"))
+    maskref = cv2.imread(os.path.join(data_path, "right_mask.png"))[:, :, 1]==255
+    
+    # histogram of the whole image, as np.histogram()
+    acc = pymg.HistogramAccumulator((0, 255), nbr_bins=32)
+    acc.update(imref, maskref)
+    assert(acc.counts.shape == (3, 32))
+    for c in range(3):
+        counts, edges = np.histogram(imref[:, :, c][maskref], 32, range=(0, 255))
+        assert((acc.counts[c] == counts).all())
+        assert((acc.edges[c] == edges).all())
+        
+    # partial histograms of row chunks, merged
+    acc1 = pymg.HistogramAccumulator((0, 255), nbr_bins=32)
+    acc2 = pymg.HistogramAccumulator((0, 255), nbr_bins=32)
+    acc1.update(imref[:100], maskref[:100])
+    acc2.update(imref[100:], maskref[100:])
+    acc1.merge(acc2)
+    assert((acc1.counts == acc.counts).all())
+    
+    # values outside the range are not counted
+    acc_small = pymg.HistogramAccumulator((10, 20), nbr_bins=4, channel_axis=None)
+    acc_small.update(np.array([5, 10, 12, 20, 21, np.nan]))
+    assert(list(acc_small.counts[0]) == [2, 0, 0, 1])
+    
+    # serialization
+    acc_copy = pymg.HistogramAccumulator.from_bytes(acc.to_bytes())
+    assert((acc_copy.counts == acc.counts).all() and (acc_copy.edges == acc.edges).all())
+    assert(len(acc.to_bytes()) < acc.counts.nbytes + acc.edges.nbytes)
+    acc_copy = pickle.loads(pickle.dumps(acc))
+    assert((acc_copy.counts == acc.counts).all())
+    
+    # histograms with different bins cannot be merged
+    try:
+        acc.merge(pymg.HistogramAccumulator((0, 100), nbr_bins=32).update(imref))
+        assert(False)
+    except ValueError:
+        pass
+    
+    # the accumulator gives the same result as the reference image, when the 
+    # images have the same range (up to rounding to integers)
+    acc = pymg.HistogramAccumulator([(imref[:, :, c].min(), imref[:, :, c].max()) for c in range(3)])
+    acc.update(imref)
+    assert(np.abs(pymg.matchHist(acc, im).astype(int) - pymg.matchHist(imref, im)).max() <= 1)
+    
+    # an image with a different range than the accumulator bins is matched to
+    # the reference distribution
+    rs = np.random.RandomState(0)
+    acc = pymg.HistogramAccumulator((0, 255), nbr_bins=256, channel_axis=None)
+    acc.update(rs.uniform(0, 255, 100000))
+    x_matched = pymg.matchHist(acc, rs.uniform(0, 10, 20000), channel_axis=None)
+    assert(abs(x_matched.mean() - 127.5) < 2)
+    assert(abs(np.percentile(x_matched, 90) - 229.5) < 3)
+
+def test_matchHist_mask_in_place():
+    """Pixels outside the mask are not modified, and are not used for the 
+    histograms, even if they are not finite
+    """
+    
+    import numpy as np
+    
+    rs = np.random.RandomState(3)
+    imref = rs.rand(40, 30)
+    im = rs.rand(20, 50) * 3 + 1
+    mask = rs.rand(20, 50) > 0.3
+    im[~mask] = np.nan
+    
+    im_matched = pymg.matchHist(imref, im, mask=mask)[:, :, 0]
+    assert(np.isnan(im_matched[~mask]).all())
+    assert(np.isfinite(im_matched[mask]).all())
+    expected = pymg.matchHist(imref, im[mask].reshape(-1, 1), channel_axis=None)[:, 0]
+    assert((im_matched[mask] == expected).all())
+
+def test_matchHistLocal():
+    """Test matchHistLocal()
+    """
+    
+    import numpy as np
+    
+    imref = cv2.imread(os.path.join(data_path, "right.png"))
+    im = cv2.imread(os.path.join(data_path, "left.png"))
+    
+    # with one tile, it's the same as matchHist() (both images have the same 
+    # range, up to rounding to integers)
+    im_matched = pymg.matchHistLocal(imref, im, nblocks=1)
+    assert(im_matched.shape == im.shape and im_matched.dtype == im.dtype)
+    assert(np.abs(im_matched.astype(int) - pymg.matchHist(imref, im)).max() <= 1)
+    
+    # texture with uneven illumination from left to right
+    rs = np.random.RandomState(0)
+    ref = rs.rand(60, 80)
+    x = rs.rand(60, 80) * np.linspace(0.2, 1.0, 80)
+    x_global = pymg.matchHist(ref, x, channel_axis=None)
+    x_local = pymg.matchHistLocal(ref, x, nblocks=(2, 4), channel_axis=None)
+    assert(x_local.shape == x.shape)
+    
+    # local matching corrects the illumination better than global matching
+    col_means_global = x_global.reshape(60, 4, 20).mean(axis=(0, 2))
+    col_means_local = x_local.reshape(60, 4, 20).mean(axis=(0, 2))
+    assert(np.ptp(col_means_local) < np.ptp(col_means_global) / 2)
+    
+    # no seams: a smooth ramp stays smooth after blending the tile mappings
+    ramp = np.add.outer(np.arange(40.0), np.arange(50.0))
+    ramp_local = pymg.matchHistLocal(ref, ramp, nblocks=(3, 3), channel_axis=None)
+    assert(np.abs(np.diff(ramp_local, axis=1)).max() < 0.1)
+    assert(np.abs(np.diff(ramp_local, axis=0)).max() < 0.1)
+    
+    # pixels outside the mask are not modified
+    mask = np.zeros(x.shape, dtype=bool)
+    mask[:, 10:] = True
+    x_local = pymg.matchHistLocal(ref, x, nblocks=(2, 4), mask=mask, channel_axis=None)
+    assert((x_local[~mask] == x[~mask]).all())
+
+def test_matchHist_precision():
+    """Test matchHist() and matchHistLocal() with float32 intermediate values
+    """
+    
+    import numpy as np
+    import pysto.instrument as pin
+    
+    imref = cv2.imread(os.path.join(data_path, "right.png"))
+    im = cv2.imread(os.path.join(data_path, "left.png"))
+    mask = cv2.imread(os.path.join(data_path, "left_mask.png"))[:, :, 1]==255
+    
+    # float32 interpolation is the same as np.interp, up to float32 rounding
+    rs = np.random.RandomState(0)
+    xp = np.sort(rs.rand(50))
+    xp[10:13] = xp[10]
+    fp = np.cumsum(rs.rand(50))
+    x = rs.rand(1000) * 1.2 - 0.1
+    y = pymg._interp(x, xp, fp, np.float32)
+    assert(y.dtype == np.float32)
+    np.testing.assert_allclose(y, np.interp(x, xp, fp), rtol=1e-5)
+    
+    # 8-bit images
+    with pin.record() as stats:
+        im64 = pymg.matchHist(imref, im, mask=mask)
+        im32 = pymg.matchHist(imref, im, mask=mask, precision='float32')
+    assert(np.abs(im64.astype(int) - im32).max() <= 1)
+    assert(stats.calls[1].stages['interp'].nbytes * 2 == stats.calls[0].stages['interp'].nbytes)
+    im64 = pymg.matchHistLocal(imref, im, nblocks=(2, 3))
+    im32 = pymg.matchHistLocal(imref, im, nblocks=(2, 3), precision='float32')
+    assert(np.abs(im64.astype(int) - im32).max() <= 1)